@@ -0,0 +1,329 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""Generate one Python module per XProgram.
+
+Every XFormula becomes a node `C[id]`, the instructions become local variables
+`s0, s1, ...` and the branches become `if/else`. Nodes are emitted in one
+function per topological level, so the module is evaluated without any
+dispatch on the syntax tuples.
+
+The compiled code object is cached as a hash-based `.pyc` next to the
+workbook text, repeat loads skip both parsing and code generation.
+"""
+
+import importlib.util
+import marshal
+import os
+import sys
+import types
+from typing import Callable, Dict, List
+
+from . import Compiler
+from . import Utils
+from .Evaluator import FUNCS, OPERATORS, UNARY, to_value
+from .Formula import XFormula, as_ref
+from .Graph import from_program
+from .PseudoCode import XProgram
+
+__all__ = ["generate", "load", "load_program", "cache_key"]
+
+# Version of the generated code, change it with any change of the output
+VERSION = '2'
+
+
+# Names of the operators in the generated module
+_OPNAMES = {'+': '_add', '-': '_sub', '*': '_mul', '/': '_div', '^': '_pow', '&': '_cat',
+            '=': '_eq', '<>': '_ne', '<': '_lt', '>': '_gt', '<=': '_le', '>=': '_ge'}
+_UNNAMES = {'-': '_neg', '%': '_pct'}
+
+
+def _error(e: Exception) -> str:
+    """Excel error value of the exception, same as `XEvaluator.evaluate`."""
+    if isinstance(e, ZeroDivisionError):
+        return '#DIV/0!'
+    if isinstance(e, KeyError):
+        return '#NAME?'
+    return '#VALUE!'
+
+
+def _range(C: List, spec):
+    """Build the list of rows of a range: spec is (rows, cols, consts, nodes)."""
+    rows, cols, consts, nodes = spec
+    grid = [[None] * cols for _ in range(rows)]
+    for y, x, v in consts:
+        grid[y][x] = v
+    for y, x, i in nodes:
+        grid[y][x] = C[i]
+    return grid
+
+
+def _item(v, dx: int, dy: int):
+    """One cell of the result of a range formula."""
+    if isinstance(v, list):
+        row = v[dy] if dy < len(v) else []
+        return row[dx] if isinstance(row, list) and dx < len(row) else None
+    return v
+
+
+def _set(grid, y: int, x: int, v):
+    grid[y][x] = v
+    return grid
+
+
+# Runtime of the generated module
+RUNTIME = {'_error': _error, '_range': _range, '_item': _item, '_set': _set}
+RUNTIME.update({n: OPERATORS[op] for op, n in _OPNAMES.items()})
+RUNTIME.update({n: UNARY[op] for op, n in _UNNAMES.items()})
+
+
+class _Generator:
+    """ Translate the XFormula of one XProgram into Python source."""
+
+    def __init__(self, prog: XProgram):
+        self.prog = prog
+        self.graph = from_program(prog)
+        self.ids: Dict[int, int] = {}
+        for i, (_, _, fn) in enumerate(prog.formulas()):
+            self.ids[id(fn)] = i
+        # specs of all the ranges, referred as _RG[k]
+        self.ranges: List = []
+
+    # Values of cells, resolved at generation time
+
+    def _range_formula(self, sheet: str, x: int, y: int):
+        for (left, top), (right, bottom), fn in self.prog.sheetsRange.get(sheet, []):
+            if left <= x <= right and top <= y <= bottom:
+                return fn, x - left, y - top
+        return None, 0, 0
+
+    def cell(self, sheet: str, cell: str, depth: int = 0):
+        """ Return ('c', value) for a static value, ('n', expr) for a node."""
+        prog = self.prog
+        if depth > 64:
+            return 'c', None
+        if len(sheet) == 0:     # Alias
+            if cell in prog.sheetsRefer[""]:
+                return self.ref(prog.sheetsRefer[""][cell], depth + 1)
+            return 'c', prog.sheetsValue[""].get(cell)
+        fn = prog.sheetsExpr.get(sheet, {}).get(cell)
+        if fn is not None:
+            return 'n', self.ids[id(fn)]
+        if cell in prog.sheetsValue.get(sheet, {}):
+            return 'c', to_value(prog.sheetsValue[sheet][cell])
+        if cell in prog.sheetsRefer.get(sheet, {}):
+            return self.ref(prog.sheetsRefer[sheet][cell], depth + 1)
+        fn, dx, dy = self._range_formula(sheet, *Utils.name_to_pos(cell))
+        if fn is None:
+            return 'c', None
+        return 'e', f"_item(C[{self.ids[id(fn)]}], {dx}, {dy})"
+
+    def ref(self, ref, depth: int = 0):
+        sheet, cellrange = ref
+        if cellrange.find(':') < 0:
+            return self.cell(sheet, cellrange, depth)
+        rg = Utils.XRange(cellrange)
+        # populated cells only: the occupancy index, and the cells of the range formulas
+        index = self.prog.sheetsIndex.get(sheet)
+        cells = list(index.cells(rg)) if index is not None else []
+        seen = set(cells)
+        for (left, top), (right, bottom), _ in self.prog.sheetsRange.get(sheet, []):
+            for y in range(max(top, rg.top), min(bottom, rg.bottom) + 1):
+                for x in range(max(left, rg.left), min(right, rg.right) + 1):
+                    name = f"{Utils._COLUMNS[x]}{y}"
+                    if name not in seen:
+                        seen.add(name)
+                        cells.append(name)
+        consts, nodes, exprs = [], [], []
+        for name in cells:
+            x, y = Utils.name_to_pos(name)
+            k, v = self.cell(sheet, name, depth)
+            if k == 'n':
+                nodes.append((y - rg.top, x - rg.left, v))
+            elif k == 'e':
+                exprs.append((y - rg.top, x - rg.left, v))
+            elif v is not None:
+                consts.append((y - rg.top, x - rg.left, v))
+        self.ranges.append((rg.bottom - rg.top + 1, rg.right - rg.left + 1,
+                            tuple(consts), tuple(nodes)))
+        expr = f"_range(C, _RG[{len(self.ranges) - 1}])"
+        for y, x, v in exprs:
+            expr = f"_set({expr}, {y}, {x}, {v})"
+        return 'e', expr
+
+    def operand(self, fn: XFormula, a) -> str:
+        if not isinstance(a, str):
+            return repr(a)
+        k = a[0]
+        if k == '@':
+            return f"s{a[1:]}"
+        if k == '#':
+            return repr(fn.values[int(a[1:])])
+        if k == '$':
+            kind, v = self.ref(as_ref(fn.sheet, fn.params[int(a[1:])]))
+            if kind == 'n':
+                return f"C[{v}]"
+            return v if kind == 'e' else repr(v)
+        return repr(a)
+
+    # Instructions
+
+    def block(self, fn: XFormula, lo: int, hi: int, indent: str, out: List[str]):
+        """ Emit the instructions [lo, hi) of `fn`."""
+        syntax = fn.syntax
+        pc = lo
+        while pc < hi:
+            ins = syntax[pc]
+            op = ins[1]
+            if op == 'BR':
+                f = ins[4]
+                out.append(f"{indent}s{pc} = bool({self.operand(fn, ins[2])})")
+                out.append(f"{indent}if s{pc}:")
+                out.append(f"{indent}    pass")
+                if syntax[f][1] == 'LB' and syntax[f][3] == 'false':
+                    end = syntax[f - 1][2]
+                    self.block(fn, pc + 2, f - 1, indent + '    ', out)
+                    out.append(f"{indent}else:")
+                    out.append(f"{indent}    pass")
+                    self.block(fn, f + 1, end, indent + '    ', out)
+                else:
+                    end = f
+                    self.block(fn, pc + 2, f, indent + '    ', out)
+                pc = end + 1
+                continue
+            if op in ('LB', 'JP'):
+                pass
+            elif op == 'PHI':
+                out.append(f"{indent}s{pc} = {self.operand(fn, ins[3])} if {ins[2].replace('@', 's')} "
+                           f"else {self.operand(fn, ins[4])}")
+            elif op == 'IF':
+                out.append(f"{indent}s{pc} = {self.operand(fn, ins[3])} if {self.operand(fn, ins[2])} "
+                           f"else {self.operand(fn, ins[4])}")
+            elif isinstance(ins[2], list):      # function
+                args = ', '.join(self.operand(fn, a) for a in ins[2]) if ins[2] != [None] else ''
+                out.append(f"{indent}s{pc} = F[{op.upper()!r}]({args})")
+            elif len(ins) == 3:
+                out.append(f"{indent}s{pc} = {_UNNAMES[op]}({self.operand(fn, ins[2])})")
+            else:
+                out.append(f"{indent}s{pc} = {_OPNAMES[op]}({self.operand(fn, ins[2])}, "
+                           f"{self.operand(fn, ins[3])})")
+            pc += 1
+
+    def node(self, fn: XFormula, out: List[str]):
+        i = self.ids[id(fn)]
+        if len(fn.syntax) == 0:
+            out.append(f"    C[{i}] = None")
+            return
+        out.append(f"    # {fn.ln}: {fn.txt}" if fn.txt else f"    # {fn.ln}")
+        out.append("    try:")
+        self.block(fn, 0, len(fn.syntax), '        ', out)
+        out.append(f"        C[{i}] = s{len(fn.syntax) - 1}")
+        out.append("    except Exception as e:")
+        out.append(f"        C[{i}] = _error(e)")
+
+    def module(self) -> str:
+        g = self.graph
+        order, levels = g.toposort()
+        fns = [fn for _, _, fn in self.prog.formulas()]
+        out = ["# Generated by spd.CodeGen, do not edit", ""]
+        names = []
+        for lv in range(int(levels.max()) + 1 if len(levels) else 0):
+            names.append(f"level_{lv}")
+            out.append(f"def level_{lv}(C, F):")
+            for i in order[levels[order] == lv]:
+                self.node(fns[i], out)
+            out.append("")
+        # egress DAGs as node ids in topological order
+        t = g.transpose()
+        dags = {}
+        for fn in self.prog.egressCells:
+            me = self.ids[id(fn)]
+            depth = t.bfs([me])
+            dags[fn.ln] = [int(i) for i in order if depth[i] >= 0]
+        out.append(f"N = {g.nodes}")
+        out.append(f"CELLS = {[str(c) for c in g.cells]!r}")
+        out.append(f"LINES = {[int(x) for x in g.lines]!r}")
+        out.append(f"EGRESS = {({fn.ln: self.ids[id(fn)] for fn in self.prog.egressCells})!r}")
+        out.append(f"DAGS = {dags!r}")
+        out.append(f"LOOPS = {[int(i) for i in range(g.nodes) if levels[i] < 0]!r}")
+        out.append(f"LEVELS = [{', '.join(names)}]")
+        out.append(f"_RG = {self.ranges!r}")
+        out.append("")
+        out.append("")
+        out.append("def calculate(C=None, F=None):")
+        out.append("    C = [None] * N if C is None else C")
+        out.append("    F = FUNCS if F is None else F")
+        out.append("    for level in LEVELS:")
+        out.append("        level(C, F)")
+        out.append("    return {ln: C[i] for ln, i in EGRESS.items()}")
+        return '\n'.join(out) + '\n'
+
+
+def generate(prog: XProgram) -> str:
+    """ Python source of the module for `prog`."""
+    return _Generator(prog).module()
+
+
+def _new_module(name: str, code, funcs: Dict[str, Callable] = None) -> types.ModuleType:
+    mod = types.ModuleType(name)
+    mod.__dict__.update(RUNTIME)
+    mod.FUNCS = dict(FUNCS)
+    if funcs:
+        mod.FUNCS.update(funcs)
+    exec(code, mod.__dict__)
+    return mod
+
+
+def load_program(prog: XProgram, funcs: Dict[str, Callable] = None) -> types.ModuleType:
+    """ Generate and load the module of `prog` without any cache."""
+    code = compile(generate(prog), '<spd>', 'exec')
+    return _new_module('spd_workbook', code, funcs)
+
+
+def _pyc_path(path: str) -> str:
+    return path + '.pyc'
+
+
+def cache_key(data: bytes, funcs: Dict[str, Callable] = None) -> bytes:
+    """ PEP 552 source hash of the workbook text, the generator version and the
+    names of all the functions, a change of any of them makes a new module.
+    """
+    names = sorted(set(FUNCS) | set(funcs or ()))
+    return importlib.util.source_hash(b'\0'.join([data, VERSION.encode(), ','.join(names).encode()]))
+
+
+def load(path: str, funcs: Dict[str, Callable] = None, cache: bool = True) -> types.ModuleType:
+    """ Load the module of the workbook text `path`.
+    The code object is cached as `<path>.pyc`, a hash-based pyc keyed by `cache_key`.
+    """
+    with open(path, 'rb') as f:
+        data = f.read()
+    digest = cache_key(data, funcs)
+    pyc = _pyc_path(path)
+    name = os.path.splitext(os.path.basename(path))[0]
+    magic = importlib.util.MAGIC_NUMBER
+    if cache and os.path.exists(pyc):
+        with open(pyc, 'rb') as f:
+            head = f.read(16)
+            if head[:4] == magic and head[8:16] == digest:
+                return _new_module(name, marshal.loads(f.read()), funcs)
+
+    prog = Compiler.load_lines(data.decode('utf-8').splitlines(), keep_txt=False)
+    code = compile(generate(prog), path, 'exec')
+    if cache:
+        # PEP 552 header: flags=0b01 hash-based without check_source, then the 8 bytes hash
+        tmp = f"{pyc}.{os.getpid()}"
+        with open(tmp, 'wb') as f:
+            f.write(magic + (1).to_bytes(4, 'little') + digest + marshal.dumps(code))
+        os.replace(tmp, pyc)
+    return _new_module(name, code, funcs)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print(f"Usage: {sys.argv[0]} <formula-file>")
+        exit(-1)
+    with open(sys.argv[1], 'r', encoding='utf-8') as f:
+        print(generate(Compiler.load_lines(f)))
+
+# vim: noai:ts=4:sw=4:expandtab
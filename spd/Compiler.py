@@ -3,15 +3,16 @@
 
 """Excel Expression parser with SLY."""
 
+import math
 import re
 import sys
+from typing import Iterable, List, NamedTuple, Tuple
 
 from sly import Lexer, Parser
 
-from .Formula import XFormula
-
-# set encoding='utf-8' for consoole
-sys.stdout.reconfigure(encoding='utf-8')
+from . import Engine
+from .Formula import XFormula, as_ref, branch_params
+from .PseudoCode import XProgram
 
 
 class FormulaLexer(Lexer):
@@ -51,13 +52,16 @@ class FormulaLexer(Lexer):
     OP_CMP = r'<>|<=|>=|>|<|='
     OP_MULDIV = r'\*|/'
 
-    IF = r'IF\>'
+    IF = r'IF(?=\s*\()'
 
     NAME = r'[\w_]+'
 
+    def __init__(self):
+        # Illegal characters of the current line as List[Tuple[index:int, char:str]]
+        self.errors: List[Tuple[int, str]] = []
+
     def error(self, t):
-        print(
-            f'Illegal character {t.value[0]!r} at index {self.index}', t.value, self.index)
+        self.errors.append((self.index, t.value[0]))
         self.index += 1
 
 
@@ -90,18 +94,21 @@ class FormulaParser(Parser):
         self.syntax = []
         self.params = []
         self.values = []
+        # the slot of the whole expression, e.g. `@3`, `$0`, `#0`
+        self.result = None
+        # Syntax errors of the current line as List[str]
+        self.errors: List[str] = []
 
     # Assignment is the entry point
 
     @_('reference AS expr')
     def assignment(self, p):
-        print(f"=={self.lineno:06d}==",  p.reference, ":=", p.expr)
+        self.result = p.expr
 
     @_('NAME AS reference')
     def assignment(self, p):
         self.refer = p.NAME
         self.target = p.reference
-        print(f"=={self.lineno:06d}==", self.refer, "@=", self.target)
 
     # Reference
 
@@ -135,70 +142,65 @@ class FormulaParser(Parser):
         return f"${len(self.params)-1}"
 
     # IF Function
+    # A group of pseudo instruments are define to help the branch, only the taken
+    # branch is evaluated:
+    #   (idx, 'BR', cond, true, false)  - llvm IR `br`, jump to `true` or `false` by testing cond
+    #   (idx, 'LB', br, 'true|false|end') - Label of the branch *br*
+    #   (idx, 'JP', end)                - Jump to the end label
+    #   (idx, 'PHI', '@br', a, b)       - llvm IR `phi`, `a` if the branch *br* was true else `b`
+    # If neither branch has any instrument, it's a simple select:
+    #   (idx, 'IF', cond, a, b)
+    # An empty argument is None, same as in the params of a function.
+
+    @_('')
+    def _iftest(self, p):
+        # this is the right place for if
+        idx = len(self.syntax)
+        self.syntax.append(None)    # BR
+        self.syntax.append(None)    # Label%true
+        return idx
 
-    # @_(',')
-    # def _iftest(self, p):
-    #    # this is the right place for if
-    #    idx = len(self.syntax)
-    #    self.syntax.append(None)    # BR
-    #    self.syntax.append(None)    # Label%true
-    #    return idx
-
-    # @_('')
-    # def _ifelse(self, p):
-    #    idx = len(self.syntax)
-    #    self.syntax.append(None)    # BR end
-    #    self.syntax.append(None)    # Label%false
-    #    return idx
-
-    # @_('')
-    # def _ifend(self, p):
-    #    idx = len(self.syntax)
-    #    self.syntax.append(None)    # Label%end
-    #    self.syntax.append(None)    # phi
-    #    return idx
-
-    @_('IF "(" expr "," expr "," expr ")"')
-    def factor(eelf, p):
-        # if p.expr1[0] != '@' and p.expr2[0] != '@':   # two values
-        #    self.syntax[p._iftest] = (idx, 'IF', p.expr0, p.expr1, p.expr2)
-        #    return f"@{idx}"
+    @_('')
+    def _ifelse(self, p):
+        idx = len(self.syntax)
+        self.syntax.append(None)    # JP end
+        self.syntax.append(None)    # Label%false
+        return idx
+
+    def _ifselect(self, br: int, cond, a, b):
+        """Replace the placeholders of the branch by one select."""
+        del self.syntax[br:]
+        self.syntax.append((br, 'IF', cond, a, b))
+        return f"@{br}"
+
+    @_('IF "(" param "," _iftest param "," _ifelse param ")"')
+    def factor(self, p):
+        br, el = p._iftest, p._ifelse
+        if len(self.syntax) == br + 4:      # two values
+            return self._ifselect(br, p.param0, p.param1, p.param2)
         # IF and ELSE
-        #self.syntax[p._iftest]   = ('BR', idx, p.expr0)
-        #self.syntax[p._iftest+1] = ('LB', idx, 'true')
-        #self.syntax[p._ifelse]   = ('JP', idx)
-        #self.syntax[p._ifelse+1] = ('LB', idx, 'false')
-        #self.syntax[p._ifend]    = ('LB', idx, 'end')
-        #self.syntax[p._ifend+1]  = ('PHI', idx, p.expr1, p.expr2)
-        return f"@{idx} {p.expr0}?{p.expr1}:{p.expr2}"
-
-    @_('IF "(" expr "," expr ")"')
+        end = len(self.syntax)
+        self.syntax[br] = (br, 'BR', p.param0, br + 1, el + 1)
+        self.syntax[br + 1] = (br + 1, 'LB', br, 'true')
+        self.syntax[el] = (el, 'JP', end)
+        self.syntax[el + 1] = (el + 1, 'LB', br, 'false')
+        self.syntax.append((end, 'LB', br, 'end'))
+        self.syntax.append((end + 1, 'PHI', f"@{br}", p.param1, p.param2))
+        return f"@{end + 1}"
+
+    @_('IF "(" param "," _iftest param ")"')
     def factor(self, p):
-        ''' A group of pseudo instruments are define to help the branch
-        BR - llvm IR `br` of *idx* by testing p.expr0
-        LB - Label of *idx* for `true|false|end`
-        JP - Jump to the end label of *idx* 
-        PHI - llvm IR `phi` of *idx*
-        '''
-        #print("IF/ELSE: ", p.expr0, p.expr1, p.expr2)
-        # return ('?', p.expr0, p.expr1, p.expr2)
+        br = p._iftest
         # only has TRUE expression
-        # if p.expr1[0] != '@':   # value
-        #    idx = p._iftest
-        #    del self.syntax[p._ifend]
-        #    del self.syntax[p._ifend]
-        #    del self.syntax[p._iftest]
-        #    self.syntax[p._iftest] = (idx, 'IF', p.expr0, p.expr1, False)
-        #    return f"@{idx}"
+        if len(self.syntax) == br + 2:      # value
+            return self._ifselect(br, p.param0, p.param1, False)
         # expression of True
-        #idx = p._ifend
-        #self.syntax[p._iftest]   = ('BR', idx, p.expr0)
-        #self.syntax[p._iftest+1] = ('LB', idx, 'true')
-        #self.syntax[p._ifend]    = ('JP', idx)
-        #self.syntax[p._ifend+1]  = ('LB', idx, 'false')
-        #self.syntax.append( ('LB', idx, 'end') )
-        #self.syntax.append( ('PHI', idx, p.expr1, False) )
-        return f"@{idx} {p.expr0}?{p.expr1}:False"
+        end = len(self.syntax)
+        self.syntax[br] = (br, 'BR', p.param0, br + 1, end)
+        self.syntax[br + 1] = (br + 1, 'LB', br, 'true')
+        self.syntax.append((end, 'LB', br, 'end'))
+        self.syntax.append((end + 1, 'PHI', f"@{br}", p.param1, False))
+        return f"@{end + 1}"
 
     # Factors
 
@@ -243,7 +245,10 @@ class FormulaParser(Parser):
     def factor(self, p):
         #print("NUM: ", p.NUMBER)
         # return p.NUMBER
-        self.values.append(p.NUMBER)
+        try:
+            self.values.append(int(p.NUMBER))
+        except ValueError:
+            self.values.append(float(p.NUMBER))
         return f"#{len(self.values)-1}"
 
 #    @_('NAME "(" ")"')
@@ -275,6 +280,9 @@ class FormulaParser(Parser):
     def factor(self, p):
         #print("NAME: ", p.NAME)
         # return ('VAR', p.NAME)
+        if p.NAME.upper() in ('TRUE', 'FALSE'):
+            self.values.append(p.NAME.upper() == 'TRUE')
+            return f"#{len(self.values)-1}"
         self.params.append(('', p.NAME))
         return f"${len(self.params)-1}"
 
@@ -335,12 +343,12 @@ class FormulaParser(Parser):
 
     def error(self, token):
         '''
-        Default error handling function.  This may be subclassed.
+        Record the syntax error, the line is dropped by `parse_line`.
         '''
-        sys.stderr.write(
-            f'sly: Syntax error at line {self.lineno:06d}, token={token.type}\n')
-        # Read ahead looking for a terminating ";"
-        # return token
+        if token is None:
+            self.errors.append("unexpected end of line")
+        else:
+            self.errors.append(f"unexpected {token.type} {token.value!r} at index {token.index}")
 
     def as_formula(self) -> XFormula:
         '''
@@ -349,11 +357,159 @@ class FormulaParser(Parser):
         fma = XFormula(self.sheet, self.syntax, self.params,
                          self.values, self.lineno, self.txt)
         fma.targets.append(self.target)
+        fma.conds = branch_params(self.syntax)
         self.__init__()
         return fma
 
 
+# Kinds of line returned by `parse_line`
+LN_ALIAS = 'ALIAS'
+LN_REFER = 'REFER'
+LN_VALUE = 'VALUE'
+LN_FORMULA = 'FORMULA'
+
+# Levels of XDiagnostic
+D_ERROR = 'error'
+D_WARNING = 'warning'
+
+
+class XDiagnostic(NamedTuple):
+    """ One problem found while compiling, `txt` is the source line."""
+    ln: int
+    level: str
+    message: str
+    txt: str
+
+
+def parse_line(lexer: FormulaLexer, parser: FormulaParser, line: str, ln: int = 0,
+               keep_txt: bool = True, diags: List[XDiagnostic] = None):
+    """ Parse one line and classify it as Tuple[kind, sheet, tgt, item]:
+      (LN_ALIAS, '', NAME, (sheet, cellrange))    -- `NAME @= 'Sheet'!A1:B2`
+      (LN_REFER, sheet, cell, (sheet, cellrange)) -- `'Sheet'!A1 @= 'Other'!B1`
+      (LN_VALUE, sheet, cell, value:str)          -- `'Sheet'!A1 @= 1.5`
+      (LN_FORMULA, sheet, cellrange, XFormula)    -- anything else
+    Return None if the line can't be parsed, the reason is appended to `diags`.
+    Illegal characters are skipped with a warning.
+    """
+    lexer.errors.clear()
+    parser.lineno = ln
+    parser.txt = line if keep_txt else None
+    parser.parse(lexer.tokenize(line))
+    if diags is not None:
+        for index, char in lexer.errors:
+            diags.append(XDiagnostic(ln, D_WARNING, f"illegal character {char!r} at index {index}", line))
+        for msg in parser.errors:
+            diags.append(XDiagnostic(ln, D_ERROR, f"syntax error: {msg}", line))
+    if parser.errors:
+        rtn = None
+    elif parser.refer:
+        sheet, c0, c1 = parser.target
+        rtn = (LN_ALIAS, '', parser.refer, as_ref(sheet, (sheet, c0, c1)))
+    elif parser.result is None or not parser.sheet:
+        if diags is not None:
+            diags.append(XDiagnostic(ln, D_ERROR, "not an assignment to a cell", line))
+        rtn = None
+    else:
+        tgt = parser.target
+        tgt = f"{tgt[0]}:{tgt[1]}" if isinstance(tgt, tuple) else tgt
+        sheet, tgt = parser.sheet, tgt.replace('$', '')
+        if len(parser.syntax) == 0 and parser.result[0] == '$':
+            rtn = (LN_REFER, sheet, tgt, as_ref(sheet, parser.params[0]))
+        elif len(parser.syntax) == 0 and parser.result[0] == '#':
+            rtn = (LN_VALUE, sheet, tgt, parser.values[0])
+        else:
+            return (LN_FORMULA, sheet, tgt, parser.as_formula())
+    parser.__init__()
+    return rtn
+
+
+def compile_lines(lines: Iterable[str], prog: XProgram = None,
+                  keep_txt: bool = False, start: int = 1) -> Tuple[XProgram, List[XDiagnostic]]:
+    """ Compile the lines of the text (as printed by `pxlsx.py`) into a XProgram.
+    Empty lines and lines start with `//` are ignored, bad lines are skipped and
+    reported in the returned List[XDiagnostic]; nothing is printed.
+    `keep_txt` keeps the source line in `XFormula.txt`, it costs memory.
+    `start` is the line number of the first line, line numbers must be unique
+    when more lines are added into an existing program.
+    """
+    if prog is None:
+        prog = XProgram()
+    diags: List[XDiagnostic] = []
+    lexer, parser = FormulaLexer(), FormulaParser()
+    ln = start - 1
+    for line in lines:
+        ln += 1
+        line = line.strip()
+        if len(line) == 0 or line.startswith('//'):
+            continue
+        try:
+            parsed = parse_line(lexer, parser, line, ln, keep_txt, diags)
+            if parsed is None:
+                continue
+            kind, sheet, tgt, item = parsed
+            if kind == LN_FORMULA:
+                Engine.evaluate_funcs(item, line)
+                prog.add_formula(item, tgt, sheet)
+            elif kind == LN_VALUE:
+                prog.add_value(item, tgt, sheet)
+            else:
+                prog.add_refer(item, tgt, sheet)
+        except Exception as e:
+            parser.__init__()
+            diags.append(XDiagnostic(ln, D_ERROR, f"{type(e).__name__}: {e}", line))
+    return prog, diags
+
+
+def workbook_lines(path: str) -> Iterable[str]:
+    """ Lines of the workbook: cells of a `.xlsx` file as `pxlsx.py` prints them
+    (needs openpyxl), or any other file as text.
+    """
+    if not path.lower().endswith(('.xlsx', '.xlsm')):
+        with open(path, 'r', encoding='utf-8') as f:
+            yield from f
+        return
+    import openpyxl
+    wb = openpyxl.load_workbook(filename=path)
+    for n in wb.defined_names.localnames(None):
+        ref = wb.defined_names[n].attr_text
+        if ref.find('!') > 0 and ref[0] != "'":
+            ref = "'{}'!{}".format(*ref.split('!', 1))
+        yield f"{n} @= {ref}"
+    for s in wb:
+        for col in s.columns:
+            for c in col:
+                v = c.value
+                if v is None or v == '':
+                    continue
+                if isinstance(v, str) and len(v) > 1 and v[0] == '=':
+                    yield f"'{c.parent.title}'!{c.coordinate} @{v}"
+                else:
+                    yield f"'{c.parent.title}'!{c.coordinate} @={literal(v)}"
+
+
+def literal(v) -> str:
+    """ Constant as the lexer reads it: TRUE/FALSE, a number, or a quoted string."""
+    if isinstance(v, bool):
+        return 'TRUE' if v else 'FALSE'
+    if isinstance(v, (int, float)) and math.isfinite(v):
+        return repr(v).upper().replace('E+', 'E')
+    return '"' + str(v).replace('"', '""') + '"'
+
+
+def compile_workbook(path: str, keep_txt: bool = False) -> Tuple[XProgram, List[XDiagnostic]]:
+    """ Compile the workbook file, see `compile_lines` and `workbook_lines`."""
+    return compile_lines(workbook_lines(path), keep_txt=keep_txt)
+
+
+def load_lines(lines, prog: XProgram = None, keep_txt: bool = True) -> XProgram:
+    """ Same as `compile_lines`, but only the XProgram is returned."""
+    return compile_lines(lines, prog, keep_txt)[0]
+
+
 if __name__ == '__main__':
+    # set encoding='utf-8' for consoole
+    sys.stdout.reconfigure(encoding='utf-8')
+
     lexer = FormulaLexer()
     parser = FormulaParser()
 
@@ -370,20 +526,11 @@ if __name__ == '__main__':
             parser.__init__()
 
     try:
-        ln = 0
-        with open(sys.argv[1], 'r', encoding='utf-8') as f:
-            for line in f:
-                ln += 1
-                line = line.strip()
-                if len(line) == 0 or line.startswith('//'):
-                    continue
-                print(f"[{ln:06d}] {line}")
-                parser.lineno = ln
-                parser.txt = line
-                # Parse
-                parser.parse(lexer.tokenize(line))
-                fma = parser.as_formula()
-                print(fma)
+        prog, diags = compile_workbook(sys.argv[1], keep_txt=True)
+        for sheet, tgt, fma in prog.formulas():
+            print(f"[{fma.ln:06d}] '{sheet}'!{tgt}", fma)
+        for d in diags:
+            sys.stderr.write(f"{d.ln:06d}: {d.level}: {d.message}: {d.txt}\n")
     except OSError:
         # 'File not found' error message.
         print("File not found!")
@@ -0,0 +1,219 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""Output path of the egress cells (`Engine.xlsEgressFuncs`).
+
+Writes are queued per destination, the first constant argument of `RTC`/`OUTPUT`:
+- a write to an egress cell already queued replaces the queued value (coalescing);
+- the queue of a destination is sent as one batch when its oldest write is
+  `window` seconds old or it has `max_batch` writes;
+- at most `max_pending` writes are queued, a writer waits for the flusher thread
+  which slows down the evaluator.
+Without the flusher thread (`start`) the writer sends the due batches by itself.
+Sinks only need `send(dest, batch)` and `close()`.
+"""
+
+import json
+import socket
+import threading
+import time
+from typing import Callable, Dict, List, Tuple
+
+from .Engine import xlsEgressFuncs
+from .Formula import XFormula
+from .PseudoCode import XProgram
+
+__all__ = ["destination", "XEgress", "XListSink", "XFileSink", "XSocketSink"]
+
+
+def destination(fn: XFormula) -> str:
+    """ The constant first argument of the egress function, '' if there's none."""
+    for ins in fn.syntax:
+        if isinstance(ins[2], list) and ins[1].upper() in xlsEgressFuncs:
+            a = ins[2][0]
+            if isinstance(a, str) and a[0] == '#':
+                return str(fn.values[int(a[1:])])
+            return ''
+    return ''
+
+
+def _encode(dest: str, batch: List[Tuple[int, object]]) -> bytes:
+    return (json.dumps({'dest': dest, 'writes': batch}, default=str) + '\n').encode('utf-8')
+
+
+class XListSink:
+    """ Keep all the batches in memory as List[Tuple[dest:str, batch:List]]."""
+
+    def __init__(self) -> None:
+        self.batches: List[Tuple[str, List[Tuple[int, object]]]] = []
+
+    def send(self, dest: str, batch: List[Tuple[int, object]]):
+        self.batches.append((dest, batch))
+
+    def close(self):
+        pass
+
+
+class XFileSink:
+    """ Append every batch as one JSON line: {"dest": ..., "writes": [[ln, value], ...]}."""
+
+    def __init__(self, path: str) -> None:
+        self.f = open(path, 'ab')
+
+    def send(self, dest: str, batch: List[Tuple[int, object]]):
+        self.f.write(_encode(dest, batch))
+        self.f.flush()
+
+    def close(self):
+        self.f.close()
+
+
+class XSocketSink:
+    """ Same JSON lines as XFileSink over a connected socket, or a (host, port) to connect."""
+
+    def __init__(self, sock) -> None:
+        self.sock = sock if isinstance(sock, socket.socket) else socket.create_connection(sock)
+
+    def send(self, dest: str, batch: List[Tuple[int, object]]):
+        self.sock.sendall(_encode(dest, batch))
+
+    def close(self):
+        self.sock.close()
+
+
+class XEgress:
+    """ Coalescing and batching queue between the evaluator and the sinks.
+
+    sinks  -- {dest: sink}, the sink of '' takes the destinations not listed
+    dests  -- {egress ln: dest}, see `from_program`
+    window  -- seconds a write may wait for more writes of the same destination
+    max_batch  -- writes of one destination sent at once
+    max_pending  -- writes queued before `write` blocks
+    """
+
+    def __init__(self, sinks: Dict[str, object], dests: Dict[int, str] = None,
+                 window: float = 0.005, max_batch: int = 256, max_pending: int = 4096,
+                 clock: Callable[[], float] = time.monotonic) -> None:
+        self.sinks = sinks
+        self.dests: Dict[int, str] = dests or {}
+        self.window: float = window
+        self.max_batch: int = max_batch
+        self.max_pending: int = max_pending
+        self.clock = clock
+        # dest => {ln: value} in the order of the first write, and its oldest time
+        self._queues: Dict[str, Dict[int, object]] = {}
+        self._since: Dict[str, float] = {}
+        self._pending: int = 0
+        self._cond = threading.Condition()
+        # keep the batches of one destination in order
+        self._sending = threading.Lock()
+        self._thread: threading.Thread = None
+        self._stop: bool = False
+        self.stats: Dict[str, float] = {'writes': 0, 'coalesced': 0, 'batches': 0,
+                                        'sent': 0, 'blocked': 0, 'blocked_time': 0.0}
+
+    @staticmethod
+    def from_program(prog: XProgram, sinks: Dict[str, object], **kwargs):
+        """ XEgress with the destinations of all the egress cells of `prog`."""
+        return XEgress(sinks, {fn.ln: destination(fn) for fn in prog.egressCells}, **kwargs)
+
+    def write(self, ln: int, value):
+        """ Queue the value of the egress cell `ln`, same as `Replay.XSink.write`."""
+        self.put(ln, value, self.dests.get(ln, ''))
+
+    def put(self, ln: int, value, dest: str = ''):
+        with self._cond:
+            self.stats['writes'] += 1
+            queue = self._queues.setdefault(dest, {})
+            if ln in queue:
+                queue[ln] = value
+                self.stats['coalesced'] += 1
+                return
+            if self._pending >= self.max_pending and self._thread is not None:
+                self.stats['blocked'] += 1
+                t = time.perf_counter()
+                self._cond.notify_all()
+                while self._pending >= self.max_pending and not self._stop:
+                    self._cond.wait()
+                self.stats['blocked_time'] += time.perf_counter() - t
+                if ln in queue:     # written by another thread meanwhile
+                    queue[ln] = value
+                    self.stats['coalesced'] += 1
+                    return
+            if len(queue) == 0:
+                self._since[dest] = self.clock()
+            queue[ln] = value
+            self._pending += 1
+            full = len(queue) >= self.max_batch or self._pending >= self.max_pending
+            due = full or self.clock() - self._since[dest] >= self.window
+            if self._thread is not None:
+                if full:
+                    self._cond.notify_all()
+                return
+            blocked = self._pending >= self.max_pending
+        if due:
+            t = time.perf_counter()
+            self.flush()
+            if blocked:
+                self.stats['blocked'] += 1
+                self.stats['blocked_time'] += time.perf_counter() - t
+
+    def _due(self, force: bool) -> List[Tuple[str, List[Tuple[int, object]]]]:
+        """ Take the batches to send out of the queues, under `self._cond`."""
+        now, batches = self.clock(), []
+        force = force or self._pending >= self.max_pending
+        for dest, queue in self._queues.items():
+            if not queue:
+                continue
+            if force or len(queue) >= self.max_batch or now - self._since[dest] >= self.window:
+                items = list(queue.items())
+                for i in range(0, len(items), self.max_batch):
+                    batches.append((dest, items[i:i + self.max_batch]))
+                self._pending -= len(queue)
+                queue.clear()
+        if batches:
+            self._cond.notify_all()
+        return batches
+
+    def flush(self, force: bool = False) -> int:
+        """ Send the batches which are due, or all of them; return the number of batches."""
+        with self._sending:
+            with self._cond:
+                batches = self._due(force)
+            for dest, batch in batches:
+                sink = self.sinks.get(dest, self.sinks.get(''))
+                if sink is not None:
+                    sink.send(dest, batch)
+                self.stats['sent'] += len(batch)
+            self.stats['batches'] += len(batches)
+        return len(batches)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                if self._stop:
+                    break
+                self._cond.wait(self.window)
+            self.flush()
+
+    def start(self) -> 'XEgress':
+        """ Flush from a background thread."""
+        if self._thread is None:
+            self._stop = False
+            self._thread = threading.Thread(target=self._run, name='egress', daemon=True)
+            self._thread.start()
+        return self
+
+    def close(self):
+        """ Stop the thread, send everything left and close the sinks."""
+        if self._thread is not None:
+            with self._cond:
+                self._stop = True
+                self._cond.notify_all()
+            self._thread.join()
+            self._thread = None
+        self.flush(force=True)
+        for sink in {id(s): s for s in self.sinks.values()}.values():
+            sink.close()
+
+# vim: noai:ts=4:sw=4:expandtab
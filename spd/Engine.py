@@ -1,9 +1,9 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
-from typing import List  # Dict, Tuple, Union, ClassVar
+from typing import Dict, List  # Tuple, Union, ClassVar
 
-from Formula import XFormula
+from .Formula import XFormula
 # import EEISyntax
 # import EEIUtils
 
@@ -19,6 +19,8 @@ it defines all the supported functions!
 xlsFuncs: List[str] = []
 xlsActiveFuncs: List[str] = ['RTGET', 'TR', 'TODAY', 'NOW']
 xlsEgressFuncs: List[str] = ['RTC', 'OUTPUT']
+# Recalc priority of the egress functions, lower goes first
+xlsEgressPriority: Dict[str, int] = {'RTC': 0, 'OUTPUT': 10}
 
 
 def load(yaml: str):
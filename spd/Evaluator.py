@@ -0,0 +1,311 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""Scalar interpreter of `XFormula.syntax`.
+
+Every instruction is `(idx, OP, operands...)` and writes slot `@idx`;
+operands are `@n` slot, `$n` param, `#n` value, None (empty param) or a literal.
+Branch instructions BR/LB/JP/PHI are described in `Compiler.FormulaParser`,
+only the taken side of a branch is executed.
+"""
+
+import datetime
+import math
+import operator
+from typing import Callable, Dict, List, Tuple
+
+from . import Utils
+from .Formula import XFormula, as_ref
+from .PseudoCode import XProgram
+
+__all__ = ["FUNCS", "OPERATORS", "XEvaluator"]
+
+
+def to_value(v):
+    """Convert the raw string from the parser/sheets to int/float if possible."""
+    if not isinstance(v, str):
+        return v
+    try:
+        return int(v)
+    except ValueError:
+        pass
+    try:
+        return float(v)
+    except ValueError:
+        return v
+
+
+def _num(v):
+    if v is None:
+        return 0
+    if isinstance(v, str):
+        v = to_value(v)
+        if isinstance(v, str):
+            raise ValueError(v)
+    return v
+
+
+def _text(v) -> str:
+    if v is None:
+        return ''
+    if isinstance(v, bool):
+        return 'TRUE' if v else 'FALSE'
+    if isinstance(v, float) and v.is_integer():
+        return str(int(v))
+    return str(v)
+
+
+def _flat(args):
+    """Flatten all args and ranges (list of rows)."""
+    for a in args:
+        if isinstance(a, list):
+            for r in a:
+                yield from (r if isinstance(r, list) else [r])
+        else:
+            yield a
+
+
+def _numbers(args):
+    return [v for v in _flat(args) if isinstance(v, (int, float)) and not isinstance(v, bool)]
+
+
+def _serial(d: datetime.datetime) -> float:
+    """Excel serial number of the date time."""
+    delta = d - datetime.datetime(1899, 12, 30)
+    return delta.days + delta.seconds / 86400.0
+
+
+def _cmp(op):
+    def f(a, b):
+        if isinstance(a, str) and isinstance(b, str):
+            a, b = a.upper(), b.upper()
+        elif isinstance(a, str) != isinstance(b, str):
+            a, b = _num(a), _num(b)
+        return op(a, b)
+    return f
+
+
+OPERATORS: Dict[str, Callable] = {
+    '+': lambda a, b: _num(a) + _num(b),
+    '-': lambda a, b: _num(a) - _num(b),
+    '*': lambda a, b: _num(a) * _num(b),
+    '/': lambda a, b: _num(a) / _num(b),
+    '^': lambda a, b: _num(a) ** _num(b),
+    '&': lambda a, b: _text(a) + _text(b),
+    '=': _cmp(operator.eq),
+    '<>': _cmp(operator.ne),
+    '<': _cmp(operator.lt),
+    '>': _cmp(operator.gt),
+    '<=': _cmp(operator.le),
+    '>=': _cmp(operator.ge),
+}
+
+UNARY: Dict[str, Callable] = {
+    '-': lambda a: -_num(a),
+    '%': lambda a: _num(a) / 100,
+}
+
+FUNCS: Dict[str, Callable] = {
+    'SUM': lambda *a: sum(_numbers(a)),
+    'MIN': lambda *a: min(_numbers(a), default=0),
+    'MAX': lambda *a: max(_numbers(a), default=0),
+    'AVERAGE': lambda *a: sum(_numbers(a)) / len(_numbers(a)),
+    'COUNT': lambda *a: len(_numbers(a)),
+    'ABS': lambda a: abs(_num(a)),
+    'ROUND': lambda a, n=0: round(_num(a), int(_num(n))),
+    'INT': lambda a: math.floor(_num(a)),
+    'AND': lambda *a: all(_flat(a)),
+    'OR': lambda *a: any(_flat(a)),
+    'NOT': lambda a: not a,
+    'IF': lambda c, a=True, b=False: a if c else b,
+    'TODAY': lambda: float(math.floor(_serial(datetime.datetime.now()))),
+    'NOW': lambda: _serial(datetime.datetime.now()),
+    # Ingress, it should be provided by the feed
+    'RTGET': lambda *a: None,
+    'TR': lambda *a: None,
+    # Egress, the value to output is the last one
+    'RTC': lambda *a: a[-1] if a else None,
+    'OUTPUT': lambda *a: a[-1] if a else None,
+}
+
+
+class XEvaluator:
+    """ Demand driven evaluation of a XProgram.
+    Results of XFormula are cached by line number until `invalidate`.
+    """
+
+    def __init__(self, prog: XProgram, funcs: Dict[str, Callable] = None):
+        self.prog: XProgram = prog
+        self.funcs: Dict[str, Callable] = dict(FUNCS)
+        if funcs:
+            self.funcs.update(funcs)
+        # XFormula.ln => result
+        self.results: Dict[int, object] = {}
+        # XFormula.ln in evaluation, to break loops; ordered, outermost first
+        self._active: Dict[int, None] = {}
+        # Functions which receive range params as `Tuple[sheet:str, cellrange:str]`
+        self.byref: set = set()
+        # Called with the List[Tuple[sheet:str, cellrange:str]] changed, None for all
+        self.watchers: List[Callable] = []
+        # XFormula.ln => Tuple[sheet:str, cellrange:str], built on demand
+        self._targets: Dict[int, Tuple[str, str]] = {}
+        self.stats: Dict[str, int] = {'formulas': 0, 'instructions': 0, 'calls': 0}
+
+    # Cells
+
+    def _range_formula(self, sheet: str, x: int, y: int) -> Tuple[XFormula, int, int]:
+        for (left, top), (right, bottom), fn in self.prog.sheetsRange.get(sheet, []):
+            if left <= x <= right and top <= y <= bottom:
+                return fn, x - left, y - top
+        return None, 0, 0
+
+    def value(self, sheet: str, cell: str):
+        """ Value of one cell, formulas are evaluated on demand."""
+        if len(sheet) == 0:     # Alias
+            if cell in self.prog.sheetsRefer[""]:
+                return self.fetch(self.prog.sheetsRefer[""][cell])
+            return self.prog.sheetsValue[""].get(cell)
+        fn = self.prog.sheetsExpr.get(sheet, {}).get(cell)
+        if fn is not None:
+            return self.result(fn)
+        values = self.prog.sheetsValue.get(sheet, {})
+        if cell in values:
+            return to_value(values[cell])
+        refs = self.prog.sheetsRefer.get(sheet, {})
+        if cell in refs:
+            return self.fetch(refs[cell])
+        fn, dx, dy = self._range_formula(sheet, *Utils.name_to_pos(cell))
+        if fn is None:
+            return None
+        rtn = self.result(fn)
+        if isinstance(rtn, list):       # array result as list of rows
+            row = rtn[dy] if dy < len(rtn) else []
+            return row[dx] if isinstance(row, list) and dx < len(row) else None
+        return rtn
+
+    def fetch(self, ref: Tuple[str, str]):
+        """ Value of `Tuple[sheet:str, cellrange:str]`, a range is a list of rows."""
+        sheet, cellrange = ref
+        if cellrange.find(':') < 0:
+            return self.value(sheet, cellrange)
+        rg = Utils.XRange(cellrange)
+        return [[self.value(sheet, f"{Utils._COLUMNS[x]}{y}") for x in range(rg.left, rg.right + 1)]
+                for y in range(rg.top, rg.bottom + 1)]
+
+    def result(self, fn: XFormula):
+        """ Cached result of the XFormula."""
+        if fn.ln in self.results:
+            return self.results[fn.ln]
+        if fn.ln in self._active:      # circular reference
+            return None
+        self._active[fn.ln] = None
+        try:
+            rtn = self.evaluate(fn)
+        finally:
+            del self._active[fn.ln]
+        self.results[fn.ln] = rtn
+        return rtn
+
+    def invalidate(self, lines: List[int] = None):
+        """ Drop the cached results of `lines`, or all of them."""
+        if lines is None:
+            self.results.clear()
+            for w in self.watchers:
+                w(None)
+            return
+        for ln in lines:
+            self.results.pop(ln, None)
+        if self.watchers:
+            if not self._targets:
+                self._targets = {fn.ln: (sheet, tgt) for sheet, tgt, fn in self.prog.formulas()}
+            changed = [self._targets[ln] for ln in lines if ln in self._targets]
+            for w in self.watchers:
+                w(changed)
+
+    def changed(self, sheet: str, cellrange: str):
+        """ Tell the watchers that the static value of cells are changed."""
+        for w in self.watchers:
+            w([(sheet, cellrange)])
+
+    # Formula
+
+    def reference(self, fn: XFormula, slots: List, a):
+        """ Same as `operand`, but a range param is kept as `Tuple[sheet:str, cellrange:str]`."""
+        if isinstance(a, str) and a[0] == '$':
+            ref = as_ref(fn.sheet, fn.params[int(a[1:])])
+            if len(ref[0]) == 0 and ref[1] in self.prog.sheetsRefer[""]:   # Alias
+                ref = self.prog.sheetsRefer[""][ref[1]]
+            if ref[1].find(':') >= 0:
+                return ref
+        return self.operand(fn, slots, a)
+
+    def operand(self, fn: XFormula, slots: List, a):
+        if not isinstance(a, str):
+            return a
+        k = a[0]
+        if k == '@':
+            return slots[int(a[1:])]
+        if k == '$':
+            return self.fetch(as_ref(fn.sheet, fn.params[int(a[1:])]))
+        if k == '#':
+            return fn.values[int(a[1:])]
+        return a
+
+    def evaluate(self, fn: XFormula):
+        """ Run the syntax of `fn` and return the value of the last instruction.
+        Errors are returned as Excel error values.
+        """
+        self.stats['formulas'] += 1
+        try:
+            return self._run(fn)
+        except ZeroDivisionError:
+            return '#DIV/0!'
+        except (TypeError, ValueError, IndexError):
+            return '#VALUE!'
+        except KeyError:
+            return '#NAME?'
+
+    def _run(self, fn: XFormula):
+        syntax = fn.syntax
+        if len(syntax) == 0:
+            return None
+        slots = [None] * len(syntax)
+        pc, n = 0, len(syntax)
+        while pc < n:
+            ins = syntax[pc]
+            op = ins[1]
+            self.stats['instructions'] += 1
+            if op == 'BR':
+                slots[pc] = bool(self.operand(fn, slots, ins[2]))
+                pc = ins[3] if slots[pc] else ins[4]
+                continue
+            if op == 'JP':
+                pc = ins[2]
+                continue
+            if op == 'LB':
+                pass
+            elif op == 'PHI':
+                taken = slots[int(ins[2][1:])]
+                slots[pc] = self.operand(fn, slots, ins[3] if taken else ins[4])
+            elif op == 'IF':
+                taken = self.operand(fn, slots, ins[2])
+                slots[pc] = self.operand(fn, slots, ins[3] if taken else ins[4])
+            elif isinstance(ins[2], list):      # function
+                self.stats['calls'] += 1
+                name = op.upper()
+                get = self.reference if name in self.byref else self.operand
+                args = [get(fn, slots, a) for a in ins[2]] if ins[2] != [None] else []
+                slots[pc] = self.funcs[name](*args)
+            elif len(ins) == 3:
+                slots[pc] = UNARY[op](self.operand(fn, slots, ins[2]))
+            else:
+                slots[pc] = OPERATORS[op](self.operand(fn, slots, ins[2]),
+                                          self.operand(fn, slots, ins[3]))
+            pc += 1
+        return slots[-1]
+
+    def calculate(self) -> Dict[int, object]:
+        """ Evaluate all the egress cells, return {ln: value}."""
+        return {fn.ln: self.result(fn) for fn in self.prog.egressCells}
+
+# vim: noai:ts=4:sw=4:expandtab
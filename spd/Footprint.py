@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""Memory footprint of a compiled XProgram.
+
+`footprint` walks the program once and attributes every object to the first
+structure it's reached from, so shared objects (interned strings, formulas in
+the call flows) are counted once:
+  structures -- sheetsExpr, sheetsRange, ..., without the XFormula fields below
+  fields     -- txt, syntax, params, values, outputs, targets, conds of all XFormula
+  sheets     -- everything reached from the cells of one sheet
+`assert_budget` turns the report into a test: any entry over its budget fails.
+"""
+
+import sys
+import tracemalloc
+from typing import Callable, Dict, List, Tuple
+
+from .PseudoCode import XProgram
+from .Utils import sizeof
+
+__all__ = ["sizeof", "footprint", "flatten", "check_budget", "assert_budget", "traced"]
+
+# Fields of XFormula reported one by one
+FIELDS = ('txt', 'syntax', 'params', 'values', 'outputs', 'targets', 'conds')
+
+# Attributes of XProgram reported as structures
+STRUCTURES = ('sheetsExpr', 'sheetsRange', 'sheetsRefer', 'sheetsValue', 'sheetsIndex',
+              'constants', 'callflow', 'ingressCells', 'egressCells', 'referLoops', 'dataPrepares')
+
+
+def footprint(prog: XProgram) -> Dict:
+    """ Return {'total', 'formulas', 'per_formula', 'structures': {name: bytes},
+    'fields': {name: bytes}, 'sheets': {sheet: bytes}}.
+    """
+    seen: set = set()
+    fields = dict.fromkeys(FIELDS, 0)
+    sheets: Dict[str, int] = {}
+    formulas = 0
+
+    def formula(fn) -> int:
+        n = 0
+        for f in FIELDS:
+            b = sizeof(getattr(fn, f, None), seen)
+            fields[f] += b
+            n += b
+        return n
+
+    structures: Dict[str, int] = {}
+    # the constant pool is the `values` of every interned XFormula, it's counted
+    # once as a structure and not under the first formula reaching it
+    structures['constants'] = sizeof(getattr(prog, 'constants', None), seen)
+
+    # XFormula fields first, so they're not counted by the structures;
+    # a range formula is in sheetsExpr and sheetsRange, count it once
+    done: set = set()
+    for sheet, fns in [(s, c.values()) for s, c in prog.sheetsExpr.items()] + \
+            [(s, [r[2] for r in rs]) for s, rs in prog.sheetsRange.items()]:
+        for fn in fns:
+            if id(fn) in done:
+                continue
+            done.add(id(fn))
+            sheets[sheet] = sheets.get(sheet, 0) + formula(fn)
+            formulas += 1
+
+    for name in STRUCTURES:
+        if name in structures:
+            continue
+        attr = getattr(prog, name, None)
+        if isinstance(attr, dict) and name.startswith('sheets'):
+            n = sys.getsizeof(attr)
+            seen.add(id(attr))
+            for sheet, v in attr.items():
+                b = sizeof(sheet, seen) + sizeof(v, seen)
+                if sheet:
+                    sheets[sheet] = sheets.get(sheet, 0) + b
+                n += b
+        else:
+            n = sizeof(attr, seen)
+        structures[name] = n
+    # whatever else the program holds
+    structures['other'] = sizeof(prog, seen)
+
+    total = sum(structures.values()) + sum(fields.values())
+    return {'total': total, 'formulas': formulas,
+            'per_formula': total / formulas if formulas else 0.0,
+            'structures': structures, 'fields': fields, 'sheets': sheets}
+
+
+def flatten(report: Dict, prefix: str = '') -> Dict[str, float]:
+    """ Nested report as {'structures.sheetsExpr': bytes, 'sheets.Data': bytes, ...}."""
+    rtn: Dict[str, float] = {}
+    for k, v in report.items():
+        if isinstance(v, dict):
+            rtn.update(flatten(v, f"{prefix}{k}."))
+        else:
+            rtn[prefix + k] = v
+    return rtn
+
+
+def check_budget(report: Dict, budgets: Dict[str, float]) -> List[str]:
+    """ Entries of the report over their budget, keys are as `flatten` gives."""
+    flat = flatten(report)
+    over = []
+    for k, limit in budgets.items():
+        if k not in flat:
+            over.append(f"{k}: not in the report")
+        elif flat[k] > limit:
+            over.append(f"{k}: {flat[k]:.0f} bytes > budget {limit:.0f}")
+    return over
+
+
+def assert_budget(report: Dict, budgets: Dict[str, float]):
+    """ Raise AssertionError if any entry of the report is over its budget."""
+    over = check_budget(report, budgets)
+    if over:
+        raise AssertionError("memory budget exceeded: " + "; ".join(over))
+
+
+def traced(func: Callable, *args, top: int = 10, **kwargs) -> Tuple[object, Dict]:
+    """ Call `func` under `tracemalloc`, return (result, {'allocated', 'peak', 'top'}),
+    `top` is the List[Tuple[file:line, bytes]] which allocated the most.
+    """
+    started = not tracemalloc.is_tracing()
+    if started:
+        tracemalloc.start()
+    try:
+        tracemalloc.reset_peak()
+        before = tracemalloc.take_snapshot()
+        rtn = func(*args, **kwargs)
+        after = tracemalloc.take_snapshot()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        if started:
+            tracemalloc.stop()
+    stats = after.compare_to(before, 'lineno')
+    return rtn, {'allocated': sum(s.size_diff for s in stats), 'peak': peak,
+                 'top': [(str(s.traceback), s.size_diff) for s in stats[:top]]}
+
+
+if __name__ == '__main__':
+    from .Compiler import compile_workbook
+
+    if len(sys.argv) < 2:
+        print(f"Usage: {sys.argv[0]} <formula-file>")
+        exit(-1)
+    (prog, _), mem = traced(compile_workbook, sys.argv[1])
+    prog.build_call_trees()
+    report = footprint(prog)
+    for k, v in flatten(report).items():
+        print(f"{k:40s} {v:14,.0f}")
+    print(f"{'tracemalloc.allocated':40s} {mem['allocated']:14,.0f}")
+    for where, n in mem['top']:
+        print(f"  {where:60s} {n:12,d}")
+
+# vim: noai:ts=4:sw=4:expandtab
@@ -1,7 +1,7 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
-from typing import List, ClassVar
+from typing import Dict, List, ClassVar, Tuple
 # import pprint as pp
 
 
@@ -31,6 +31,8 @@ class XFormula:
 
         # extended attributes, need to analytics by parsing the syntax
         self.targets: List = []
+        # params only needed by one side of a branch: {param: (br, taken)}
+        self.conds: Dict[int, Tuple[int, bool]] = {}
 
         # type of cell - It will be evaluated by EEIEngine.evaluate_types(formula)
         #   0: unspecified,
@@ -55,17 +57,165 @@ class XFormula:
         """Return XFormula itself if it contains output functinos."""
         return self if self.type & XFormula.CT_TARGET > 0 else None
 
+    def references(self) -> List[Tuple[str, str]]:
+        """Return all the distinct params as `Tuple[sheet:str, cellrange:str]`.
+        Alias is kept as `('', NAME)` which should be resolved by the program.
+        """
+        refs = []
+        for c in self.params:
+            ref = as_ref(self.sheet, c)
+            if ref not in refs:
+                refs.append(ref)
+        return refs
+
+    def branch_references(self) -> Dict[Tuple[str, str], Tuple[int, bool]]:
+        """Return the references only needed when the branch `(br, taken)` is taken."""
+        rtn, seen = {}, set()
+        for i, c in enumerate(self.params):
+            ref = as_ref(self.sheet, c)
+            cond = self.conds.get(i)
+            if cond is None or (ref in seen and rtn.get(ref) != cond):
+                rtn.pop(ref, None)
+            elif ref not in seen:
+                rtn[ref] = cond
+            seen.add(ref)
+        return rtn
+
     def __repr__(self):
         return self.__str__()
 
+    def constants(self) -> Dict[int, object]:
+        """Return {n: constant} of all the `#n` operands."""
+        return {int(a[1:]): self.values[int(a[1:])]
+                for ins in self.syntax for a in _operands(ins) if a[:1] == '#'}
+
     def __str__(self):
         return f"""FORMULA:{self.ln:06d},  TXT:`{self.txt}`, TYPE:{self.type:04b},
                SHEET:'{self.sheet}',  TARGET:{self.targets},
                PARAMS:{self.params},
-               VALUES:{self.values},
+               VALUES:{self.constants()},
                SYNTAX:{self.syntax}"""
 
 
+class XConstants:
+    """ Typed constants of all the XFormula in one program, without duplications.
+
+    Interned XFormula share `values` with the pool and their `#n` operands are pool ids.
+    The pool is append-only: a new version of the program works on a `copy`, the ids
+    of its base stay valid and the base is left as is when the version is dropped.
+    """
+
+    def __init__(self) -> None:
+        # pool id => constant: int, float, bool or str
+        self.values: List = []
+        # (type, constant) => pool id, 1, 1.0 and TRUE are different constants,
+        # floats are keyed by repr so 0.0 and -0.0 are too
+        self._ids: Dict[Tuple[type, object], int] = {}
+
+    def __len__(self) -> int:
+        return len(self.values)
+
+    def copy(self) -> 'XConstants':
+        rtn = XConstants()
+        rtn.values = list(self.values)
+        rtn._ids = dict(self._ids)
+        return rtn
+
+    def add(self, v) -> int:
+        """ Pool id of the constant."""
+        key = (float, repr(v)) if isinstance(v, float) else (type(v), v)
+        idx = self._ids.get(key)
+        if idx is None:
+            idx = self._ids[key] = len(self.values)
+            self.values.append(v)
+        return idx
+
+    def intern(self, fn: XFormula) -> XFormula:
+        """ Move the constants of `fn` into the pool and rewrite its `#n` operands."""
+        if fn.values is self.values:
+            return fn
+        ids = [f"#{self.add(v)}" for v in fn.values]
+
+        def remap(a):
+            if isinstance(a, str) and a[:1] == '#':
+                return ids[int(a[1:])]
+            if isinstance(a, list):
+                return [remap(x) for x in a]
+            return a
+
+        if ids:
+            fn.syntax = [ins[:2] + tuple(remap(a) for a in ins[2:]) for ins in fn.syntax]
+        fn.values = self.values
+        return fn
+
+
+def as_ref(sheet: str, param) -> Tuple[str, str]:
+    """Normalize one param recorded by the parser to `Tuple[sheet:str, cellrange:str]`.
+
+    The parser records params as:
+      'A1'                  -- cell of the current sheet
+      (None, 'A1', 'B2')    -- range of the current sheet
+      ('S', 'A1', None)     -- cell of sheet 'S'
+      ('S', 'A1', 'B2')     -- range of sheet 'S'
+      ('', 'NAME')          -- alias
+    """
+    if not isinstance(param, tuple):
+        return sheet, param.replace('$', '')
+    if len(param) == 2:
+        return param
+    s, c0, c1 = param
+    cellrange = f"{c0}:{c1}" if c1 else c0
+    return (s if s is not None else sheet), cellrange.replace('$', '')
+
+
+def _operands(ins) -> List[str]:
+    """All the operands of one instruction, the args of function are flatten."""
+    rtn = []
+    for a in ins[2:]:
+        if isinstance(a, list):
+            rtn.extend(x for x in a if isinstance(x, str))
+        elif isinstance(a, str):
+            rtn.append(a)
+    return rtn
+
+
+def branch_params(syntax: List) -> Dict[int, Tuple[int, bool]]:
+    """Find the params which are only used by one side of a branch.
+
+    Return {param: (br, taken)}, the param is needed only if the condition
+    of the BR/IF instruction `br` is `taken`.
+    """
+    uses: Dict[int, set] = {}
+    stack: List[Tuple[int, bool]] = []
+
+    def use(operand: str, cond):
+        if operand[0] == '$':
+            uses.setdefault(int(operand[1:]), set()).add(cond)
+
+    for ins in syntax:
+        op = ins[1]
+        if op == 'LB':
+            if ins[3] == 'true':
+                stack.append((ins[2], True))
+            elif ins[3] == 'false':
+                stack[-1] = (ins[2], False)
+            else:
+                stack.pop()
+            continue
+        cond = stack[-1] if stack else None
+        if op in ('PHI', 'IF'):
+            br = int(ins[2][1:]) if op == 'PHI' else ins[0]
+            if op == 'IF' and isinstance(ins[2], str):
+                use(ins[2], cond)
+            for a, taken in ((ins[3], True), (ins[4], False)):
+                if isinstance(a, str):
+                    use(a, (br, taken))
+            continue
+        for a in _operands(ins):
+            use(a, cond)
+    return {k: v.pop() for k, v in uses.items() if len(v) == 1 and None not in v}
+
+
 def new(sheet: str,
         syntax: List, params: List, values: List,
         ln: int, txt: str = None) -> XFormula:
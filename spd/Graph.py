@@ -0,0 +1,166 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""Compressed-sparse-row form of the dependency graph.
+
+Node `i` is one XFormula of the `XProgram`, the edges `indices[indptr[i]:indptr[i+1]]`
+are the formulas depending on `i` (data flows from precedent to dependent).
+"""
+
+import os
+from typing import Dict, List, Tuple
+
+import numpy as np
+
+from .PseudoCode import XProgram
+
+__all__ = ["XGraph", "from_program"]
+
+
+class XGraph:
+    """ CSR adjacency of the dependency graph.
+
+    indptr  -- int64[n+1], offsets of every node into `indices`
+    indices -- int32[m], dependent node ids
+    cells   -- str[n], node id to `'Sheet'!Cell`
+    lines   -- int64[n], node id to line number of the XFormula
+    conds   -- bool[m], the edge is only needed by one side of an IF branch
+    """
+
+    def __init__(self, indptr, indices, cells, lines=None, conds=None) -> None:
+        self.indptr = np.asarray(indptr, dtype=np.int64)
+        self.indices = np.asarray(indices, dtype=np.int32)
+        self.cells = np.asarray(cells, dtype=str)
+        if lines is None:
+            lines = np.full(len(self.cells), -1, dtype=np.int64)
+        self.lines = np.asarray(lines, dtype=np.int64)
+        if conds is None:
+            conds = np.zeros(len(self.indices), dtype=bool)
+        self.conds = np.asarray(conds, dtype=bool)
+
+    @property
+    def nodes(self) -> int:
+        return len(self.indptr) - 1
+
+    @property
+    def edges(self) -> int:
+        return len(self.indices)
+
+    def save(self, path: str):
+        """ Save as one `.npz` file, or as `.npy` files in the `path` directory."""
+        arrays = {'indptr': self.indptr, 'indices': self.indices,
+                  'cells': self.cells, 'lines': self.lines, 'conds': self.conds}
+        if path.endswith('.npz'):
+            np.savez(path, **arrays)
+            return
+        os.makedirs(path, exist_ok=True)
+        for k, v in arrays.items():
+            np.save(os.path.join(path, k + '.npy'), v)
+
+    @staticmethod
+    def load(path: str, mmap: bool = True):
+        """ Load from `.npz` file or `.npy` directory, the later is memory mapped."""
+        if path.endswith('.npz'):
+            with np.load(path) as f:
+                return XGraph(f['indptr'], f['indices'], f['cells'], f['lines'], f['conds'])
+        mode = 'r' if mmap else None
+        arrays = [np.load(os.path.join(path, k + '.npy'), mmap_mode=mode)
+                  for k in ('indptr', 'indices', 'cells', 'lines', 'conds')]
+        return XGraph(*arrays)
+
+    def transpose(self):
+        """ Reverse all the edges: from dependent to precedent."""
+        src = np.repeat(np.arange(self.nodes, dtype=np.int32), np.diff(self.indptr))
+        order = np.argsort(self.indices, kind='stable')
+        indptr = np.zeros(self.nodes + 1, dtype=np.int64)
+        np.cumsum(np.bincount(self.indices, minlength=self.nodes), out=indptr[1:])
+        return XGraph(indptr, src[order], self.cells, self.lines, self.conds[order])
+
+    def neighbors(self, frontier: np.ndarray) -> np.ndarray:
+        """ Concatenate the adjacency of all the nodes in `frontier`."""
+        starts = self.indptr[frontier]
+        counts = self.indptr[frontier + 1] - starts
+        total = int(counts.sum())
+        if total == 0:
+            return np.empty(0, dtype=np.int32)
+        # offsets of every gathered edge: start of its node + position within the node
+        offsets = np.repeat(starts - np.cumsum(counts) + counts, counts)
+        return self.indices[offsets + np.arange(total)]
+
+    def bfs(self, sources) -> np.ndarray:
+        """ Breath-First Search from `sources`, return the depth of every node, -1 if unreached."""
+        depth = np.full(self.nodes, -1, dtype=np.int64)
+        frontier = np.unique(np.asarray(sources, dtype=np.int64))
+        level = 0
+        while len(frontier):
+            depth[frontier] = level
+            nbrs = self.neighbors(frontier)
+            frontier = np.unique(nbrs[depth[nbrs] < 0]).astype(np.int64)
+            level += 1
+        return depth
+
+    def toposort(self) -> Tuple[np.ndarray, np.ndarray]:
+        """ Kahn's algorithm one level at a time.
+        Return (order, levels), nodes inside a loop are not in order and have level -1.
+        """
+        indeg = np.bincount(self.indices, minlength=self.nodes)
+        levels = np.full(self.nodes, -1, dtype=np.int64)
+        frontier = np.flatnonzero(indeg == 0)
+        order: List[np.ndarray] = []
+        level = 0
+        while len(frontier):
+            levels[frontier] = level
+            order.append(frontier)
+            nbrs = self.neighbors(frontier)
+            indeg -= np.bincount(nbrs, minlength=self.nodes)
+            cand = np.unique(nbrs)
+            frontier = cand[indeg[cand] == 0]
+            level += 1
+        order = np.concatenate(order) if order else np.empty(0, dtype=np.int64)
+        return order, levels
+
+    def fanout(self) -> np.ndarray:
+        return np.diff(self.indptr)
+
+    def fanin(self) -> np.ndarray:
+        return np.bincount(self.indices, minlength=self.nodes)
+
+    def stats(self) -> Dict[str, float]:
+        """ Fan-in/fan-out statistics of the graph."""
+        rtn: Dict[str, float] = {'nodes': self.nodes, 'edges': self.edges}
+        for name, deg in (('fanin', self.fanin()), ('fanout', self.fanout())):
+            if len(deg) == 0:
+                deg = np.zeros(1, dtype=np.int64)
+            rtn[name + '_max'] = int(deg.max())
+            rtn[name + '_mean'] = float(deg.mean())
+            rtn[name + '_p99'] = float(np.percentile(deg, 99))
+            rtn[name + '_zero'] = int((deg == 0).sum())
+        return rtn
+
+
+def from_program(prog: XProgram) -> XGraph:
+    """ Export the dependency graph of all the XFormula in `prog` as CSR."""
+    ids: Dict[int, int] = {}
+    cells, lines = [], []
+    for sheet, tgt, fn in prog.formulas():
+        ids[id(fn)] = len(cells)
+        cells.append(f"'{sheet}'!{tgt}")
+        lines.append(fn.ln)
+
+    src, dst, conds = [], [], []
+    for _, _, fn in prog.formulas():
+        me = ids[id(fn)]
+        for p, cond in prog.edges(fn):
+            src.append(ids[id(p)])
+            dst.append(me)
+            conds.append(cond is not None)
+
+    n = len(cells)
+    src = np.asarray(src, dtype=np.int64)
+    dst = np.asarray(dst, dtype=np.int32)
+    order = np.argsort(src, kind='stable')
+    indptr = np.zeros(n + 1, dtype=np.int64)
+    np.cumsum(np.bincount(src, minlength=n), out=indptr[1:])
+    return XGraph(indptr, dst[order], cells, lines, np.asarray(conds, dtype=bool)[order])
+
+# vim: noai:ts=4:sw=4:expandtab
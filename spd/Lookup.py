@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""Indexes for the lookup functions: VLOOKUP, HLOOKUP, MATCH and INDEX.
+
+The first call on a (sheet, range, key column) builds a hash index for exact
+match and a sorted index for approximate match; later calls are O(1)/O(log n).
+Indexes are dropped when any cell inside the range changes, see
+`XEvaluator.invalidate` and `XEvaluator.changed`.
+"""
+
+from bisect import bisect_right
+from typing import Dict, List, Tuple
+
+from . import Utils
+from .Evaluator import XEvaluator, _num
+
+__all__ = ["XLookup"]
+
+NA = '#N/A'
+
+
+def _key(v):
+    """Key of the value in the index: strings are case-insensitive, TRUE is not 1."""
+    if isinstance(v, bool):
+        return ('B', v)
+    if isinstance(v, str):
+        return v.upper()
+    return v
+
+
+class XLookup:
+    """ Lookup functions with cached indexes, installed into one XEvaluator."""
+
+    FUNCS = ('VLOOKUP', 'HLOOKUP', 'MATCH', 'INDEX')
+
+    def __init__(self, ev: XEvaluator) -> None:
+        self.ev = ev
+        # (sheet, cellrange) => list of rows
+        self.tables: Dict[Tuple[str, str], List[List]] = {}
+        # (sheet, cellrange, axis, pos, mode) => index
+        self.indexes: Dict[Tuple, object] = {}
+        self.stats: Dict[str, int] = {'builds': 0, 'hits': 0, 'invalidated': 0}
+        for name in self.FUNCS:
+            ev.funcs[name] = getattr(self, name.lower())
+        ev.byref.update(self.FUNCS)
+        ev.watchers.append(self.invalidate)
+
+    # Cache
+
+    def table(self, ref) -> List[List]:
+        """ Rows of the range `ref`; a materialized list is returned as is."""
+        if not isinstance(ref, tuple):
+            return ref if isinstance(ref, list) else [[ref]]
+        if ref not in self.tables:
+            self.tables[ref] = self.ev.fetch(ref)
+        return self.tables[ref]
+
+    def _vector(self, rows: List[List], axis: str, pos: int) -> List:
+        if axis == 'col':
+            return [r[pos] if pos < len(r) else None for r in rows]
+        return list(rows[pos]) if pos < len(rows) else []
+
+    def _index(self, ref, axis: str, pos: int, mode: str):
+        """ Hash index {key: first position} (`exact`), or sorted index
+        {type: (keys, positions)} (`sorted`) of the column/row `pos` of the range.
+        """
+        key = (ref, axis, pos, mode) if isinstance(ref, tuple) else None
+        if key in self.indexes:
+            self.stats['hits'] += 1
+            return self.indexes[key]
+        self.stats['builds'] += 1
+        vec = self._vector(self.table(ref), axis, pos)
+        if mode == 'exact':
+            idx: Dict = {}
+            for i, v in enumerate(vec):
+                idx.setdefault(_key(v), i)
+        else:
+            idx = {'n': ([], []), 's': ([], [])}
+            for i, v in enumerate(vec):
+                if isinstance(v, bool) or v is None:
+                    continue
+                keys, positions = idx['s' if isinstance(v, str) else 'n']
+                keys.append(_key(v))
+                positions.append(i)
+        if key is not None:
+            self.indexes[key] = idx
+        return idx
+
+    def _find(self, ref, axis: str, pos: int, value, exact: bool) -> int:
+        """ Position of `value` in the column/row `pos`, -1 if not found."""
+        if exact:
+            return self._index(ref, axis, pos, 'exact').get(_key(value), -1)
+        keys, positions = self._index(ref, axis, pos, 'sorted')['s' if isinstance(value, str) else 'n']
+        i = bisect_right(keys, _key(value)) - 1
+        return positions[i] if i >= 0 else -1
+
+    def invalidate(self, changed):
+        """ Drop the tables and indexes which overlap any of the changed ranges."""
+        if changed is None:
+            self.stats['invalidated'] += len(self.tables)
+            self.tables.clear()
+            self.indexes.clear()
+            return
+        for sheet, cellrange in changed:
+            rg = Utils.XRange(cellrange)
+            for ref in [r for r in self.tables if r[0] == sheet and rg.overlaps(Utils.XRange(r[1]))]:
+                del self.tables[ref]
+                self.stats['invalidated'] += 1
+                for k in [k for k in self.indexes if k[0] == ref]:
+                    del self.indexes[k]
+
+    # Functions
+
+    def vlookup(self, value, ref, col, approx=True):
+        rows = self.table(ref)
+        i = self._find(ref, 'col', 0, value, approx in (False, 0))
+        if i < 0:
+            return NA
+        row, c = rows[i], int(_num(col)) - 1
+        return row[c] if 0 <= c < len(row) else '#REF!'
+
+    def hlookup(self, value, ref, row, approx=True):
+        rows = self.table(ref)
+        i = self._find(ref, 'row', 0, value, approx in (False, 0))
+        if i < 0:
+            return NA
+        r = int(_num(row)) - 1
+        return rows[r][i] if 0 <= r < len(rows) and i < len(rows[r]) else '#REF!'
+
+    def match(self, value, ref, kind=1):
+        rows = self.table(ref)
+        axis = 'col' if len(rows) > 1 else 'row'
+        kind = int(_num(kind))
+        if kind == 0:
+            i = self._find(ref, axis, 0, value, True)
+        elif kind > 0:
+            i = self._find(ref, axis, 0, value, False)
+        else:   # descending order, no index
+            vec, i = self._vector(rows, axis, 0), -1
+            for k, v in enumerate(vec):
+                if v is not None and _key(v) >= _key(value):
+                    i = k
+        return i + 1 if i >= 0 else NA
+
+    def index(self, ref, row, col=None):
+        rows = self.table(ref)
+        r, c = int(_num(row)), (int(_num(col)) if col is not None else None)
+        if c is None:       # one dimension
+            if len(rows) == 1:
+                r, c = 1, r
+            else:
+                c = 1
+        if not (1 <= r <= len(rows) and 1 <= c <= len(rows[r - 1])):
+            return '#REF!'
+        return rows[r - 1][c - 1]
+
+# vim: noai:ts=4:sw=4:expandtab
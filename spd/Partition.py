@@ -0,0 +1,380 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""Partitioned multi-process evaluation of a XProgram.
+
+`split` cuts the dependency graph into K partitions of similar estimated cost
+with few cut edges:
+  1. the egress DAGs which don't share any cell (`Scheduler.components`) are
+     the units, so a partition boundary follows a DAG boundary when it can;
+  2. a unit heavier than one partition is cut in depth-first order from its
+     egress cells, which keeps every subtree together;
+  3. units are spread over the partitions by cost, then boundary cells are
+     moved to the partition of most of their neighbours while it stays balanced.
+
+`XDistributed` runs every partition in its own forked process. A process
+evaluates its cells in topological order and sends the value of a cell only to
+the partitions which depend on it, through the inbox queue of each partition,
+so the processes never deadlock and only cut-edge values are exchanged. The
+exception of a partition is raised by `XDistributed.run`, so is the exit of a
+process which didn't send its results.
+"""
+
+import multiprocessing
+import os
+import pickle
+import queue
+import sys
+import time
+from typing import Callable, Dict, List, Tuple
+
+import numpy as np
+
+from .Evaluator import XEvaluator
+from .Formula import XFormula
+from .Graph import XGraph, from_program
+from .PseudoCode import XProgram
+from .Scheduler import components, estimate_cost, partition
+
+__all__ = ["XPartition", "XDistributed", "split"]
+
+
+class XPartition:
+    """ Assignment of every node of the graph to one partition.
+
+    parts  -- int32[n], partition of every node
+    costs  -- int64[n], estimated cost of every node
+    """
+
+    def __init__(self, graph: XGraph, parts, costs, k: int) -> None:
+        self.graph = graph
+        self.parts = np.asarray(parts, dtype=np.int32)
+        self.costs = np.asarray(costs, dtype=np.int64)
+        self.k = k
+
+    def _edges(self) -> Tuple[np.ndarray, np.ndarray]:
+        g = self.graph
+        src = np.repeat(np.arange(g.nodes, dtype=np.int64), np.diff(g.indptr))
+        return src, g.indices.astype(np.int64)
+
+    def cut(self) -> np.ndarray:
+        """ Mask of the edges between two partitions."""
+        src, dst = self._edges()
+        return self.parts[src] != self.parts[dst]
+
+    def sends(self) -> Dict[int, List[int]]:
+        """ {node: partitions other than its own which depend on it}."""
+        src, dst = self._edges()
+        mask = self.parts[src] != self.parts[dst]
+        rtn: Dict[int, List[int]] = {}
+        for s, p in sorted(set(zip(src[mask].tolist(), self.parts[dst[mask]].tolist()))):
+            rtn.setdefault(s, []).append(p)
+        return rtn
+
+    def quality(self) -> Dict[str, float]:
+        """ Balance and cut of the partitions, `traffic` is the number of values sent
+        in one full calculation.
+        """
+        load = np.bincount(self.parts, weights=self.costs, minlength=self.k)
+        cut = self.cut()
+        edges = len(cut)
+        return {'parts': self.k,
+                'nodes': np.bincount(self.parts, minlength=self.k).tolist(),
+                'cost': load.astype(np.int64).tolist(),
+                'imbalance': float(load.max() / load.mean()) if load.sum() else 1.0,
+                'edges': edges,
+                'cut_edges': int(cut.sum()),
+                'cut_ratio': float(cut.sum() / edges) if edges else 0.0,
+                'traffic': sum(len(v) for v in self.sends().values())}
+
+
+def _dfs_order(graph: XGraph, rev: XGraph, nodes: List[int]) -> List[int]:
+    """ `nodes` in depth-first post order over the precedents, from the ones without
+    dependents in `nodes`, so every subtree is contiguous.
+    """
+    inside = set(nodes)
+    seen: set = set()
+    order: List[int] = []
+    sinks = [i for i in nodes
+             if not any(int(d) in inside for d in graph.indices[graph.indptr[i]:graph.indptr[i + 1]])]
+    for root in sinks + nodes:
+        if root in seen:
+            continue
+        seen.add(root)
+        stack = [(root, iter(rev.indices[rev.indptr[root]:rev.indptr[root + 1]].tolist()))]
+        while stack:
+            node, it = stack[-1]
+            for p in it:
+                if p in inside and p not in seen:
+                    seen.add(p)
+                    stack.append((p, iter(rev.indices[rev.indptr[p]:rev.indptr[p + 1]].tolist())))
+                    break
+            else:
+                stack.pop()
+                order.append(node)
+    return order
+
+
+def _refine(graph: XGraph, parts: np.ndarray, costs: np.ndarray, k: int,
+            limit: float, passes: int) -> int:
+    """ Move the boundary nodes to the partition of most of their neighbours, while no
+    partition goes over `limit`; return the number of moves.
+    """
+    rev = graph.transpose()
+    load = np.bincount(parts, weights=costs, minlength=k)
+    src = np.repeat(np.arange(graph.nodes, dtype=np.int64), np.diff(graph.indptr))
+    dst = graph.indices.astype(np.int64)
+    moved = 0
+    for _ in range(passes):
+        moves = 0
+        cut = parts[src] != parts[dst]
+        for i in np.unique(np.concatenate((src[cut], dst[cut]))).tolist():
+            nbrs = np.concatenate((graph.indices[graph.indptr[i]:graph.indptr[i + 1]],
+                                   rev.indices[rev.indptr[i]:rev.indptr[i + 1]]))
+            if len(nbrs) == 0:
+                continue
+            count = np.bincount(parts[nbrs], minlength=k)
+            cur = parts[i]
+            best = int(count.argmax())
+            if count[best] <= count[cur] or load[best] + costs[i] > limit:
+                continue
+            load[cur] -= costs[i]
+            load[best] += costs[i]
+            parts[i] = best
+            moves += 1
+        moved += moves
+        if moves == 0:
+            break
+    return moved
+
+
+def split(prog: XProgram, k: int, eps: float = 0.1, passes: int = 4, graph: XGraph = None) -> XPartition:
+    """ Split the formulas of `prog` into `k` partitions, the cost of one partition
+    should stay below (1 + eps) times the average.
+    """
+    if not prog.callflow:
+        prog.build_call_trees()
+    graph = graph if graph is not None else from_program(prog)
+    n = graph.nodes
+    k = max(1, min(k, n))
+    fns = {fn.ln: fn for _, _, fn in prog.formulas()}
+    costs = np.asarray([estimate_cost(fns[int(ln)]) for ln in graph.lines], dtype=np.int64)
+    nodes = {int(ln): i for i, ln in enumerate(graph.lines)}
+    target = costs.sum() / k if n else 0
+
+    # 1. disjoint egress DAGs, cells which no egress depends on go together
+    units: List[List[int]] = []
+    owned = np.zeros(n, dtype=bool)
+    for group in components(prog):
+        unit = sorted({nodes[fn.ln] for e in group for fn in prog.callflow[e.ln] if fn.ln in nodes}
+                      | {nodes[e.ln] for e in group if e.ln in nodes})
+        unit = [i for i in unit if not owned[i]]
+        owned[unit] = True
+        if unit:
+            units.append(unit)
+    rest = np.flatnonzero(~owned).tolist()
+    if rest:
+        units.append(rest)
+
+    # 2. heavy units are cut in depth-first order
+    rev = graph.transpose()
+    pieces: List[List[int]] = []
+    for unit in units:
+        cost = int(costs[unit].sum())
+        if cost <= target * (1 + eps) or len(unit) == 1:
+            pieces.append(unit)
+            continue
+        order = _dfs_order(graph, rev, unit)
+        count = int(np.ceil(cost / target))
+        bounds = np.searchsorted(np.cumsum(costs[order]), np.arange(1, count) * cost / count)
+        pieces.extend(p.tolist() for p in np.split(np.asarray(order), bounds) if len(p))
+
+    # 3. spread over the partitions, then refine the boundary
+    parts = np.zeros(n, dtype=np.int32)
+    for p, group in enumerate(partition([int(costs[u].sum()) for u in pieces], k)):
+        for u in group:
+            parts[pieces[u]] = p
+    if n:
+        limit = max(target * (1 + eps), float(np.bincount(parts, weights=costs, minlength=k).max()))
+        _refine(graph, parts, costs, k, limit, passes)
+    return XPartition(graph, parts, costs, k)
+
+
+class _XPartEvaluator(XEvaluator):
+    """ XEvaluator of one partition, the results of `remote` formulas come from the inbox."""
+
+    def __init__(self, prog: XProgram, funcs: Dict[str, Callable], remote: set, inbox, flush: Callable):
+        super().__init__(prog, funcs)
+        self.remote = remote
+        self.inbox = inbox
+        self.flush = flush
+        self.waited: float = 0.0
+        self.received: int = 0
+
+    def result(self, fn: XFormula):
+        if fn.ln in self.remote:
+            while fn.ln not in self.results:
+                self.flush()
+                t0 = time.perf_counter()
+                values = self.inbox.get()
+                self.waited += time.perf_counter() - t0
+                self.results.update(values)
+                self.received += len(values)
+            return self.results[fn.ln]
+        return super().result(fn)
+
+
+def _run_partition(p: int, prog: XProgram, funcs: Dict[str, Callable], lines: List[Tuple[int, int]],
+                   remote: set, sends: Dict[int, List[int]], inboxes: List, results):
+    """ Evaluate the plan `lines` of the partition `p`, put `(p, {egress ln: value}, stats)`
+    on `results`, or `(p, exception)` if it fails.
+    """
+    try:
+        results.put((p,) + _evaluate_partition(p, prog, funcs, lines, remote, sends, inboxes))
+    except BaseException as e:
+        try:
+            pickle.dumps(e)
+        except Exception:
+            e = RuntimeError(f"{type(e).__name__}: {e}")
+        results.put((p, e))
+
+
+def _evaluate_partition(p, prog, funcs, lines, remote, sends, inboxes) -> Tuple[Dict, Dict]:
+    outbox: Dict[int, List[Tuple[int, object]]] = {}
+    stats = {'evaluated': 0, 'sent': 0, 'messages': 0}
+
+    def flush():
+        for q, values in outbox.items():
+            if values:
+                inboxes[q].put(values)
+                stats['sent'] += len(values)
+                stats['messages'] += 1
+        outbox.clear()
+
+    ev = _XPartEvaluator(prog, funcs, remote, inboxes[p], flush)
+    fns = {fn.ln: fn for _, _, fn in prog.formulas()}
+    egress = {fn.ln for fn in prog.egressCells}
+    rtn: Dict[int, object] = {}
+    t0 = time.perf_counter()
+    level = None
+    for lv, ln in lines:
+        if lv != level:
+            flush()
+            level = lv
+        v = ev.result(fns[ln])
+        stats['evaluated'] += 1
+        for q in sends.get(ln, ()):
+            outbox.setdefault(q, []).append((ln, v))
+        if ln in egress:
+            rtn[ln] = v
+    flush()
+    stats.update(received=ev.received, waited=ev.waited, elapsed=time.perf_counter() - t0)
+    return rtn, stats
+
+
+class XDistributed:
+    """ Evaluate all the egress cells of a XProgram with one process per partition.
+
+    parts  -- number of partitions, default to the number of CPUs
+    """
+
+    def __init__(self, prog: XProgram, funcs: Dict[str, Callable] = None, parts: int = None,
+                 eps: float = 0.1, timeout: float = None) -> None:
+        self.prog = prog
+        self.funcs = funcs
+        self.timeout = timeout
+        self.graph = from_program(prog)
+        self.partition = split(prog, parts or os.cpu_count() or 1, eps, graph=self.graph)
+        # partition => {evaluated, sent, messages, received, waited, elapsed}
+        self.stats: Dict[int, Dict] = {}
+        self.serial: int = 0
+
+    def run(self) -> Dict[int, object]:
+        """ Evaluate and return {egress ln: value}, same as `XEvaluator.calculate`."""
+        order, levels = self.graph.toposort()
+        k = self.partition.k
+        if k <= 1 or (levels < 0).any() or 'fork' not in multiprocessing.get_all_start_methods():
+            # loops can't be ordered across partitions
+            self.serial += 1
+            return XEvaluator(self.prog, self.funcs).calculate()
+        parts, lines = self.partition.parts, self.graph.lines
+        plan: List[List[Tuple[int, int]]] = [[] for _ in range(k)]
+        for i in order.tolist():
+            plan[parts[i]].append((int(levels[i]), int(lines[i])))
+        src, dst = self.partition._edges()
+        remote: List[set] = [set() for _ in range(k)]
+        for s, d in zip(src.tolist(), dst.tolist()):
+            if parts[s] != parts[d]:
+                remote[parts[d]].add(int(lines[s]))
+        sends = {int(lines[i]): q for i, q in self.partition.sends().items()}
+
+        ctx = multiprocessing.get_context('fork')
+        inboxes, results = [ctx.Queue() for _ in range(k)], ctx.Queue()
+        procs = [ctx.Process(target=_run_partition, name=f"XPartition-{p}", daemon=True,
+                             args=(p, self.prog, self.funcs, plan[p], remote[p], sends, inboxes, results))
+                 for p in range(k)]
+        rtn: Dict[int, object] = {}
+        deadline = time.monotonic() + self.timeout if self.timeout is not None else None
+        pending, gone = set(range(k)), set()
+        try:
+            for proc in procs:
+                proc.start()
+            while pending:
+                try:
+                    msg = results.get(timeout=0.05)
+                except queue.Empty:
+                    # the message of a process is sent before it exits: one found dead
+                    # twice in a row without a message died on the way
+                    dead = {p for p in pending if procs[p].exitcode is not None}
+                    for p in dead & gone:
+                        raise RuntimeError(f"partition {p} exited with code {procs[p].exitcode}")
+                    gone = dead
+                    if deadline is not None and time.monotonic() > deadline:
+                        raise TimeoutError("partitions did not finish in time")
+                    continue
+                if len(msg) == 2:
+                    raise msg[1]
+                p, values, stats = msg
+                rtn.update(values)
+                self.stats[p] = stats
+                pending.discard(p)
+            # a value on a branch not taken is never read, don't wait for its feeder
+            for proc in procs:
+                proc.join(1.0)
+        finally:
+            for proc in procs:
+                if proc.is_alive():
+                    proc.terminate()
+        return {fn.ln: rtn[fn.ln] for fn in self.prog.egressCells}
+
+    def report(self) -> Dict[str, float]:
+        """ Quality of the partition and the traffic of the last run."""
+        rtn = self.partition.quality()
+        stats = self.stats.values()
+        rtn['sent'] = sum(s['sent'] for s in stats)
+        rtn['messages'] = sum(s['messages'] for s in stats)
+        rtn['waited'] = sum(s['waited'] for s in stats)
+        return rtn
+
+
+if __name__ == '__main__':
+    # Partition quality and timing vs the number of partitions: [width [depth]]
+    from .Compiler import load_lines
+    from .Scheduler import synthetic
+
+    width = int(sys.argv[1]) if len(sys.argv) > 1 else 64
+    depth = int(sys.argv[2]) if len(sys.argv) > 2 else 60
+    prog = load_lines(synthetic(width, depth), keep_txt=False)
+    funcs = {'RTGET': lambda ric, field: 1.0}
+    t = time.perf_counter()
+    expect = XEvaluator(prog, funcs).calculate()
+    print(f"serial: {(time.perf_counter() - t) * 1000:9.1f}ms")
+    for k in (2, 4, 8):
+        dist = XDistributed(prog, funcs, k)
+        t = time.perf_counter()
+        assert dist.run() == expect
+        q = dist.report()
+        print(f"parts:{k} {(time.perf_counter() - t) * 1000:9.1f}ms imbalance:{q['imbalance']:.3f} "
+              f"cut:{q['cut_edges']}/{q['edges']} traffic:{q['traffic']} sent:{q['sent']} messages:{q['messages']}")
+
+# vim: noai:ts=4:sw=4:expandtab
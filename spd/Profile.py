@@ -0,0 +1,243 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""Hot cells and functions of a recalculation.
+
+`XProfiler` works in one of two modes:
+  trace  -- `XEvaluator.evaluate` and the functions are wrapped, every call is
+            counted and timed; self time excludes the precedent formulas and
+            the function calls
+  sample -- a thread samples the evaluator stack every `interval` seconds,
+            nothing is wrapped, counts are samples and times are estimates;
+            the formulas come from the evaluator's own stack, the function from
+            the code objects of the thread's frames, no frame locals are read
+
+    with XProfiler(ev) as prof:
+        ev.calculate()
+    print(prof.report(20))
+    prof.dump('calc.folded')    # flamegraph.pl calc.folded > calc.svg
+
+Formulas are labelled `'Sheet'!Cell:ln` in the report and in the folded stacks.
+"""
+
+import sys
+import threading
+import time
+from typing import Callable, Dict, List, Tuple
+
+from .Evaluator import XEvaluator
+
+__all__ = ["XProfiler"]
+
+
+class XProfiler:
+    """ Profile the evaluations of one XEvaluator between `start` and `stop`.
+
+    interval  -- sampling period in seconds, None to trace every call
+    """
+
+    def __init__(self, ev: XEvaluator, interval: float = None) -> None:
+        self.ev = ev
+        self.interval = interval
+        # ln => [count, cumulative, self], name => [count, cumulative, self]
+        self.formulas: Dict[int, List] = {}
+        self.funcs: Dict[str, List] = {}
+        # folded stack => self time (trace) or samples (sample)
+        self.stacks: Dict[Tuple, float] = {}
+        self.samples: int = 0
+        self.elapsed: float = 0.0
+        self._labels: Dict[int, str] = {}
+        self._frames: List = []
+        self._children: List[float] = []
+        self._saved: Dict[str, Callable] = {}
+        self._thread = None
+        self._running = False
+        self._t0 = 0.0
+
+    # Trace
+
+    def _enter(self, key):
+        self._frames.append(key)
+        self._children.append(0.0)
+
+    def _leave(self, records: Dict, name, dt: float):
+        children = self._children.pop()
+        stack = tuple(self._frames)
+        self._frames.pop()
+        rec = records.get(name)
+        if rec is None:
+            rec = records[name] = [0, 0.0, 0.0]
+        rec[0] += 1
+        rec[1] += dt
+        rec[2] += dt - children
+        self.stacks[stack] = self.stacks.get(stack, 0.0) + dt - children
+        if self._children:
+            self._children[-1] += dt
+
+    def _trace_formula(self, evaluate: Callable) -> Callable:
+        def traced(fn):
+            self._enter(fn.ln)
+            t0 = time.perf_counter()
+            try:
+                return evaluate(fn)
+            finally:
+                self._leave(self.formulas, fn.ln, time.perf_counter() - t0)
+        return traced
+
+    def _trace_func(self, name: str, func: Callable) -> Callable:
+        def traced(*args):
+            self._enter(name)
+            t0 = time.perf_counter()
+            try:
+                return func(*args)
+            finally:
+                self._leave(self.funcs, name, time.perf_counter() - t0)
+        return traced
+
+    # Sample
+
+    def _stack(self, frame, codes: Dict) -> Tuple:
+        """ ln of the formulas in evaluation, outermost first, and the function in the
+        innermost one if it's being called.
+        """
+        # a copy of a dict of ints is made without releasing the GIL
+        rtn = list(self.ev._active)
+        run = XEvaluator._run.__code__
+        while frame is not None and frame.f_code is not run:
+            func = codes.get(frame.f_code)
+            if func is not None:
+                rtn.append(func)
+                break
+            frame = frame.f_back
+        return tuple(rtn)
+
+    def _sampler(self, ident: int):
+        # code object => name of the Python functions, the builtins are not seen
+        codes = {getattr(f, '__code__', None): name for name, f in self.ev.funcs.items()}
+        codes.pop(None, None)
+        last = time.perf_counter()
+        while self._running:
+            time.sleep(self.interval)
+            # a sample stands for the time since the previous one, the GIL may delay it
+            now = time.perf_counter()
+            dt, last = now - last, now
+            frame = sys._current_frames().get(ident)
+            if frame is None:
+                continue
+            stack = self._stack(frame, codes)
+            del frame
+            self.samples += 1
+            if not stack:
+                continue
+            self.stacks[stack] = self.stacks.get(stack, 0) + 1
+            for i, key in enumerate(stack):
+                records = self.funcs if isinstance(key, str) else self.formulas
+                rec = records.get(key)
+                if rec is None:
+                    rec = records[key] = [0, 0.0, 0.0]
+                if key not in stack[i + 1:]:
+                    rec[0] += 1
+                    rec[1] += dt
+                if i == len(stack) - 1:
+                    rec[2] += dt
+
+    # Control
+
+    def start(self) -> 'XProfiler':
+        self._t0 = time.perf_counter()
+        if self.interval is None:
+            ev = self.ev
+            self._saved = dict(ev.funcs)
+            ev.evaluate = self._trace_formula(ev.evaluate)
+            for name, func in self._saved.items():
+                ev.funcs[name] = self._trace_func(name, func)
+        else:
+            self._running = True
+            self._thread = threading.Thread(target=self._sampler, args=(threading.get_ident(),),
+                                            name='XProfiler', daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self) -> 'XProfiler':
+        if self.interval is None:
+            if 'evaluate' in vars(self.ev):
+                del self.ev.evaluate
+            for name, func in self._saved.items():
+                self.ev.funcs[name] = func
+            self._saved = {}
+        elif self._thread is not None:
+            self._running = False
+            self._thread.join()
+            self._thread = None
+        self.elapsed += time.perf_counter() - self._t0
+        return self
+
+    def __enter__(self) -> 'XProfiler':
+        return self.start()
+
+    def __exit__(self, kind, value, tb):
+        self.stop()
+
+    # Output
+
+    def label(self, key) -> str:
+        """ `'Sheet'!Cell:ln` of a formula, the name of a function."""
+        if isinstance(key, str):
+            return key
+        if not self._labels:
+            self._labels = {fn.ln: f"'{sheet}'!{tgt}:{fn.ln}" for sheet, tgt, fn in self.ev.prog.formulas()}
+        return self._labels.get(key, f"?:{key}")
+
+    def top(self, n: int = 20, key: str = 'self', funcs: bool = False) -> List[Tuple[str, int, float, float]]:
+        """ (label, count, cumulative, self) of the `n` hottest formulas, or functions,
+        sorted by 'self', 'cumulative' or 'count'.
+        """
+        col = {'count': 0, 'cumulative': 1, 'self': 2}[key]
+        records = self.funcs if funcs else self.formulas
+        rows = sorted(records.items(), key=lambda kv: kv[1][col], reverse=True)[:n]
+        return [(self.label(k), c, cum, own) for k, (c, cum, own) in rows]
+
+    def report(self, n: int = 20, key: str = 'self') -> str:
+        unit = 'samples' if self.interval is not None else 'calls'
+        lines = [f"elapsed {self.elapsed * 1000:.1f}ms"
+                 + (f", {self.samples} samples every {self.interval * 1000:g}ms" if self.interval else "")]
+        for title, funcs in (('formula', False), ('function', True)):
+            lines.append(f"{title:40s} {unit:>10s} {'cum ms':>10s} {'self ms':>10s}")
+            for label, count, cum, own in self.top(n, key, funcs):
+                lines.append(f"{label:40s} {count:10d} {cum * 1000:10.3f} {own * 1000:10.3f}")
+        return "\n".join(lines)
+
+    def folded(self) -> List[str]:
+        """ Folded stacks `frame;frame;... value` for flamegraph.pl / speedscope,
+        values are microseconds (trace) or samples (sample).
+        """
+        scale = 1e6 if self.interval is None else 1
+        rtn = []
+        for stack, v in sorted(self.stacks.items(), key=lambda kv: kv[1], reverse=True):
+            v = int(round(v * scale))
+            if v > 0:
+                rtn.append(";".join(self.label(k) for k in stack) + f" {v}")
+        return rtn
+
+    def dump(self, path: str):
+        with open(path, 'w', encoding='utf-8') as f:
+            for line in self.folded():
+                f.write(line + "\n")
+
+
+if __name__ == '__main__':
+    # Profile one full calculation: [formula-file|- [interval]], - for a synthetic graph
+    from .Compiler import compile_workbook, load_lines
+    from .Scheduler import synthetic
+
+    if len(sys.argv) > 1 and sys.argv[1] != '-':
+        prog, _ = compile_workbook(sys.argv[1])
+    else:
+        prog = load_lines(synthetic(64, 20), keep_txt=False)
+    interval = float(sys.argv[2]) if len(sys.argv) > 2 else None
+    ev = XEvaluator(prog)
+    with XProfiler(ev, interval) as prof:
+        ev.calculate()
+    print(prof.report(20))
+
+# vim: noai:ts=4:sw=4:expandtab
@@ -5,7 +5,7 @@
 from typing import Dict, List, Tuple
 
 from . import Utils
-from .Formula import XFormula
+from .Formula import XConstants, XFormula
 
 """
 Each egress cell can construct a call graph -- DAG.
@@ -33,9 +33,19 @@ class XProgram:
         self.sheetsRange: Dict[str, List[Tuple]] = {}
         # Store all the Ref and Alias as Dict[sheet:str, Dict[str, Tuple[sheet:str, cellrange:str]]]
         self.sheetsRefer: Dict[str, Dict[str, Tuple[str, str]]] = {"": {}}
+        # Whether all the chains in `self.sheetsRefer` are flattened by `resolve_refers`
+        self.refersResolved: bool = True
+        # Loops found by `resolve_refers` as List[List[Tuple[sheet:str, name:str]]]
+        self.referLoops: List[List[Tuple[str, str]]] = []
         # Store all the static value as Dict[sheet:str, Dict[cell:str, value:str]]
         self.sheetsValue: Dict[str, Dict[str, str]] = {
             '': {'FALSE': False, 'TRUE': True}}
+        # Typed constants of all the XFormula, see `XConstants.intern`
+        self.constants: XConstants = XConstants()
+        # Index of all the populated cells as Dict[sheet:str, Utils.XOccupancy]
+        self.sheetsIndex: Dict[str, Utils.XOccupancy] = {}
+        # Stubs of the cells removed by `prune` as Dict[sheet:str, Dict[cell:str, Tuple[kind:str, ln:int]]]
+        self.sheetsPruned: Dict[str, Dict[str, Tuple[str, int]]] = {}
 
         # All active cells: List[XFormula]
         self.ingressCells: List[XFormula] = []
@@ -44,13 +54,23 @@ class XProgram:
         self.egressCells: List[XFormula] = []
 
         # call flow from cell to cell for all Egress Functions
-        self.callflow = []
+        # it is egress ln => visited XFormula by `build_call_trees`
+        self.callflow = {}  # { ln: [array of XFormula], ... }
 
         # call flows for Active cells to other Active cells
         # it is ActiveCell => array of ref(XFormula)
         self.dataPrepares = {}  # { ActiveCell: [array of XFormula], ... }
         pass
 
+    def _occupy(self, tgt: str, sheet: str):
+        """ Record the single cell `tgt` into the index of the sheet.
+        """
+        if len(sheet) == 0 or tgt.find(':') >= 0:
+            return
+        if sheet not in self.sheetsIndex:
+            self.sheetsIndex[sheet] = Utils.XOccupancy()
+        self.sheetsIndex[sheet].add(tgt)
+
     def add_refer(self, href: Tuple[str, str], tgt: str, sheet: str = ''):
         """ Add alias and refer into the program
         XXX: We assume the ALIAS always come at the beginning.
@@ -59,16 +79,57 @@ class XProgram:
             self.sheetsRefer[sheet] = {tgt: href}
         else:
             self.sheetsRefer[sheet][tgt] = href
-        pass
+        self.refersResolved = False
+        self._occupy(tgt, sheet)
+
+    def _is_refer(self, ref: Tuple[str, str]) -> bool:
+        return ref[1] in self.sheetsRefer.get(ref[0], {})
+
+    def resolve_refers(self) -> List[List[Tuple[str, str]]]:
+        """ Flatten every Ref and Alias chain to the final `Tuple[sheet:str, cellrange:str]`.
+        A chain stops at anything which is not a Ref/Alias: formula, value, range or nothing.
+        Refers in (or leading to) a loop are removed, the loops are returned and
+        recorded in `self.referLoops`.
+        """
+        loops = []
+        # refers removed so far, a chain reaching one of them leads to a loop
+        dead = set()
+        for sheet, refs in self.sheetsRefer.items():
+            for name in list(refs):
+                if name not in refs:        # removed as part of a loop
+                    continue
+                path, onpath, key = [], set(), (sheet, name)
+                while key not in dead and self._is_refer(key):
+                    if key in onpath:
+                        loops.append(path[path.index(key):])
+                        break
+                    path.append(key)
+                    onpath.add(key)
+                    key = self.sheetsRefer[key[0]][key[1]]
+                if key in dead or key in onpath:
+                    key = None
+                # path compression
+                for s, n in path:
+                    if key is None:
+                        del self.sheetsRefer[s][n]
+                        dead.add((s, n))
+                    else:
+                        self.sheetsRefer[s][n] = key
+        self.referLoops.extend(loops)
+        self.refersResolved = True
+        return loops
 
     def add_formula(self, cell: XFormula, tgt: str, sheet: str = ''):
         """ Before set the cell into the sheets, please make sure call `EEIEngine.evaluate_funcs(cell)` to
         expand the extra outpus and validate the type of the cell!!!
+        The constants of the cell are moved into `self.constants`.
         """
+        self.constants.intern(cell)
         if sheet not in self.sheetsExpr:
             self.sheetsExpr[sheet] = {tgt: cell}
         else:
             self.sheetsExpr[sheet][tgt] = cell
+        self._occupy(tgt, sheet)
         # Record all the target Cells
         if cell.egress():
             self.egressCells.append(cell)
@@ -93,7 +154,7 @@ class XProgram:
             self.sheetsValue[sheet] = {tgt: value}
         else:
             self.sheetsValue[sheet][tgt] = value
-        pass
+        self._occupy(tgt, sheet)
 
     def _overlapped_range(self, sheet: str, cellrange: str) -> XFormula:
         """ Whether the input range/cell is overlapped with range, and it doesn't visited by `tgt`
@@ -114,68 +175,75 @@ class XProgram:
                     return r[2]
         return None
 
-    def _ref_first_search(self, ref: Tuple[str, str], tgt: int, visited: List):
-        """ Search and append all the `ref:Tuple[sheet:str, cellrange:str]` into the `visited`
+    def _ref_formulas(self, ref: Tuple[str, str], depth: int = 0):
+        """ Yield all the XFormula covered by `ref:Tuple[sheet:str, cellrange:str]`,
+        Ref and Alias are followed.
         """
         sheet, cellrange = ref
-        if cellrange.rfind(':') < 0:
-            self._ref_first_search_cell(ref, tgt, visited)
+        if depth > 64:      # refer loop
+            return
+        if len(sheet) == 0:     # Alias
+            ref = self.sheetsRefer[""].get(cellrange)
+            if ref:
+                yield from self._ref_formulas(ref, depth + 1)
             return
 
-        # print("  TGT:{:06d} -> '{}'!{}".format(tgt, sheet, cellrange))
         # Look for all the cells again
         r = self._overlapped_range(sheet, cellrange)
-        if r and tgt not in r.outputs:
-            #print("  -> TGT:{:06d} -> R:'{}'!{}".format(tgt, sheet, cellrange))
-            r.outputs.append(tgt)
-            visited.append(r)
+        if r:
+            yield r
+            if cellrange.rfind(':') < 0:
+                return
 
-        # loop all cells, but do deep-first for all ref cells
+        if sheet not in self.sheetsIndex:
+            return
+        # loop all populated cells, but do deep-first for all ref cells
         sheetcells = self.sheetsExpr[sheet] if sheet in self.sheetsExpr else {}
         sheetrefs = self.sheetsRefer[sheet] if sheet in self.sheetsRefer else {
         }
-        for x in Utils.range_to_cells(cellrange):
-            #print("  -> TGT:{:06d} -> C:'{}'!{}".format(tgt, sheet, x))
+        for x in self.sheetsIndex[sheet].cells(Utils.XRange(cellrange)):
             if x in sheetcells:
                 # but here it could be: Value, Ref, Alias
-                fn = sheetcells[x]
-                if tgt not in fn.outputs:
-                    fn.outputs.append(tgt)
-                    visited.append(fn)
-            elif x in sheetrefs:
-                self._ref_first_search(sheetrefs[x], tgt, visited)
-
-    def _ref_first_search_cell(self, ref: Tuple[str, str], tgt: int, visited: List):
-        """ Search and append all the cell into the `visited`
-        """
-        sheet, cell = ref
-        #print("  TGT:{:06d} -> '{}'!{}".format(tgt, sheet, cell))
-        # Look for all the cells again
-        r = self._overlapped_range(sheet, cell)
-        if r:
-            if tgt not in r.outputs:
-                #print("  -> TGT:{:06d} -> R:'{}'!{}".format(tgt, sheet, cell))
-                r.outputs.append(tgt)
-                visited.append(r)
-            return
+                yield sheetcells[x]
+            elif x in sheetrefs:   # It must be a Tuple[sheet:str, cellrange:str]
+                yield from self._ref_formulas(sheetrefs[x], depth + 1)
 
-        # loop all cells, but do deep-first for all ref cells
-        sheetcells = self.sheetsExpr[sheet] if sheet in self.sheetsExpr else {}
-        if cell in sheetcells:
-            #print("  -> TGT:{:06d} -> E:'{}'!{}".format(tgt, sheet, cell))
-            fn = sheetcells[cell]
+    def _ref_first_search(self, ref: Tuple[str, str], tgt: int, visited: List):
+        """ Search and append all the `ref:Tuple[sheet:str, cellrange:str]` into the `visited`
+        """
+        for fn in self._ref_formulas(ref):
             if tgt not in fn.outputs:
                 fn.outputs.append(tgt)
                 visited.append(fn)
-            return
 
-        # loop all Ref and Alias
-        sheetrefs = self.sheetsRefer[sheet] if sheet in self.sheetsRefer else {
-        }
-        if cell in sheetrefs:   # It must be a Tuple[sheet:str, cellrange:str]
-            #print("  -> TGT:{:06d} -> A:'{}'!{}".format(tgt, sheet, cell))
-            self._ref_first_search(sheetrefs[cell], tgt, visited)
-            return
+    def edges(self, it: XFormula) -> List[Tuple[XFormula, Tuple[int, bool]]]:
+        """ All the XFormula directly depended by `it` with the branch condition,
+        the condition is `(br, taken)` if it's only needed by one side of the branch `br`,
+        otherwise None.
+        """
+        rtn, seen = [], {}
+        conds = it.branch_references()
+        for c in it.references():
+            cond = conds.get(c)
+            for fn in self._ref_formulas(c):
+                if id(fn) not in seen:
+                    seen[id(fn)] = len(rtn)
+                    rtn.append((fn, cond))
+                elif rtn[seen[id(fn)]][1] != cond:
+                    rtn[seen[id(fn)]] = (fn, None)
+        return rtn
+
+    def precedents(self, it: XFormula) -> List[XFormula]:
+        """ All the XFormula directly depended by `it`, without duplications.
+        """
+        return [fn for fn, _ in self.edges(it)]
+
+    def formulas(self):
+        """ Yield all the `Tuple[sheet:str, cellrange:str, XFormula]` in the program.
+        """
+        for sheet, cells in self.sheetsExpr.items():
+            for tgt, fn in cells.items():
+                yield sheet, tgt, fn
 
     def breathfistsearch(self, tgt: XFormula, visited: List[XFormula] = []):
         """ Breath-First Search to go through all the cells which depeneded by tgt: target cell
@@ -189,28 +257,18 @@ class XProgram:
         while idx < len(visited):
             it = visited[idx]
             params = []
-            for c in it.params:   # c is a ref,range,alias
+            for c in it.references():   # c is a ref,range,alias
                 # pp.pprint(tgt.ln, c)
-                if isinstance(c, Tuple):    # Alias or Ref
-                    if len(c[0]) == 0:        # Alias
-                        sheet, cellrange = self.sheetsRefer[""][c[1]]
-                    else:                     # Ref
-                        sheet, cellrange = c
-                else:                       # in sheet ref
-                    sheet, cellrange = it.sheet, c
-                # Added to a new list if it doesn't exist
-                ref = (sheet, cellrange)
+                if len(c[0]) == 0:        # Alias
+                    ref = self.sheetsRefer[""].get(c[1])
+                    if ref is None:
+                        continue
+                else:                     # Ref
+                    ref = c
                 # No duplications
                 if ref not in params:
                     params.append(ref)
 
-            # Debug - .txt is only available in debug mode
-            if it.txt:
-                print("ID:{:04d} TGT:{:06d}: TXT:{}".format(
-                    idx, tgt.ln, it.txt))
-            # else:
-            #  print("ID:{:04d} TGT:{:06d}: S:{} P:{} V:{}".format(idx, tgt.ln, it.syntax, it.params, it.values))
-
             # Loop all params
             for c in params:
                 self._ref_first_search(c, tgt.ln, visited)
@@ -220,15 +278,89 @@ class XProgram:
 
         return visited
 
+    def _live_cells(self, live: List[XFormula]) -> set:
+        """ All the `Tuple[sheet:str, cell:str]` read by `live` formulas, following Ref and Alias.
+        """
+        keep, seen = set(), set()
+        stack = [ref for fn in live for ref in fn.references()]
+        while stack:
+            ref = stack.pop()
+            if ref in seen:
+                continue
+            seen.add(ref)
+            sheet, cellrange = ref
+            if len(sheet) == 0:     # Alias
+                keep.add(ref)
+                if cellrange in self.sheetsRefer[""]:
+                    stack.append(self.sheetsRefer[""][cellrange])
+                continue
+            if sheet not in self.sheetsIndex:
+                continue
+            refs = self.sheetsRefer.get(sheet, {})
+            for x in self.sheetsIndex[sheet].cells(Utils.XRange(cellrange)):
+                keep.add((sheet, x))
+                if x in refs:
+                    stack.append(refs[x])
+        return keep
+
+    def prune(self) -> Dict[str, int]:
+        """ Remove the formulas, values and refers which no egress cell depends on,
+        the call trees are built first if needed. Every removed cell leaves a stub
+        `(kind, ln)` in `self.sheetsPruned`, kind is 'F'ormula, 'V'alue or 'R'efer.
+        Return the number of removed formulas, values, refers, cells and the bytes
+        held by the removed cells.
+        """
+        if not self.callflow:
+            self.build_call_trees()
+        live = {id(fn): fn for visited in self.callflow.values() for fn in visited}
+        keep = self._live_cells(list(live.values()))
+        rtn = {'formulas': 0, 'values': 0, 'refers': 0, 'cells': 0, 'bytes': 0}
+        seen: set = set()
+
+        def drop(kind: str, sheet: str, tgt: str, item, ln: int = 0):
+            self.sheetsPruned.setdefault(sheet, {})[tgt] = (kind, ln)
+            if sheet in self.sheetsIndex and tgt.find(':') < 0:
+                self.sheetsIndex[sheet].remove(tgt)
+            rtn['bytes'] += Utils.sizeof(item, seen)
+            rtn['cells'] += 1
+
+        for sheet, cells in self.sheetsExpr.items():
+            for tgt in [t for t, fn in cells.items() if id(fn) not in live]:
+                drop('F', sheet, tgt, cells[tgt], cells[tgt].ln)
+                del cells[tgt]
+                rtn['formulas'] += 1
+        for sheet in self.sheetsRange:
+            self.sheetsRange[sheet] = [r for r in self.sheetsRange[sheet] if id(r[2]) in live]
+        for sheet, values in self.sheetsValue.items():
+            if len(sheet) == 0:
+                continue
+            # values of a range are not indexed, they're kept
+            for tgt in [t for t in values if (sheet, t) not in keep and t.find(':') < 0]:
+                drop('V', sheet, tgt, values.pop(tgt))
+                rtn['values'] += 1
+        for sheet, refs in self.sheetsRefer.items():
+            for tgt in [t for t in refs if (sheet, t) not in keep and t.find(':') < 0]:
+                drop('R', sheet, tgt, refs.pop(tgt))
+                rtn['refers'] += 1
+        self.ingressCells = [fn for fn in self.ingressCells if id(fn) in live]
+        for attr in ('sheetsExpr', 'sheetsRange', 'sheetsValue', 'sheetsRefer', 'sheetsIndex'):
+            sheets = getattr(self, attr)
+            for sheet in [k for k, v in sheets.items() if len(k) and len(v) == 0]:
+                del sheets[sheet]
+        return rtn
+
     def build_call_trees(self):
         """ Build call trees by
         1, loop all the egressCells, build the dependencies cells from egress to all depended cells
         2, mark all the activate cells during the trace, merge the callflow for egressCells
         3, reverse the dependency trees to callflow
         """
+        if not self.refersResolved:
+            self.resolve_refers()
         dags: Dict = {}
         for tgt in self.egressCells:
             dags[tgt.ln] = self.breathfistsearch(tgt)
+        self.callflow = dags
 
         # Now all the ingressCells should record all the egress ln.
         # We do only group by
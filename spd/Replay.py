@@ -0,0 +1,214 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""Record/replay of tick streams through a compiled XProgram.
+
+A tick `(ts, ric, field, value)` updates the quote read by `RTGET`/`TR`, the
+formulas downstream of the matching ingress cells are invalidated and every
+affected egress cell is evaluated and written to the sink. The latency of one
+write is measured from the dispatch of its tick, all offline: `XFeed` stands
+for the market data feed and `XSink` for the downstream system.
+"""
+
+import csv
+import random
+import sys
+import time
+from typing import Callable, Dict, Iterable, List, NamedTuple, Tuple
+
+import numpy as np
+
+from .Evaluator import XEvaluator, to_value
+from .Formula import XFormula
+from .Graph import from_program
+from .PseudoCode import XProgram
+
+__all__ = ["XTick", "XFeed", "XSink", "XReplay",
+           "tick_keys", "synthetic_ticks", "save_ticks", "load_ticks"]
+
+# Functions which read the ticks
+TICK_FUNCS = ('RTGET', 'TR')
+
+
+class XTick(NamedTuple):
+    """ One market data update, `ts` is in seconds."""
+    ts: float
+    ric: str
+    field: str
+    value: object
+
+
+class XFeed:
+    """ Fake feed: the last value of every (ric, field), read by `RTGET`/`TR`."""
+
+    def __init__(self, quotes: Dict[Tuple[str, str], object] = None) -> None:
+        self.quotes: Dict[Tuple[str, str], object] = dict(quotes or {})
+
+    def update(self, tick: XTick):
+        self.quotes[(tick.ric, tick.field)] = tick.value
+
+    def get(self, ric, field, *args):
+        return self.quotes.get((ric, field))
+
+    def funcs(self) -> Dict[str, Callable]:
+        return {name: self.get for name in TICK_FUNCS}
+
+
+class XSink:
+    """ Fake sink: keep all the egress writes as List[Tuple[ln:int, value]]."""
+
+    def __init__(self) -> None:
+        self.writes: List[Tuple[int, object]] = []
+
+    def write(self, ln: int, value):
+        self.writes.append((ln, value))
+
+
+def tick_keys(fn: XFormula) -> List[Tuple[str, str]]:
+    """ (ric, field) read by the tick functions of `fn`, None for any tick
+    when the arguments are not constant.
+    """
+    keys = []
+    for ins in fn.syntax:
+        if not isinstance(ins[2], list) or ins[1].upper() not in TICK_FUNCS:
+            continue
+        args = ins[2][:2]
+        if len(args) < 2 or not all(isinstance(a, str) and a[0] == '#' for a in args):
+            return None
+        keys.append(tuple(fn.values[int(a[1:])] for a in args))
+    return keys
+
+
+class XReplay:
+    """ Replay ticks through a XProgram and measure tick-to-egress latency.
+
+    feed  -- XFeed, its `RTGET`/`TR` are installed into the evaluator
+    sink  -- anything with `write(ln, value)`
+    """
+
+    def __init__(self, prog: XProgram, feed: XFeed = None, sink=None,
+                 funcs: Dict[str, Callable] = None) -> None:
+        self.prog = prog
+        self.feed = feed if feed is not None else XFeed()
+        self.sink = sink if sink is not None else XSink()
+        self.ev = XEvaluator(prog, dict(funcs or {}, **self.feed.funcs()))
+        self.graph = from_program(prog)
+        fns = {fn.ln: fn for _, _, fn in prog.formulas()}
+        self._fns = [fns[int(ln)] for ln in self.graph.lines]
+        # (ric, field) => node ids of the ingress cells, `None` for any tick
+        self.keys: Dict[Tuple, List[int]] = {}
+        nodes = {fn.ln: i for i, fn in enumerate(self._fns)}
+        for fn in prog.ingressCells:
+            keys = tick_keys(fn)
+            for k in (keys if keys is not None else [None]):
+                self.keys.setdefault(k, []).append(nodes[fn.ln])
+        # (ric, field) => (lines to invalidate, egress XFormula to write)
+        self._affected: Dict[Tuple, Tuple[List[int], List[XFormula]]] = {}
+        # seconds from tick dispatch to every egress write
+        self.latencies: List[float] = []
+        self.ticks: int = 0
+
+    def affected(self, key: Tuple[str, str]) -> Tuple[List[int], List[XFormula]]:
+        """ Formulas downstream of the ingress cells reading `key`."""
+        if key not in self._affected:
+            sources = self.keys.get(key, []) + self.keys.get(None, [])
+            if sources:
+                reached = np.flatnonzero(self.graph.bfs(sources) >= 0)
+            else:
+                reached = []
+            fns = [self._fns[i] for i in reached]
+            self._affected[key] = ([fn.ln for fn in fns],
+                                   [fn for fn in fns if fn.egress()])
+        return self._affected[key]
+
+    def prime(self):
+        """ Evaluate all the egress cells once, nothing is written."""
+        self.ev.calculate()
+
+    def tick(self, tick: XTick):
+        """ Dispatch one tick and write the affected egress cells."""
+        t0 = time.perf_counter()
+        self.feed.update(tick)
+        lines, egress = self.affected((tick.ric, tick.field))
+        self.ev.invalidate(lines)
+        for fn in egress:
+            self.sink.write(fn.ln, self.ev.result(fn))
+            self.latencies.append(time.perf_counter() - t0)
+        self.ticks += 1
+
+    def run(self, ticks: Iterable[XTick], speed: float = None) -> Dict[str, float]:
+        """ Replay all the ticks and return the `report`.
+        By default ticks are sent as fast as possible, `speed` replays them at
+        `speed` times the recorded pace.
+        """
+        start = time.perf_counter()
+        first = None
+        for t in ticks:
+            if speed:
+                if first is None:
+                    first = t.ts
+                delay = (t.ts - first) / speed - (time.perf_counter() - start)
+                if delay > 0:
+                    time.sleep(delay)
+            self.tick(t)
+        return self.report(time.perf_counter() - start)
+
+    def report(self, elapsed: float) -> Dict[str, float]:
+        """ Latency percentiles in microseconds and throughput in ticks/s."""
+        lat = np.asarray(self.latencies, dtype=np.float64) * 1e6
+        rtn: Dict[str, float] = {'ticks': self.ticks, 'writes': len(lat),
+                                 'elapsed': elapsed,
+                                 'throughput': self.ticks / elapsed if elapsed > 0 else 0.0}
+        for name, q in (('p50', 50), ('p99', 99), ('p999', 99.9)):
+            rtn[name] = float(np.percentile(lat, q)) if len(lat) else 0.0
+        rtn['max'] = float(lat.max()) if len(lat) else 0.0
+        return rtn
+
+
+def synthetic_ticks(keys: List[Tuple[str, str]], count: int, rate: float = 1000.0,
+                    seed: int = 0) -> List[XTick]:
+    """ Random walk of `count` ticks over `keys`, `rate` ticks per second."""
+    rnd = random.Random(seed)
+    prices = {k: 100.0 for k in keys}
+    ticks = []
+    for i in range(count):
+        k = keys[rnd.randrange(len(keys))]
+        prices[k] = round(prices[k] * (1 + rnd.gauss(0, 0.001)), 4)
+        ticks.append(XTick(i / rate, k[0], k[1], prices[k]))
+    return ticks
+
+
+def save_ticks(ticks: Iterable[XTick], path: str):
+    """ Record the ticks as CSV: ts,ric,field,value."""
+    with open(path, 'w', newline='', encoding='utf-8') as f:
+        w = csv.writer(f)
+        for t in ticks:
+            w.writerow(t)
+
+
+def load_ticks(path: str) -> List[XTick]:
+    with open(path, 'r', newline='', encoding='utf-8') as f:
+        return [XTick(float(ts), ric, field, to_value(value)) for ts, ric, field, value in csv.reader(f)]
+
+
+if __name__ == '__main__':
+    # Replay synthetic or recorded ticks: [formula-file [ticks.csv]]
+    from .Compiler import compile_workbook, load_lines
+    from .Scheduler import synthetic
+
+    if len(sys.argv) > 1:
+        prog, _ = compile_workbook(sys.argv[1])
+    else:
+        prog = load_lines(synthetic(64, 20), keep_txt=False)
+    replay = XReplay(prog)
+    if len(sys.argv) > 2:
+        ticks = load_ticks(sys.argv[2])
+    else:
+        keys = sorted(k for k in replay.keys if k is not None) or [('X.N', 'BID')]
+        ticks = synthetic_ticks(keys, 10000)
+    replay.prime()
+    rtn = replay.run(ticks)
+    print(f"ticks:{rtn['ticks']} writes:{rtn['writes']} {rtn['throughput']:.0f} ticks/s  "
+          f"p50:{rtn['p50']:.1f}us p99:{rtn['p99']:.1f}us p999:{rtn['p999']:.1f}us max:{rtn['max']:.1f}us")
+
+# vim: noai:ts=4:sw=4:expandtab
@@ -0,0 +1,314 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""Parallel evaluation of a XProgram.
+
+Two ways to split the work:
+- by DAG: egress DAGs from `XProgram.build_call_trees` which don't share any cell
+  are evaluated in separated processes, this is the parallel mode;
+- by level: all the cells in one topological level are independent, each level
+  is split across a thread pool, levels run one after another. Pure Python
+  formulas hold the GIL, so threads only overlap functions which release it,
+  e.g. feeds waiting on I/O.
+Work is partitioned by the estimated cost of the cells; results don't depend on
+the number of workers, and everything falls back to serial evaluation when
+there's not enough work or no pool.
+
+`XRecalc` orders the recalculation after ticks instead: dirty egress cells are
+evaluated by priority, each one pulls its own cone of precedents.
+"""
+
+import heapq
+import multiprocessing
+import os
+import sys
+import time
+from collections import ChainMap
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+
+from .Engine import xlsActiveFuncs, xlsEgressFuncs, xlsEgressPriority
+from .Evaluator import XEvaluator
+from .Formula import XFormula
+from .Graph import from_program
+from .PseudoCode import XProgram
+
+__all__ = ["estimate_cost", "partition", "components", "egress_priority",
+           "XScheduler", "XRecalc"]
+
+
+def estimate_cost(fn: XFormula) -> int:
+    """Estimated cost of one XFormula: instructions + params, function calls weight more."""
+    cost = len(fn.params) + 1
+    for ins in fn.syntax:
+        if isinstance(ins[2], list):
+            cost += 50 if ins[1] in xlsActiveFuncs else 10
+        else:
+            cost += 1
+    return cost
+
+
+def partition(costs: List[int], parts: int) -> List[List[int]]:
+    """Split item indexes into `parts` groups of similar total cost.
+    Longest-processing-time first, ties are broken by index so it's deterministic.
+    """
+    parts = max(1, min(parts, len(costs)))
+    heap = [(0, p) for p in range(parts)]
+    groups: List[List[int]] = [[] for _ in range(parts)]
+    for i in sorted(range(len(costs)), key=lambda i: (-costs[i], i)):
+        total, p = heapq.heappop(heap)
+        groups[p].append(i)
+        heapq.heappush(heap, (total + costs[i], p))
+    return [sorted(g) for g in groups if g]
+
+
+def components(prog: XProgram) -> List[List[XFormula]]:
+    """Group the egress cells whose DAGs share any cell, using `prog.callflow`."""
+    if not prog.callflow:
+        prog.build_call_trees()
+    parent: Dict[int, int] = {}
+
+    def find(x: int) -> int:
+        while parent.setdefault(x, x) != x:
+            parent[x] = parent[parent[x]]
+            x = parent[x]
+        return x
+
+    owner: Dict[int, int] = {}
+    for ln, visited in prog.callflow.items():
+        find(ln)
+        for fn in visited:
+            if fn.ln in owner:
+                parent[find(ln)] = find(owner[fn.ln])
+            else:
+                owner[fn.ln] = ln
+    groups: Dict[int, List[XFormula]] = {}
+    for fn in prog.egressCells:
+        groups.setdefault(find(fn.ln), []).append(fn)
+    return [groups[k] for k in sorted(groups)]
+
+
+# Evaluator of a pool worker, set by `_init_worker` in the worker process only
+_worker: Optional[XEvaluator] = None
+
+
+def _init_worker(prog: XProgram, funcs: Optional[dict]) -> None:
+    global _worker
+    _worker = XEvaluator(prog, funcs)
+
+
+def _run_dags(lines: List[int]) -> Dict[int, object]:
+    cells = {fn.ln: fn for fn in _worker.prog.egressCells}
+    return {ln: _worker.result(cells[ln]) for ln in lines}
+
+
+class XScheduler:
+    """ Evaluate all the egress cells of a XProgram with a pool of workers.
+
+    mode    -- 'process' for disjoint DAGs, 'thread' for level by level
+    workers -- size of the pool, default to the number of CPUs
+    min_cost -- below this estimated cost the work is done serially
+    """
+
+    def __init__(self, prog: XProgram, funcs: Dict[str, Callable] = None,
+                 workers: int = None, mode: str = 'process', min_cost: int = 1000):
+        self.prog = prog
+        self.funcs = funcs
+        self.workers: int = workers or os.cpu_count() or 1
+        self.mode: str = mode
+        self.min_cost: int = min_cost
+        self.stats: Dict[str, int] = {'serial': 0, 'tasks': 0}
+
+    def serial(self) -> Dict[int, object]:
+        self.stats['serial'] += 1
+        return XEvaluator(self.prog, self.funcs).calculate()
+
+    def run(self) -> Dict[int, object]:
+        """ Evaluate and return {egress ln: value}, same as `XEvaluator.calculate`."""
+        if self.workers <= 1:
+            return self.serial()
+        if self.mode == 'thread':
+            return self.run_levels()
+        return self.run_dags()
+
+    def run_levels(self) -> Dict[int, object]:
+        """ Split every topological level across a thread pool.
+        Every task has its own XEvaluator over the results of the previous levels,
+        its results are merged once the level is done.
+        """
+        fns = [fn for _, _, fn in self.prog.formulas()]
+        costs = [estimate_cost(fn) for fn in fns]
+        if sum(costs) < self.min_cost:
+            return self.serial()
+        order, levels = from_program(self.prog).toposort()
+        results: Dict[int, object] = {}
+
+        def work(nodes) -> Dict[int, object]:
+            ev = XEvaluator(self.prog, self.funcs)
+            # read the previous levels, write its own dict only
+            ev.results = ChainMap({}, results)
+            for i in nodes:
+                ev.result(fns[i])
+            return ev.results.maps[0]
+
+        with ThreadPoolExecutor(self.workers) as pool:
+            for lv in range(int(levels.max()) + 1 if len(levels) else 0):
+                nodes = [int(i) for i in order[levels[order] == lv]]
+                groups = partition([costs[i] for i in nodes], self.workers)
+                self.stats['tasks'] += len(groups)
+                futures = [pool.submit(work, [nodes[k] for k in g]) for g in groups]
+                for f in futures:
+                    results.update(f.result())
+        # cells in loops and anything else left are done serially
+        ev = XEvaluator(self.prog, self.funcs)
+        ev.results.update(results)
+        return ev.calculate()
+
+    def run_dags(self) -> Dict[int, object]:
+        """ Evaluate groups of disjoint egress DAGs in a process pool."""
+        groups = components(self.prog)
+        costs = [sum(estimate_cost(fn) for e in g for fn in self.prog.callflow[e.ln])
+                 for g in groups]
+        if len(groups) <= 1 or sum(costs) < self.min_cost or \
+                'fork' not in multiprocessing.get_all_start_methods():
+            return self.serial()
+        tasks = [[e.ln for k in p for e in groups[k]]
+                 for p in partition(costs, self.workers)]
+        self.stats['tasks'] += len(tasks)
+        try:
+            ctx = multiprocessing.get_context('fork')
+            with ProcessPoolExecutor(len(tasks), mp_context=ctx, initializer=_init_worker,
+                                     initargs=(self.prog, self.funcs)) as pool:
+                parts = list(pool.map(_run_dags, tasks))
+        except OSError:
+            return self.serial()
+        rtn: Dict[int, object] = {}
+        for p in parts:
+            rtn.update(p)
+        return {fn.ln: rtn[fn.ln] for fn in self.prog.egressCells}
+
+
+def egress_priority(fn: XFormula, default: int = 100) -> int:
+    """Priority of the first egress function of `fn` in `Engine.xlsEgressPriority`."""
+    for ins in fn.syntax:
+        if isinstance(ins[2], list) and ins[1].upper() in xlsEgressFuncs:
+            return xlsEgressPriority.get(ins[1].upper(), default)
+    return default
+
+
+class XRecalc:
+    """ Recalculate the dirty egress cells, the lower priority number first.
+
+    priorities  -- {(sheet, cell): priority} of egress cells, default to `egress_priority`
+    deadlines  -- {priority: seconds} from `mark` to the evaluation of the egress cell
+    A precedent shared by several egress cells is evaluated with the most urgent one.
+    """
+
+    def __init__(self, prog: XProgram, funcs: Dict[str, Callable] = None,
+                 priorities: Dict[Tuple[str, str], int] = None,
+                 deadlines: Dict[int, float] = None,
+                 ev: XEvaluator = None, clock: Callable[[], float] = time.perf_counter):
+        if not prog.callflow:
+            prog.build_call_trees()
+        self.prog = prog
+        self.ev = ev if ev is not None else XEvaluator(prog, funcs)
+        self.deadlines: Dict[int, float] = deadlines or {}
+        self.clock = clock
+        self.graph = from_program(prog)
+        fns = {fn.ln: fn for _, _, fn in prog.formulas()}
+        self._fns = [fns[int(ln)] for ln in self.graph.lines]
+        self._nodes = {fn.ln: i for i, fn in enumerate(self._fns)}
+        # XFormula.ln => priority of the egress cells
+        self.priority: Dict[int, int] = {}
+        priorities = priorities or {}
+        for sheet, tgt, fn in prog.formulas():
+            if fn.egress():
+                self.priority[fn.ln] = priorities.get((sheet, tgt), egress_priority(fn))
+        self._egress = {fn.ln: fn for fn in prog.egressCells}
+        # heap of (priority, deadline, ln) of the dirty egress cells
+        self._heap: List[Tuple[int, float, int]] = []
+        self._dirty: set = set()
+        self.stats: Dict[str, int] = {'marked': 0, 'evaluated': 0, 'deferred': 0, 'missed': 0}
+
+    def pending(self) -> int:
+        return len(self._dirty)
+
+    def mark(self, lines: List[int]) -> int:
+        """ The formulas `lines` are changed: invalidate everything downstream and
+        queue the affected egress cells; return the most urgent priority queued.
+        """
+        nodes = [self._nodes[ln] for ln in lines if ln in self._nodes]
+        reached = np.flatnonzero(self.graph.bfs(nodes) >= 0) if nodes else []
+        fns = [self._fns[i] for i in reached]
+        self.ev.invalidate([fn.ln for fn in fns])
+        now, top = self.clock(), None
+        for fn in fns:
+            if not fn.egress():
+                continue
+            p = self.priority[fn.ln]
+            top = p if top is None else min(top, p)
+            if fn.ln in self._dirty:
+                continue
+            self._dirty.add(fn.ln)
+            deadline = now + self.deadlines[p] if p in self.deadlines else float('inf')
+            heapq.heappush(self._heap, (p, deadline, fn.ln))
+            self.stats['marked'] += 1
+        return top
+
+    def run(self, budget: float = None, defer: int = None) -> List[Tuple[int, object]]:
+        """ Evaluate the dirty egress cells by (priority, deadline), return [(ln, value)].
+        Once `budget` seconds are spent, cells with priority >= `defer` are left
+        dirty for the next run.
+        """
+        start, rtn, kept = self.clock(), [], []
+        while self._heap:
+            p, deadline, ln = heapq.heappop(self._heap)
+            if budget is not None and defer is not None and p >= defer and \
+                    self.clock() - start >= budget:
+                kept.append((p, deadline, ln))
+                self.stats['deferred'] += 1
+                continue
+            rtn.append((ln, self.ev.result(self._egress[ln])))
+            self._dirty.discard(ln)
+            self.stats['evaluated'] += 1
+            if self.clock() > deadline:
+                self.stats['missed'] += 1
+        for item in kept:
+            heapq.heappush(self._heap, item)
+        return rtn
+
+
+def synthetic(width: int, depth: int) -> List[str]:
+    """Lines of a wide graph: `width` disjoint chains of `depth` cells, one egress per chain."""
+    lines = []
+    for w in range(width):
+        s = f"'S{w}'"
+        lines.append(f"{s}!A1 @=RTGET(\"X{w}.N\", \"BID\")")
+        for d in range(2, depth + 1):
+            lines.append(f"{s}!A{d} @=A{d-1}*1.0001+A{d-1}^2/(1+A{d-1})-SUM(A1:A{d-1})/{d}")
+        lines.append(f"{s}!B1 @=OUTPUT(\"x\", A{depth})")
+    return lines
+
+
+if __name__ == '__main__':
+    # Speedup vs cores on a synthetic wide graph
+    from .Compiler import load_lines
+
+    width = int(sys.argv[1]) if len(sys.argv) > 1 else 64
+    depth = int(sys.argv[2]) if len(sys.argv) > 2 else 60
+    prog = load_lines(synthetic(width, depth), keep_txt=False)
+    prog.build_call_trees()
+    funcs = {'RTGET': lambda ric, field: 1.0}
+    base = None
+    for n in sorted({1, 2, 4, os.cpu_count() or 1}):
+        for mode in ('process', 'thread'):
+            t = time.perf_counter()
+            rtn = XScheduler(prog, funcs, n, mode).run()
+            t = time.perf_counter() - t
+            base = base or t
+            print(f"workers:{n:3d} mode:{mode:8s} {t*1000:9.1f}ms  speedup x{base/t:5.2f}  "
+                  f"egress:{len(rtn)}")
+
+# vim: noai:ts=4:sw=4:expandtab
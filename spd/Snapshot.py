@@ -0,0 +1,225 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""Versioned copy-on-write snapshots of a XProgram.
+
+Readers take `XVersioned.current()` and evaluate its program without any lock;
+a published program is frozen and never changes. A writer gets a `XCowProgram`
+over the current version: the top level dicts are copied, the dicts of one
+sheet are copied the first time the sheet is written, everything else (and the
+syntax/params/values of all XFormula) is shared with the previous version. The
+constant pool is copied, the constants of an aborted version are dropped.
+`commit` rebuilds the call trees and publishes the new version by swapping one
+reference, so readers never wait for a recompile.
+
+    with versioned.begin() as w:
+        compile_lines(lines, w.prog)
+    snap = versioned.current()
+"""
+
+import copy
+import threading
+from typing import Dict, List, NamedTuple, Set, Tuple
+
+from .Formula import XFormula
+from .PseudoCode import XProgram
+
+__all__ = ["XCowProgram", "XSnapshot", "XVersioned", "XWriter"]
+
+
+class XCowProgram(XProgram):
+    """ XProgram which copies the containers of the `base` before writing them."""
+
+    def __init__(self, base: XProgram) -> None:
+        self.__dict__.update(base.__dict__)
+        self.sheetsExpr = dict(base.sheetsExpr)
+        self.sheetsRange = dict(base.sheetsRange)
+        self.sheetsRefer = dict(base.sheetsRefer)
+        self.sheetsValue = dict(base.sheetsValue)
+        self.sheetsIndex = dict(base.sheetsIndex)
+        self.ingressCells = list(base.ingressCells)
+        self.egressCells = list(base.egressCells)
+        self.referLoops = list(base.referLoops)
+        self.callflow = dict(base.callflow)
+        self.dataPrepares = dict(base.dataPrepares)
+        self.sheetsPruned = {s: dict(v) for s, v in base.sheetsPruned.items()}
+        self.constants = base.constants.copy()
+        # (attribute, sheet) already copied by this version
+        self._owned: Set[Tuple[str, str]] = set()
+        # id of the XFormula added by this version, not shared with the base
+        self._added: Set[int] = set()
+        self._frozen: bool = False
+
+    def _own(self, attr: str, sheet: str):
+        if self._frozen:
+            raise RuntimeError("a published XProgram can't be changed")
+        if (attr, sheet) in self._owned:
+            return
+        self._owned.add((attr, sheet))
+        sheets = getattr(self, attr)
+        if sheet in sheets:
+            v = sheets[sheet]
+            sheets[sheet] = v.copy() if hasattr(v, 'copy') else list(v)
+
+    def _occupy(self, tgt: str, sheet: str):
+        self._own('sheetsIndex', sheet)
+        super()._occupy(tgt, sheet)
+
+    def add_refer(self, href: Tuple[str, str], tgt: str, sheet: str = ''):
+        self._own('sheetsRefer', sheet)
+        super().add_refer(href, tgt, sheet)
+
+    def add_value(self, value: str, tgt: str, sheet: str = ''):
+        self._own('sheetsValue', sheet)
+        super().add_value(value, tgt, sheet)
+
+    def add_formula(self, cell: XFormula, tgt: str, sheet: str = ''):
+        """ Add or replace the formula, the replaced one is dropped from all the lists."""
+        self._own('sheetsExpr', sheet)
+        self._own('sheetsRange', sheet)
+        old = self.sheetsExpr.get(sheet, {}).get(tgt)
+        if old is not None:
+            self.ingressCells = [fn for fn in self.ingressCells if fn is not old]
+            self.egressCells = [fn for fn in self.egressCells if fn is not old]
+            if sheet in self.sheetsRange:
+                self.sheetsRange[sheet] = [r for r in self.sheetsRange[sheet] if r[2] is not old]
+        self._added.add(id(cell))
+        super().add_formula(cell, tgt, sheet)
+
+    def resolve_refers(self):
+        for sheet in list(self.sheetsRefer):
+            self._own('sheetsRefer', sheet)
+        return super().resolve_refers()
+
+    def prune(self):
+        """ Same as `XProgram.prune`, the call trees are always rebuilt first."""
+        self.build_call_trees()
+        for attr in ('sheetsExpr', 'sheetsRange', 'sheetsValue', 'sheetsRefer', 'sheetsIndex'):
+            for sheet in list(getattr(self, attr)):
+                self._own(attr, sheet)
+        return super().prune()
+
+    def build_call_trees(self):
+        """ Same as `XProgram.build_call_trees`, but `XFormula.outputs` of the base are
+        kept: a formula of the base whose outputs change is replaced by a shallow copy,
+        and only the sheets holding one are copied.
+        """
+        if self._frozen:
+            raise RuntimeError("a published XProgram can't be changed")
+        if not self.refersResolved:
+            self.resolve_refers()
+        # same search as `breathfistsearch`, without writing the outputs
+        outputs: Dict[int, List[int]] = {}
+        dags: Dict[int, List[XFormula]] = {}
+        for tgt in self.egressCells:
+            visited, seen, idx = [tgt], set(), 0
+            while idx < len(visited):
+                params = []
+                for c in visited[idx].references():
+                    ref = self.sheetsRefer[""].get(c[1]) if len(c[0]) == 0 else c
+                    if ref is not None and ref not in params:
+                        params.append(ref)
+                for c in params:
+                    for fn in self._ref_formulas(c):
+                        if id(fn) not in seen:
+                            seen.add(id(fn))
+                            outputs.setdefault(id(fn), []).append(tgt.ln)
+                            visited.append(fn)
+                idx += 1
+            dags[tgt.ln] = visited
+
+        clones: Dict[int, XFormula] = {}
+        for sheet, tgt, fn in list(self.formulas()):
+            new = outputs.get(id(fn), [])
+            if new == fn.outputs:
+                continue
+            if id(fn) in self._added:
+                fn.outputs = new
+                continue
+            c = clones[id(fn)] = copy.copy(fn)
+            c.outputs = new
+            self._own('sheetsExpr', sheet)
+            self.sheetsExpr[sheet][tgt] = c
+            if tgt.find(':') >= 0:
+                self._own('sheetsRange', sheet)
+                self.sheetsRange[sheet] = [(a, b, clones.get(id(f), f)) for a, b, f in self.sheetsRange[sheet]]
+        if clones:
+            self.ingressCells = [clones.get(id(fn), fn) for fn in self.ingressCells]
+            self.egressCells = [clones.get(id(fn), fn) for fn in self.egressCells]
+            dags = {ln: [clones.get(id(fn), fn) for fn in visited] for ln, visited in dags.items()}
+        self.callflow = dags
+
+    def freeze(self) -> 'XCowProgram':
+        self._frozen = True
+        return self
+
+
+class XSnapshot(NamedTuple):
+    """ One published version, the program must not be changed."""
+    version: int
+    prog: XProgram
+
+
+class XWriter:
+    """ Build the next version, see `XVersioned.begin`."""
+
+    def __init__(self, owner: 'XVersioned', base: XSnapshot) -> None:
+        self.owner = owner
+        self.base = base
+        self.prog = XCowProgram(base.prog)
+        self.done: bool = False
+
+    def commit(self, build: bool = True) -> XSnapshot:
+        """ Publish the program as the next version, `build` runs `build_call_trees` first."""
+        try:
+            if build:
+                self.prog.build_call_trees()
+            snap = XSnapshot(self.base.version + 1, self.prog.freeze())
+            self.owner._current = snap
+            return snap
+        finally:
+            self.done = True
+            self.owner._lock.release()
+
+    def abort(self):
+        """ Drop the changes."""
+        self.done = True
+        self.owner._lock.release()
+
+    def __enter__(self) -> 'XWriter':
+        return self
+
+    def __exit__(self, kind, value, tb):
+        if self.done:
+            return
+        if kind is None:
+            self.commit()
+        else:
+            self.abort()
+
+
+class XVersioned:
+    """ The published version of a program, shared by readers and writers.
+
+    current  -- latest XSnapshot, never blocks
+    begin  -- XWriter of the next version, writers go one by one
+    """
+
+    def __init__(self, prog: XProgram = None) -> None:
+        self._current = XSnapshot(0, prog if prog is not None else XProgram())
+        self._lock = threading.Lock()
+
+    def current(self) -> XSnapshot:
+        return self._current
+
+    @property
+    def version(self) -> int:
+        return self._current.version
+
+    def begin(self, timeout: float = -1) -> XWriter:
+        """ Start the next version on top of the current one, wait for other writers."""
+        if not self._lock.acquire(timeout=timeout):
+            raise TimeoutError("another writer is building the next version")
+        return XWriter(self, self._current)
+
+# vim: noai:ts=4:sw=4:expandtab
@@ -0,0 +1,281 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""Disk-backed store for streaming compilation.
+
+The `XProgram` keeps all the XFormula in memory, which doesn't fit the
+largest workbooks. `XStore` spills finished formulas, refers, values and
+the dependency edges into a SQLite file, and walks the graph from there
+with a bounded formula cache.
+"""
+
+import pickle
+import sqlite3
+import sys
+from collections import OrderedDict
+from typing import Dict, Iterable, Iterator, List, Tuple
+
+from . import Compiler
+from . import Engine
+from . import Utils
+from .Formula import XFormula
+
+try:
+    import resource
+except ImportError:     # not available on Windows
+    resource = None
+
+__all__ = ["peak_rss", "compile_stream", "XStore"]
+
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS formulas (
+    ln INTEGER PRIMARY KEY, sheet TEXT, cell TEXT, type INTEGER, data BLOB);
+CREATE TABLE IF NOT EXISTS cells (
+    sheet TEXT, col INTEGER, row INTEGER, ln INTEGER,
+    PRIMARY KEY (sheet, col, row)) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS ranges (
+    sheet TEXT, left INTEGER, top INTEGER, right INTEGER, bottom INTEGER, ln INTEGER);
+CREATE INDEX IF NOT EXISTS ranges_sheet ON ranges (sheet, left);
+CREATE TABLE IF NOT EXISTS refers (
+    sheet TEXT, name TEXT, col INTEGER, row INTEGER, tsheet TEXT, trange TEXT,
+    PRIMARY KEY (sheet, name)) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS refers_pos ON refers (sheet, col, row);
+CREATE TABLE IF NOT EXISTS vals (
+    sheet TEXT, cell TEXT, value TEXT, PRIMARY KEY (sheet, cell)) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS edges (
+    ln INTEGER, egress INTEGER, PRIMARY KEY (ln, egress)) WITHOUT ROWID;
+"""
+
+
+def peak_rss() -> int:
+    """Return the peak resident set size of this process in bytes, 0 if unknown."""
+    if resource is None:
+        return 0
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports KiB, macOS reports bytes
+    return rss if sys.platform == 'darwin' else rss * 1024
+
+
+class XStore:
+    """ SQLite backed replacement of `XProgram` for the streaming compile mode.
+    Formulas are pickled into `formulas`; single cells are indexed by (sheet, col, row)
+    in `cells`, range formulas are in `ranges`. The `edges` table is the spilled form
+    of `XFormula.outputs`: one row per (formula ln, egress ln).
+    """
+
+    def __init__(self, path: str = ':memory:', memory_limit: int = 64 << 20):
+        self.db = sqlite3.connect(path)
+        self.db.executescript(_SCHEMA)
+        # ceiling of the formula cache in bytes of pickled data
+        self.memory_limit: int = memory_limit
+        self._cache: OrderedDict = OrderedDict()
+        self._cached: int = 0
+        # pending edges, flushed when the buffer is full
+        self._edges: List[Tuple[int, int]] = []
+        self.stats: Dict[str, int] = {'formulas': 0, 'refers': 0, 'values': 0,
+                                      'edges': 0, 'evicted': 0, 'peak_rss': 0}
+        # problems found by `compile_stream` as List[Compiler.XDiagnostic]
+        self.diagnostics: List = []
+
+    def close(self):
+        self.flush()
+        self.db.close()
+
+    def flush(self):
+        """ Write all the pending rows to disk."""
+        if self._edges:
+            self.db.executemany(
+                "INSERT OR IGNORE INTO edges VALUES (?, ?)", self._edges)
+            self._edges = []
+        self.db.commit()
+        self.stats['peak_rss'] = max(self.stats['peak_rss'], peak_rss())
+
+    # Same interface as XProgram
+
+    def add_refer(self, href: Tuple[str, str], tgt: str, sheet: str = ''):
+        """ Add alias (sheet '') and refer into the store."""
+        col, row = Utils.name_to_pos(tgt) if sheet else (0, 0)
+        self.db.execute("INSERT OR REPLACE INTO refers VALUES (?, ?, ?, ?, ?, ?)",
+                        (sheet, tgt, col, row, href[0], href[1]))
+        self.stats['refers'] += 1
+
+    def add_formula(self, cell: XFormula, tgt: str, sheet: str = ''):
+        """ Spill the formula, `Engine.evaluate_funcs` must be called before."""
+        self.db.execute("INSERT OR REPLACE INTO formulas VALUES (?, ?, ?, ?, ?)",
+                        (cell.ln, sheet, tgt, cell.type, pickle.dumps(cell, pickle.HIGHEST_PROTOCOL)))
+        head, _, tail = tgt.partition(':')
+        x1, y1 = Utils.name_to_pos(head)
+        if tail:
+            x2, y2 = Utils.name_to_pos(tail)
+            self.db.execute("INSERT INTO ranges VALUES (?, ?, ?, ?, ?, ?)",
+                            (sheet, min(x1, x2), min(y1, y2), max(x1, x2), max(y1, y2), cell.ln))
+        else:
+            self.db.execute("INSERT OR REPLACE INTO cells VALUES (?, ?, ?, ?)",
+                            (sheet, x1, y1, cell.ln))
+        self.stats['formulas'] += 1
+
+    def add_value(self, value: str, tgt: str, sheet: str = ''):
+        """ Add static value to the store."""
+        self.db.execute("INSERT OR REPLACE INTO vals VALUES (?, ?, ?)",
+                        (sheet, tgt, value))
+        self.stats['values'] += 1
+
+    # Read back
+
+    def formula(self, ln: int) -> XFormula:
+        """ Load one formula by line number through the bounded cache."""
+        if ln in self._cache:
+            self._cache.move_to_end(ln)
+            return self._cache[ln][0]
+        row = self.db.execute(
+            "SELECT data FROM formulas WHERE ln=?", (ln,)).fetchone()
+        if row is None:
+            return None
+        fn = pickle.loads(row[0])
+        self._cache[ln] = (fn, len(row[0]))
+        self._cached += len(row[0])
+        while self._cached > self.memory_limit and len(self._cache) > 1:
+            _, (_, size) = self._cache.popitem(last=False)
+            self._cached -= size
+            self.stats['evicted'] += 1
+        return fn
+
+    def egress(self) -> List[int]:
+        """ Line numbers of all the egress formulas."""
+        return [r[0] for r in self.db.execute(
+            "SELECT ln FROM formulas WHERE type & ? ORDER BY ln", (XFormula.CT_TARGET,))]
+
+    def ingress(self) -> List[int]:
+        """ Line numbers of all the ingress formulas."""
+        return [r[0] for r in self.db.execute(
+            "SELECT ln FROM formulas WHERE type & ? ORDER BY ln", (XFormula.CT_ACTIVE,))]
+
+    def outputs(self, ln: int) -> List[int]:
+        """ Same as `XFormula.outputs`: all the egress which depend on the formula."""
+        return [r[0] for r in self.db.execute(
+            "SELECT egress FROM edges WHERE ln=? ORDER BY egress", (ln,))]
+
+    def visited(self, egress: int) -> Iterator[int]:
+        """ All the formulas depended by the egress formula."""
+        for r in self.db.execute("SELECT ln FROM edges WHERE egress=?", (egress,)):
+            yield r[0]
+
+    # Graph walk
+
+    def _resolve(self, ref: Tuple[str, str], depth: int = 0) -> Iterator[int]:
+        """ Yield line numbers of the formulas covered by `ref`, refers are followed."""
+        sheet, cellrange = ref
+        if depth > 64:      # refer loop
+            return
+        if len(sheet) == 0:     # Alias
+            row = self.db.execute("SELECT tsheet, trange FROM refers WHERE sheet='' AND name=?",
+                                  (cellrange,)).fetchone()
+            if row:
+                yield from self._resolve(row, depth + 1)
+            return
+        head, _, tail = cellrange.partition(':')
+        x1, y1 = Utils.name_to_pos(head)
+        x2, y2 = Utils.name_to_pos(tail) if tail else (x1, y1)
+        x1, x2, y1, y2 = min(x1, x2), max(x1, x2), min(y1, y2), max(y1, y2)
+        box = (sheet, x2, x1, y2, y1)
+        for r in self.db.execute("SELECT ln FROM ranges WHERE sheet=? AND left<=? AND right>=? "
+                                 "AND top<=? AND bottom>=?", box):
+            yield r[0]
+        box = (sheet, x1, x2, y1, y2)
+        for r in self.db.execute("SELECT ln FROM cells WHERE sheet=? AND col BETWEEN ? AND ? "
+                                 "AND row BETWEEN ? AND ?", box).fetchall():
+            yield r[0]
+        for r in self.db.execute("SELECT tsheet, trange FROM refers WHERE sheet=? AND "
+                                 "col BETWEEN ? AND ? AND row BETWEEN ? AND ?", box).fetchall():
+            yield from self._resolve(r, depth + 1)
+
+    def breathfistsearch(self, egress: int) -> int:
+        """ Walk all the formulas depended by the `egress` line, spill the edges.
+        Only the line numbers are kept in memory, return the number of visited formulas.
+        """
+        visited, queue = {egress}, [egress]
+        while queue:
+            it = self.formula(queue.pop())
+            if it is None:
+                continue
+            for ref in it.references():
+                for ln in self._resolve(ref):
+                    if ln not in visited:
+                        visited.add(ln)
+                        queue.append(ln)
+                        self._edges.append((ln, egress))
+            if len(self._edges) >= 4096:
+                self.flush()
+        self.stats['edges'] += len(visited) - 1
+        return len(visited) - 1
+
+    def build_call_trees(self) -> Dict[int, int]:
+        """ Walk all egress formulas, return {egress ln: number of depended formulas}."""
+        dags = {ln: self.breathfistsearch(ln) for ln in self.egress()}
+        self.flush()
+        return dags
+
+
+def compile_stream(lines: Iterable[str], path: str = ':memory:',
+                   memory_limit: int = 64 << 20, keep_txt: bool = False) -> XStore:
+    """ Compile the lines into a `XStore` one sheet at a time.
+    Lines are expected to be grouped by sheet as `pxlsx.py` prints them, every time
+    the sheet changes the finished sheet is written to disk and dropped from memory.
+    Bad lines are skipped and reported in `XStore.diagnostics`.
+    """
+    store = XStore(path, memory_limit)
+    lexer, parser = Compiler.FormulaLexer(), Compiler.FormulaParser()
+    current, pending = None, []
+
+    def error(ln: int, line: str, e: Exception):
+        store.diagnostics.append(Compiler.XDiagnostic(ln, Compiler.D_ERROR, f"{type(e).__name__}: {e}", line))
+
+    def spill():
+        for ln, line, (kind, sheet, tgt, item) in pending:
+            try:
+                if kind == Compiler.LN_FORMULA:
+                    Engine.evaluate_funcs(item, item.txt)
+                    store.add_formula(item, tgt, sheet)
+                elif kind == Compiler.LN_VALUE:
+                    store.add_value(item, tgt, sheet)
+                else:
+                    store.add_refer(item, tgt, sheet)
+            except Exception as e:
+                error(ln, line, e)
+        pending.clear()
+        store.flush()
+
+    ln = 0
+    for line in lines:
+        ln += 1
+        line = line.strip()
+        if len(line) == 0 or line.startswith('//'):
+            continue
+        try:
+            parsed = Compiler.parse_line(lexer, parser, line, ln, keep_txt, store.diagnostics)
+        except Exception as e:
+            parser.__init__()
+            error(ln, line, e)
+            continue
+        if parsed is None:
+            continue
+        if parsed[1] != current:
+            spill()
+            current = parsed[1]
+        pending.append((ln, line, parsed))
+    spill()
+    return store
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print(f"Usage: {sys.argv[0]} <formula-file> [store.db]")
+        exit(-1)
+    with open(sys.argv[1], 'r', encoding='utf-8') as f:
+        st = compile_stream(f, sys.argv[2] if len(sys.argv) > 2 else ':memory:')
+    st.build_call_trees()
+    print(st.stats)
+    st.close()
+
+# vim: noai:ts=4:sw=4:expandtab
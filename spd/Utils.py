@@ -1,16 +1,29 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
-from typing import Tuple, Iterator
+from bisect import bisect_left, bisect_right
+from typing import Dict, List, Tuple, Iterator
 import math
+import sys
+
+import numpy as np
 
 __all__ = ["column_to_index",
            "index_to_column",
            "name_to_axis",
            "name_to_pos",
            "range_to_cells",
+           "columns_to_indexes",
+           "indexes_to_columns",
+           "names_to_pos",
+           "pos_to_names",
+           "iter_range",
+           "range_to_arrays",
            "XCell",
-           "XRange"]
+           "XRange",
+           "XRangeSet",
+           "XOccupancy",
+           "sizeof"]
 
 
 def column_to_index(col: str) -> int:
@@ -99,18 +112,10 @@ def name_to_pos(cell: str) -> Tuple[int, int]:
     return column_to_index(cell), i
 
 
-# Internal ranges
-_MOST_USED_COLUMNS = [
-    '',
-    'A', 'B', 'C', 'D', 'E', 'F', 'G', 'H', 'I', 'J', 'K', 'L', 'M',
-    'N', 'O', 'P', 'Q', 'R', 'S', 'T', 'U', 'V', 'W', 'X', 'Y', 'Z',
-    'AA', 'AB', 'AC', 'AD', 'AE', 'AF', 'AG', 'AH', 'AI', 'AJ', 'AK', 'AL', 'AM',
-    'AN', 'AO', 'AP', 'AQ', 'AR', 'AS', 'AT', 'AU', 'AV', 'AW', 'AX', 'AY', 'AZ',
-    'BA', 'BB', 'BC', 'BD', 'BE', 'BF', 'BG', 'BH', 'BI', 'BJ', 'BK', 'BL', 'BM',
-    'BN', 'BO', 'BP', 'BQ', 'BR', 'BS', 'BT', 'BU', 'BV', 'BW', 'BX', 'BY', 'BZ',
-    'CA', 'CB', 'CC', 'CD', 'CE', 'CF', 'CG', 'CH', 'CI', 'CJ', 'CK', 'CL', 'CM',
-    'CN', 'CO', 'CP', 'CQ', 'CR', 'CS', 'CT', 'CU', 'CV', 'CW', 'CX', 'CY', 'CZ'
-]
+# Internal table of all the columns: _COLUMNS[1] == 'A', _COLUMNS[16384] == 'XFD'
+MAX_COLUMN = 16384
+_COLUMNS = [''] + [index_to_column(i) for i in range(1, MAX_COLUMN + 1)]
+_COLUMN_TABLE = np.array(_COLUMNS)
 
 
 def range_to_cells(cellrange: str) -> Iterator:
@@ -127,15 +132,94 @@ def range_to_cells(cellrange: str) -> Iterator:
     right, bottom = name_to_pos(ab[1])
 
     for c in range(left, right+1):
-        if c < len(_MOST_USED_COLUMNS):
-            colume = _MOST_USED_COLUMNS[c]
-        else:
-            colume = index_to_column(c)
+        colume = _COLUMNS[c] if c <= MAX_COLUMN else index_to_column(c)
 
         for r in range(top, bottom+1):
             yield "{:s}{:d}".format(colume, r)
 
 
+def _as_codes(names) -> np.ndarray:
+    """Return the names as a matrix of character codes, one row per name."""
+    arr = np.asarray(names)
+    if arr.dtype.kind not in 'US':
+        arr = arr.astype('U')
+    arr = np.ascontiguousarray(arr.reshape(-1))
+    # UCS4 str is viewed as uint32, bytes as uint8
+    code = np.uint32 if arr.dtype.kind == 'U' else np.uint8
+    width = arr.dtype.itemsize // np.dtype(code).itemsize
+    return arr.view(code).reshape(len(arr), width)
+
+
+def names_to_pos(names) -> Tuple[np.ndarray, np.ndarray]:
+    """Batch version of `name_to_pos`.
+
+    e.g. ['A10', '$B$2'] to ([1, 2], [10, 2])
+
+    Parameters:
+      names (array_like): Cell names, str or bytes
+
+    Returns:
+      Tuple[np.ndarray, np.ndarray]: int64 arrays of columns and rows.
+    """
+    # one row per character position, only ASCII matters
+    mat = np.ascontiguousarray(_as_codes(names).T, dtype=np.uint8)
+    lval = (mat & 0xDF) - np.uint8(ord('A') - 1)
+    letter = (lval >= 1) & (lval <= 26)
+    dval = mat - np.uint8(ord('0'))
+    digit = dval <= 9
+    lval[~letter] = 0
+    dval[~digit] = 0
+    cols = np.zeros(mat.shape[1], dtype=np.int64)
+    rows = np.zeros(mat.shape[1], dtype=np.int64)
+    # Horner's method, all names at once
+    for i in range(mat.shape[0]):
+        if letter[i].any():
+            np.multiply(cols, 26, out=cols, where=letter[i])
+            cols += lval[i]
+        if digit[i].any():
+            np.multiply(rows, 10, out=rows, where=digit[i])
+            rows += dval[i]
+    return cols, rows
+
+
+def columns_to_indexes(cols) -> np.ndarray:
+    """Batch version of `column_to_index`, digits are ignored."""
+    return names_to_pos(cols)[0]
+
+
+def indexes_to_columns(nums) -> np.ndarray:
+    """Batch version of `index_to_column` by the precomputed column table."""
+    return _COLUMN_TABLE[np.clip(np.asarray(nums, dtype=np.int64), 1, MAX_COLUMN)]
+
+
+def pos_to_names(cols, rows) -> np.ndarray:
+    """From (col, row) arrays to cell names, e.g. ([1, 2], [10, 2]) to ['A10', 'B2']."""
+    return np.char.add(indexes_to_columns(cols), np.asarray(rows).astype(str))
+
+
+def iter_range(cellrange: str) -> Iterator[Tuple[int, int]]:
+    """Same order as `range_to_cells`, but yield (col, row) without building str.
+    e.g. A1:B2 -> [(1, 1), (1, 2), (2, 1), (2, 2)]
+    """
+    head, _, tail = cellrange.partition(':')
+    left, top = name_to_pos(head)
+    right, bottom = name_to_pos(tail) if tail else (left, top)
+    for c in range(left, right+1):
+        for r in range(top, bottom+1):
+            yield c, r
+
+
+def range_to_arrays(cellrange: str) -> Tuple[np.ndarray, np.ndarray]:
+    """Same order as `range_to_cells`, but return (cols, rows) index arrays."""
+    head, _, tail = cellrange.partition(':')
+    left, top = name_to_pos(head)
+    right, bottom = name_to_pos(tail) if tail else (left, top)
+    height = bottom - top + 1
+    cols = np.repeat(np.arange(left, right + 1, dtype=np.int64), height)
+    rows = np.tile(np.arange(top, bottom + 1, dtype=np.int64), right - left + 1)
+    return cols, rows
+
+
 class XCell:
     """A cell identified by (x,y) coordinates.
 
@@ -147,6 +231,8 @@ class XCell:
     clone  -- construct a duplicate
     """
 
+    __slots__ = ('x', 'y')
+
     def __init__(self, x: int = 0, y: int = 0) -> None:
         """Init with x, y."""
         self.x: int = x
@@ -218,13 +304,15 @@ class XRange:
 
     botom-right: XFD1048576
 
-    set_points  -- reset rectangle coordinates
+    from_bounds  -- construct from left, top, right, bottom
     contains  -- is a Cell inside?
-    overlaps  -- does a rectangle overlap?
+    overlaps  -- does a rectangle overlap? Boundaries are included
     top_left  -- get top-left corner
     bottom_right  -- get bottom-right corner
     """
 
+    __slots__ = ('left', 'top', 'right', 'bottom')
+
     def __init__(self, rg: str) -> None:
         """Initialize a excel range from string."""
         (head, _, tail) = rg.partition(':')
@@ -237,10 +325,28 @@ class XRange:
         self.right = max(x1, x2)
         self.bottom = max(y1, y2)
 
+    @staticmethod
+    def from_bounds(left: int, top: int, right: int, bottom: int):
+        """Create XRange from the coordinates, without parsing."""
+        rg = XRange.__new__(XRange)
+        rg.left, rg.top = min(left, right), min(top, bottom)
+        rg.right, rg.bottom = max(left, right), max(top, bottom)
+        return rg
+
     def as_tuple(self):
         """((x, y),(x2,y2))"""
         return (self.left, self.top), (self.right, self.bottom)
 
+    def bounds(self) -> Tuple[int, int, int, int]:
+        """(left, top, right, bottom)"""
+        return self.left, self.top, self.right, self.bottom
+
+    def __eq__(self, other) -> bool:
+        return isinstance(other, XRange) and self.bounds() == other.bounds()
+
+    def __hash__(self) -> int:
+        return hash(self.bounds())
+
     def contains(self, pt: XCell) -> bool:
         """Return true if a point is inside the rectangle."""
         x, y = pt.as_tuple()
@@ -248,9 +354,9 @@ class XRange:
                 self.top <= y <= self.bottom)
 
     def overlaps(self, other) -> bool:
-        """Return true if a rectangle overlaps this rectangle."""
-        return (self.right > other.left and self.left < other.right and
-                self.top < other.bottom and self.bottom > other.top)
+        """Return true if a rectangle shares any cell with this rectangle."""
+        return (self.left <= other.right and other.left <= self.right and
+                self.top <= other.bottom and other.top <= self.bottom)
 
     def top_left(self) -> XCell:
         """Return the top-left corner as a XCell."""
@@ -264,15 +370,319 @@ class XRange:
         """Return the total number of cells in this Range."""
         return (self.right - self.left + 1) * (self.bottom - self.top + 1)
 
-    @property
     def __str__(self) -> str:
         """Represent XRange as String."""
         return "<XRange (%s,%s)-(%s,%s)>" % (self.left, self.top, self.right, self.bottom)
 
+    def name(self) -> str:
+        """Return the range as Excel name, e.g. 'A1:B2', or 'A1' for one cell."""
+        head = f"{index_to_column(self.left)}{self.top}"
+        if self.left == self.right and self.top == self.bottom:
+            return head
+        return f"{head}:{index_to_column(self.right)}{self.bottom}"
+
     def __repr__(self) -> str:
         """Represent XRange as String."""
         return "%s(%r, %r)" % (self.__class__.__name__,
                                XCell(self.left, self.top),
                                XCell(self.right, self.bottom))
 
+
+Rect = Tuple[int, int, int, int]
+
+
+def _subtract(a: Rect, b: Rect) -> List[Rect]:
+    """Cells of rectangle `a` not in `b`, as at most 4 disjoint rectangles."""
+    l1, t1, r1, b1 = a
+    l2, t2, r2, b2 = b
+    if l2 > r1 or l1 > r2 or t2 > b1 or t1 > b2:
+        return [a]
+    rtn = []
+    if t1 < t2:             # band above
+        rtn.append((l1, t1, r1, t2 - 1))
+    if b2 < b1:             # band below
+        rtn.append((l1, b2 + 1, r1, b1))
+    top, bottom = max(t1, t2), min(b1, b2)
+    if l1 < l2:             # left of `b`, between the bands
+        rtn.append((l1, top, l2 - 1, bottom))
+    if r2 < r1:             # right of `b`
+        rtn.append((r2 + 1, top, r1, bottom))
+    return rtn
+
+
+def _coalesce(rects: List[Rect]) -> List[Rect]:
+    """Merge disjoint rectangles which share a whole edge, until nothing changes."""
+    while True:
+        n = len(rects)
+        for axis in (0, 1):
+            # vertical: same columns and touching rows; horizontal: the other way round
+            if axis == 0:
+                key, lo, hi = (lambda r: (r[0], r[2], r[1])), 1, 3
+            else:
+                key, lo, hi = (lambda r: (r[1], r[3], r[0])), 0, 2
+            merged: List[Rect] = []
+            for r in sorted(rects, key=key):
+                if merged:
+                    m = merged[-1]
+                    same = (m[0], m[2]) == (r[0], r[2]) if axis == 0 else (m[1], m[3]) == (r[1], r[3])
+                    if same and m[hi] + 1 == r[lo]:
+                        m = list(m)
+                        m[hi] = r[hi]
+                        merged[-1] = tuple(m)
+                        continue
+                merged.append(r)
+            rects = merged
+        if len(rects) == n:
+            return rects
+
+
+class XRangeSet:
+    """A set of cells kept as a few disjoint rectangles.
+
+    Rectangles which share a whole edge are coalesced, so a filled-down block
+    of millions of cells is one rectangle. All boundaries are included.
+
+    union (|), intersection (&), difference (-)  -- set algebra
+    contains  -- is a cell inside?
+    overlaps  -- does a range share any cell?
+    covers  -- is a whole range inside?
+    from_cells  -- build from cell names
+    """
+
+    __slots__ = ('rects',)
+
+    def __init__(self, ranges=()) -> None:
+        """Init with cell ranges: str 'A1:B2', XRange or (left, top, right, bottom)."""
+        rects: List[Rect] = []
+        for rg in ranges:
+            if isinstance(rg, str):
+                rg = XRange(rg)
+            r = rg.bounds() if isinstance(rg, XRange) else tuple(rg)
+            pieces = [r]
+            for o in rects:
+                pieces = [p for q in pieces for p in _subtract(q, o)]
+            rects.extend(pieces)
+        # List[Tuple[left, top, right, bottom]], disjoint
+        self.rects: List[Rect] = _coalesce(rects)
+
+    @staticmethod
+    def _of(rects: List[Rect]):
+        rtn = XRangeSet.__new__(XRangeSet)
+        rtn.rects = _coalesce(rects)
+        return rtn
+
+    @staticmethod
+    def from_cells(cells) -> 'XRangeSet':
+        """Build from cell names, runs of rows in every column are found at once."""
+        cols, rows = names_to_pos(cells)
+        if len(cols) == 0:
+            return XRangeSet()
+        order = np.lexsort((rows, cols))
+        cols, rows = cols[order], rows[order]
+        # a new run starts at another column or a gap of rows
+        start = np.ones(len(cols), dtype=bool)
+        start[1:] = (cols[1:] != cols[:-1]) | (rows[1:] > rows[:-1] + 1)
+        first = np.flatnonzero(start)
+        last = np.append(first[1:], len(cols)) - 1
+        rects = list(zip(cols[first].tolist(), rows[first].tolist(),
+                         cols[last].tolist(), rows[last].tolist()))
+        return XRangeSet._of(rects)
+
+    def __iter__(self) -> Iterator[XRange]:
+        return (XRange.from_bounds(*r) for r in self.rects)
+
+    def __len__(self) -> int:
+        """Number of cells."""
+        return sum((r[2] - r[0] + 1) * (r[3] - r[1] + 1) for r in self.rects)
+
+    def __bool__(self) -> bool:
+        return len(self.rects) > 0
+
+    def __or__(self, other) -> 'XRangeSet':
+        return self.union(other)
+
+    def __and__(self, other) -> 'XRangeSet':
+        return self.intersection(other)
+
+    def __sub__(self, other) -> 'XRangeSet':
+        return self.difference(other)
+
+    def __eq__(self, other) -> bool:
+        return isinstance(other, XRangeSet) and not (self - other) and not (other - self)
+
+    __hash__ = None
+
+    def union(self, other) -> 'XRangeSet':
+        rects = list(self.rects)
+        for r in XRangeSet._as_set(other).rects:
+            pieces = [r]
+            for o in self.rects:
+                pieces = [p for q in pieces for p in _subtract(q, o)]
+            rects.extend(pieces)
+        return XRangeSet._of(rects)
+
+    def intersection(self, other) -> 'XRangeSet':
+        rects = []
+        for a in self.rects:
+            for b in XRangeSet._as_set(other).rects:
+                lt = (max(a[0], b[0]), max(a[1], b[1]))
+                rb = (min(a[2], b[2]), min(a[3], b[3]))
+                if lt[0] <= rb[0] and lt[1] <= rb[1]:
+                    rects.append(lt + rb)
+        return XRangeSet._of(rects)
+
+    def difference(self, other) -> 'XRangeSet':
+        rects = list(self.rects)
+        for o in XRangeSet._as_set(other).rects:
+            rects = [p for q in rects for p in _subtract(q, o)]
+        return XRangeSet._of(rects)
+
+    @staticmethod
+    def _as_set(other) -> 'XRangeSet':
+        if isinstance(other, XRangeSet):
+            return other
+        return XRangeSet([other] if isinstance(other, (str, XRange)) else other)
+
+    def contains(self, cell) -> bool:
+        """Is the cell, as name, XCell or (x, y), inside?"""
+        if isinstance(cell, str):
+            x, y = name_to_pos(cell)
+        else:
+            x, y = cell.as_tuple() if isinstance(cell, XCell) else cell
+        return any(r[0] <= x <= r[2] and r[1] <= y <= r[3] for r in self.rects)
+
+    def overlaps(self, rg) -> bool:
+        """Does the range share any cell with the set?"""
+        return len(self.intersection(rg).rects) > 0
+
+    def covers(self, rg) -> bool:
+        """Is every cell of the range inside?"""
+        return not XRangeSet._as_set(rg).difference(self)
+
+    def __str__(self) -> str:
+        return ",".join(rg.name() for rg in sorted(self, key=lambda r: (r.left, r.top)))
+
+    def __repr__(self) -> str:
+        return "%s(%r)" % (self.__class__.__name__, str(self))
+
+
+class XOccupancy:
+    """Index of the populated cells of one sheet.
+
+    Rows are kept sorted per column, so the cells inside a XRange are found
+    by two binary searches per populated column instead of enumerating the range.
+
+    add  -- record a cell
+    remove  -- forget a cell
+    cells  -- populated cells inside a XRange
+    copy  -- independent index with the same cells
+    """
+
+    def __init__(self) -> None:
+        """Empty index."""
+        # sorted column IDs which have any populated cell
+        self.columns: List[int] = []
+        # column ID => sorted row IDs, and the cell names in the same order
+        self.rows: Dict[int, List[int]] = {}
+        self.names: Dict[int, List[str]] = {}
+
+    def __len__(self) -> int:
+        return sum(len(r) for r in self.rows.values())
+
+    def add(self, cell: str) -> None:
+        """Record the cell, e.g. 'B2', no duplications."""
+        x, y = name_to_pos(cell)
+        if x not in self.rows:
+            self.columns.insert(bisect_left(self.columns, x), x)
+            self.rows[x], self.names[x] = [], []
+        rows = self.rows[x]
+        i = bisect_left(rows, y)
+        if i < len(rows) and rows[i] == y:
+            self.names[x][i] = cell
+            return
+        rows.insert(i, y)
+        self.names[x].insert(i, cell)
+
+    def remove(self, cell: str) -> None:
+        """Forget the cell if it was recorded."""
+        x, y = name_to_pos(cell)
+        rows = self.rows.get(x, [])
+        i = bisect_left(rows, y)
+        if i < len(rows) and rows[i] == y:
+            del rows[i]
+            del self.names[x][i]
+            if len(rows) == 0:
+                del self.rows[x], self.names[x]
+                self.columns.remove(x)
+
+    def copy(self) -> 'XOccupancy':
+        rtn = XOccupancy()
+        rtn.columns = list(self.columns)
+        rtn.rows = {x: list(r) for x, r in self.rows.items()}
+        rtn.names = {x: list(n) for x, n in self.names.items()}
+        return rtn
+
+    def cells(self, rg: XRange) -> Iterator[str]:
+        """Yield the recorded cells inside `rg`, in the same order as `range_to_cells`."""
+        cols = self.columns
+        for i in range(bisect_left(cols, rg.left), bisect_right(cols, rg.right)):
+            x = cols[i]
+            rows = self.rows[x]
+            lo, hi = bisect_left(rows, rg.top), bisect_right(rows, rg.bottom)
+            yield from self.names[x][lo:hi]
+
+
+def sizeof(obj, seen: set = None) -> int:
+    """ Bytes of `obj` and everything it holds, objects in `seen` are skipped and
+    the visited ones are added into it.
+    """
+    if seen is None:
+        seen = set()
+    total = 0
+    stack = [obj]
+    while stack:
+        o = stack.pop()
+        if o is None or isinstance(o, bool) or id(o) in seen:
+            continue
+        seen.add(id(o))
+        total += sys.getsizeof(o)
+        if isinstance(o, dict):
+            stack.extend(o.keys())
+            stack.extend(o.values())
+        elif isinstance(o, (list, tuple, set, frozenset)):
+            stack.extend(o)
+        elif isinstance(o, (str, bytes, int, float, np.ndarray)):
+            pass
+        else:
+            if hasattr(o, '__dict__'):
+                stack.append(vars(o))
+            for k in getattr(type(o), '__slots__', ()):
+                stack.append(getattr(o, k, None))
+    return total
+
+
+#############################################################################
+if __name__ == '__main__':
+    # Microbenchmark: batch functions vs scalar functions
+    import timeit
+
+    N = 100000
+    names = [f"{_COLUMNS[1 + i * 7 % MAX_COLUMN]}{1 + i * 13 % 1048576}" for i in range(N)]
+    arr = np.array(names)
+    cols, rows = names_to_pos(arr)
+    cases = (
+        ("name_to_pos", lambda: [name_to_pos(n) for n in names],
+         lambda: names_to_pos(arr)),
+        ("column_to_index", lambda: [column_to_index(n) for n in names],
+         lambda: columns_to_indexes(arr)),
+        ("index_to_column", lambda: [index_to_column(c) for c in cols.tolist()],
+         lambda: indexes_to_columns(cols)),
+        ("range_to_cells", lambda: [name_to_pos(c) for c in range_to_cells('A1:CV1000')],
+         lambda: range_to_arrays('A1:CV1000')),
+    )
+    for name, scalar, batch in cases:
+        ts = min(timeit.repeat(scalar, number=1, repeat=3))
+        tb = min(timeit.repeat(batch, number=1, repeat=3))
+        print(f"{name:16s} scalar:{ts*1000:9.2f}ms  batch:{tb*1000:8.2f}ms  x{ts/tb:6.1f}")
+
 # vim: noai:ts=4:sw=4:expandtab
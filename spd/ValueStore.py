@@ -0,0 +1,374 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""Columnar value store in shared memory.
+
+Every sheet is a dense block over its used extent, stored column by column in
+one `multiprocessing.shared_memory` segment, or for a sparse sheet only the
+TILE blocks holding used cells, back to back in one segment:
+  num  -- float64, the number, or the offset of the string in the arena
+  kind -- uint8, one of K_EMPTY, K_NUMBER, K_BOOL, K_STRING, K_ERROR
+  size -- uint32, byte length of the string
+Strings live in one shared append-only arena, so a worker process attached by
+`XValueStore.attach(store.spec())` reads and writes cells without pickling.
+"""
+
+import multiprocessing
+from multiprocessing import resource_tracker, shared_memory
+from typing import Dict, List, Tuple
+
+import numpy as np
+
+from . import Utils
+from .Evaluator import XEvaluator, to_value
+from .PseudoCode import XProgram
+
+__all__ = ["K_EMPTY", "K_NUMBER", "K_BOOL", "K_STRING", "K_ERROR",
+           "XSheetStore", "XTiledSheetStore", "XValueStore"]
+
+K_EMPTY = 0
+K_NUMBER = 1
+K_BOOL = 2
+K_STRING = 3
+K_ERROR = 4
+
+# Excel error values are kept as K_ERROR
+ERRORS = {'#DIV/0!', '#VALUE!', '#NAME?', '#REF!', '#N/A', '#NUM!', '#NULL!'}
+
+# Bytes of a cell: num, size and kind
+CELL = 13
+# Columns and rows of a block of a sparse sheet
+TILE = (16, 1024)
+# Default limit of `XValueStore.from_program`
+MAX_BYTES = 1 << 32
+
+
+def _attach(name: str, size: int, create: bool) -> shared_memory.SharedMemory:
+    if create:
+        return shared_memory.SharedMemory(create=True, size=max(size, 1))
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        # before 3.13 attaching registers the segment, the resource tracker of a
+        # process started with spawn would unlink it when that process exits
+        shm = shared_memory.SharedMemory(name=name)
+        resource_tracker.unregister(shm._name, 'shared_memory')
+        return shm
+
+
+class XSheetStore:
+    """ Values of one sheet over the box (left, top)-(right, bottom).
+
+    buf  -- memory of a block of XTiledSheetStore, instead of a segment of its own
+    """
+
+    def __init__(self, box: Tuple[int, int, int, int], arena, shm: str = None,
+                 buf: memoryview = None) -> None:
+        self.left, self.top, self.right, self.bottom = box
+        self.arena = arena
+        cols, rows = self.right - self.left + 1, self.bottom - self.top + 1
+        n = cols * rows
+        self.shm = None
+        self.buf = buf
+        if buf is None:
+            self.shm = _attach(shm, n * CELL, shm is None)
+            buf = self.shm.buf
+        self.num = np.ndarray((cols, rows), dtype=np.float64, buffer=buf)
+        self.size = np.ndarray((cols, rows), dtype=np.uint32, buffer=buf, offset=n * 8)
+        self.kind = np.ndarray((cols, rows), dtype=np.uint8, buffer=buf, offset=n * 12)
+        if shm is None and self.buf is None:
+            self.kind[:] = K_EMPTY
+
+    def spec(self) -> Tuple:
+        return (self.left, self.top, self.right, self.bottom), self.shm.name
+
+    def _index(self, x: int, y: int) -> Tuple[int, int]:
+        if not (self.left <= x <= self.right and self.top <= y <= self.bottom):
+            raise IndexError(f"({x}, {y}) is out of the sheet")
+        return x - self.left, y - self.top
+
+    def get(self, x: int, y: int):
+        """ Python value of the cell at column `x` and row `y`, None if empty."""
+        if not (self.left <= x <= self.right and self.top <= y <= self.bottom):
+            return None
+        i, j = x - self.left, y - self.top
+        return self._decode(self.kind[i, j], self.num[i, j], self.size[i, j])
+
+    def _decode(self, k, v, n):
+        if k == K_NUMBER:
+            return int(v) if v.is_integer() and abs(v) < 2 ** 53 else float(v)
+        if k == K_BOOL:
+            return bool(v)
+        if k in (K_STRING, K_ERROR):
+            return self.arena.read(int(v), int(n))
+        return None
+
+    def set(self, x: int, y: int, value) -> None:
+        """ Write the Python value into the cell."""
+        i, j = self._index(x, y)
+        if value is None:
+            self.kind[i, j] = K_EMPTY
+        elif isinstance(value, bool):
+            self.num[i, j], self.kind[i, j] = float(value), K_BOOL
+        elif isinstance(value, (int, float)):
+            self.num[i, j], self.kind[i, j] = float(value), K_NUMBER
+        else:
+            value = str(value)
+            off, n = self.arena.write(value)
+            self.num[i, j], self.size[i, j] = off, n
+            self.kind[i, j] = K_ERROR if value in ERRORS else K_STRING
+
+    def read(self, rg: Utils.XRange) -> Tuple[np.ndarray, np.ndarray]:
+        """ Zero-copy (num, kind) views of the range clipped to the sheet, indexed [col, row]."""
+        c0, c1 = max(rg.left, self.left) - self.left, min(rg.right, self.right) - self.left + 1
+        r0, r1 = max(rg.top, self.top) - self.top, min(rg.bottom, self.bottom) - self.top + 1
+        c1, r1 = max(c0, c1), max(r0, r1)
+        return self.num[c0:c1, r0:r1], self.kind[c0:c1, r0:r1]
+
+    def values(self, rg: Utils.XRange) -> List[List]:
+        """ The range as list of rows, same as `XEvaluator.fetch`."""
+        return [[self.get(x, y) for x in range(rg.left, rg.right + 1)]
+                for y in range(rg.top, rg.bottom + 1)]
+
+    def close(self):
+        # drop the views before closing the segment
+        self.num = self.size = self.kind = None
+        if self.buf is not None:
+            self.buf.release()
+            self.buf = None
+        if self.shm is not None:
+            self.shm.close()
+
+
+class XTiledSheetStore:
+    """ Values of a sparse sheet, `tiles` are the (column, row) numbers of the
+    TILE blocks holding used cells; the other cells are empty and read-only.
+    """
+
+    def __init__(self, tiles: List[Tuple[int, int]], arena, shm: str = None) -> None:
+        self.arena = arena
+        self.tiles = [tuple(t) for t in tiles]
+        cols, rows = TILE
+        n = cols * rows * CELL
+        # a new segment is zero filled, K_EMPTY everywhere
+        self.shm = _attach(shm, len(self.tiles) * n, shm is None)
+        self.blocks: Dict[Tuple[int, int], XSheetStore] = {}
+        for i, (tx, ty) in enumerate(self.tiles):
+            box = (tx * cols + 1, ty * rows + 1, (tx + 1) * cols, (ty + 1) * rows)
+            self.blocks[tx, ty] = XSheetStore(box, arena, buf=self.shm.buf[i * n:(i + 1) * n])
+
+    def spec(self) -> Tuple:
+        return self.tiles, self.shm.name
+
+    def _block(self, x: int, y: int) -> XSheetStore:
+        return self.blocks.get(((x - 1) // TILE[0], (y - 1) // TILE[1]))
+
+    def get(self, x: int, y: int):
+        """ Python value of the cell at column `x` and row `y`, None if empty."""
+        b = self._block(x, y)
+        return b.get(x, y) if b is not None else None
+
+    def set(self, x: int, y: int, value) -> None:
+        """ Write the Python value into the cell."""
+        b = self._block(x, y)
+        if b is None:
+            raise IndexError(f"({x}, {y}) is out of the used blocks of the sheet")
+        b.set(x, y, value)
+
+    def read(self, rg: Utils.XRange) -> Tuple[np.ndarray, np.ndarray]:
+        """ (num, kind) of the range clipped to the used blocks, indexed [col, row]:
+        zero-copy views within one block, a copy across blocks.
+        """
+        hit = [b for b in self.blocks.values()
+               if b.left <= rg.right and rg.left <= b.right and b.top <= rg.bottom and rg.top <= b.bottom]
+        if len(hit) == 1:
+            return hit[0].read(rg)
+        if not hit:
+            return np.zeros((0, 0), dtype=np.float64), np.zeros((0, 0), dtype=np.uint8)
+        left, top = max(rg.left, min(b.left for b in hit)), max(rg.top, min(b.top for b in hit))
+        right, bottom = min(rg.right, max(b.right for b in hit)), min(rg.bottom, max(b.bottom for b in hit))
+        num = np.zeros((right - left + 1, bottom - top + 1), dtype=np.float64)
+        kind = np.zeros(num.shape, dtype=np.uint8)
+        for b in hit:
+            i, j = max(rg.left, b.left) - left, max(rg.top, b.top) - top
+            bn, bk = b.read(rg)
+            num[i:i + bn.shape[0], j:j + bn.shape[1]] = bn
+            kind[i:i + bk.shape[0], j:j + bk.shape[1]] = bk
+        return num, kind
+
+    def values(self, rg: Utils.XRange) -> List[List]:
+        """ The range as list of rows, same as `XEvaluator.fetch`."""
+        return [[self.get(x, y) for x in range(rg.left, rg.right + 1)]
+                for y in range(rg.top, rg.bottom + 1)]
+
+    def close(self):
+        for b in self.blocks.values():
+            b.close()
+        self.blocks = {}
+        self.shm.close()
+
+
+def _layout(sheet: str, cells: Dict[int, List[int]], ranges: List, max_bytes: int):
+    """ Box of a dense sheet, or list of tiles of a sparse one, and its size in bytes."""
+    cols, rows = TILE
+    x1 = min([x for x in cells] + [r[0][0] for r in ranges])
+    y1 = min([ys[0] for ys in cells.values()] + [r[0][1] for r in ranges])
+    x2 = max([x for x in cells] + [r[1][0] for r in ranges])
+    y2 = max([ys[-1] for ys in cells.values()] + [r[1][1] for r in ranges])
+    dense = (x2 - x1 + 1) * (y2 - y1 + 1) * CELL
+    # a sheet that fits in a few blocks stays dense
+    if dense <= 4 * cols * rows * CELL:
+        return (x1, y1, x2, y2), dense
+    tiles = set()
+    for x, ys in cells.items():
+        tiles.update(((x - 1) // cols, ty) for ty in np.unique((np.asarray(ys) - 1) // rows).tolist())
+    for (rx1, ry1), (rx2, ry2), _ in ranges:
+        tx1, ty1, tx2, ty2 = (rx1 - 1) // cols, (ry1 - 1) // rows, (rx2 - 1) // cols, (ry2 - 1) // rows
+        if (tx2 - tx1 + 1) * (ty2 - ty1 + 1) * cols * rows * CELL > max_bytes:
+            raise MemoryError(f"the ranges of sheet '{sheet}' need more than {max_bytes} bytes")
+        tiles.update((tx, ty) for tx in range(tx1, tx2 + 1) for ty in range(ty1, ty2 + 1))
+    tiled = len(tiles) * cols * rows * CELL
+    if dense <= tiled:
+        return (x1, y1, x2, y2), dense
+    return sorted(tiles), tiled
+
+
+class XArena:
+    """ Append-only shared bytes for strings, the first 8 bytes are the used size."""
+
+    def __init__(self, capacity: int = 1 << 20, shm: str = None, lock=None) -> None:
+        self.shm = _attach(shm, capacity + 8, shm is None)
+        self.used = np.ndarray((1,), dtype=np.uint64, buffer=self.shm.buf)
+        if shm is None:
+            self.used[0] = 0
+        self.lock = lock if lock is not None else multiprocessing.Lock()
+        # strings written or read by this process: str => (offset, size)
+        self._seen: Dict[str, Tuple[int, int]] = {}
+
+    def write(self, value: str) -> Tuple[int, int]:
+        if value in self._seen:
+            return self._seen[value]
+        data = value.encode('utf-8')
+        with self.lock:
+            off = int(self.used[0])
+            if off + len(data) > self.shm.size - 8:
+                raise MemoryError("string arena is full")
+            self.shm.buf[8 + off:8 + off + len(data)] = data
+            self.used[0] = off + len(data)
+        self._seen[value] = (off, len(data))
+        return off, len(data)
+
+    def read(self, off: int, n: int) -> str:
+        return bytes(self.shm.buf[8 + off:8 + off + n]).decode('utf-8')
+
+    def close(self):
+        self.used = None
+        self.shm.close()
+
+
+class XValueStore:
+    """ All the sheets of a program in shared memory.
+
+    spec  -- picklable description to `attach` from another process
+    close  -- release the mapping of this process
+    unlink  -- destroy the segments, by the creator only
+    """
+
+    def __init__(self, boxes: Dict[str, Tuple[int, int, int, int]] = None,
+                 capacity: int = 1 << 20, spec: Dict = None, lock=None) -> None:
+        self.owner: bool = spec is None
+        # a box is a tuple, the blocks of a sparse sheet a list
+        if spec is None:
+            self.arena = XArena(capacity, lock=lock)
+            self.sheets = {s: XTiledSheetStore(b, self.arena) if isinstance(b, list) else XSheetStore(b, self.arena)
+                           for s, b in (boxes or {}).items()}
+        else:
+            self.arena = XArena(shm=spec['arena'], lock=lock)
+            self.sheets = {s: XTiledSheetStore(b, self.arena, name) if isinstance(b, list)
+                           else XSheetStore(b, self.arena, name)
+                           for s, (b, name) in spec['sheets'].items()}
+
+    def spec(self) -> Dict:
+        return {'arena': self.arena.shm.name,
+                'sheets': {s: st.spec() for s, st in self.sheets.items()}}
+
+    @staticmethod
+    def attach(spec: Dict, lock=None):
+        """ Map the store created by another process, `lock` should be the creator's
+        `store.arena.lock` when strings are written from more than one process."""
+        return XValueStore(spec=spec, lock=lock)
+
+    @staticmethod
+    def from_program(prog: XProgram, capacity: int = 1 << 20, max_bytes: int = MAX_BYTES):
+        """ Create the store over the used extent of every sheet and load the static values,
+        MemoryError if the sheets need more than `max_bytes`.
+        """
+        # a static value over a range fills all its cells, and isn't in sheetsIndex
+        filled: Dict[str, List] = {}
+        for sheet, values in prog.sheetsValue.items():
+            for tgt in values:
+                if len(sheet) and tgt.find(':') >= 0:
+                    a, b = tgt.split(':')
+                    filled.setdefault(sheet, []).append((Utils.name_to_pos(a), Utils.name_to_pos(b), None))
+        boxes: Dict = {}
+        total = 0
+        for sheet in dict.fromkeys(list(prog.sheetsIndex) + list(prog.sheetsRange) + list(filled)):
+            idx = prog.sheetsIndex.get(sheet)
+            cells = {x: idx.rows[x] for x in idx.columns if len(idx.rows[x])} if idx is not None else {}
+            ranges = prog.sheetsRange.get(sheet, []) + filled.get(sheet, [])
+            if not cells and not ranges:
+                continue
+            boxes[sheet], n = _layout(sheet, cells, ranges, max_bytes)
+            total += n
+            if total > max_bytes:
+                raise MemoryError(f"the value store needs more than {max_bytes} bytes, at sheet '{sheet}'")
+        store = XValueStore(boxes, capacity)
+        try:
+            for sheet, values in prog.sheetsValue.items():
+                st = store.sheets.get(sheet)
+                if st is None:
+                    continue
+                for tgt, v in values.items():
+                    v = to_value(v)
+                    for x, y in Utils.iter_range(tgt):
+                        st.set(x, y, v)
+        except BaseException:
+            store.unlink()
+            raise
+        return store
+
+    def get(self, sheet: str, cell: str):
+        st = self.sheets.get(sheet)
+        return st.get(*Utils.name_to_pos(cell)) if st else None
+
+    def set(self, sheet: str, cell: str, value) -> None:
+        self.sheets[sheet].set(*Utils.name_to_pos(cell), value)
+
+    def read(self, sheet: str, cellrange: str) -> Tuple[np.ndarray, np.ndarray]:
+        return self.sheets[sheet].read(Utils.XRange(cellrange))
+
+    def update(self, ev: XEvaluator) -> int:
+        """ Write all the evaluated single cell formulas of `ev`, return the count."""
+        n = 0
+        for sheet, tgt, fn in ev.prog.formulas():
+            if fn.ln in ev.results and tgt.find(':') < 0:
+                self.set(sheet, tgt, ev.results[fn.ln])
+                n += 1
+        return n
+
+    def close(self):
+        for st in self.sheets.values():
+            st.close()
+        self.arena.close()
+
+    def unlink(self):
+        """ Close and destroy all the segments."""
+        names = [st.shm for st in self.sheets.values()] + [self.arena.shm]
+        self.close()
+        if self.owner:
+            for shm in names:
+                # an attach in this process, or one sharing its tracker, unregistered it
+                resource_tracker.register(shm._name, 'shared_memory')
+                shm.unlink()
+
+# vim: noai:ts=4:sw=4:expandtab
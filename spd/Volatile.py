@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""Time buckets of the volatile functions TODAY and NOW.
+
+The clock is cut into buckets of a configurable size: TODAY changes at the day
+boundary, NOW every `granularity['NOW']` seconds. Both functions return the
+start of the bucket seen by the last `tick`, so the results are stable within
+one bucket; `tick` invalidates the formulas calling a function and everything
+downstream only when the bucket of that function moves.
+"""
+
+import datetime
+from typing import Callable, Dict, List
+
+import numpy as np
+
+from .Evaluator import XEvaluator, _serial
+from .Graph import from_program
+
+__all__ = ["GRANULARITY", "XVolatile"]
+
+# Default bucket size in seconds
+GRANULARITY: Dict[str, float] = {'TODAY': 86400.0, 'NOW': 1.0}
+
+
+class XVolatile:
+    """ TODAY/NOW installed into one XEvaluator.
+
+    granularity  -- {function: seconds}, TODAY is always on the day boundary
+    clock  -- local `datetime.datetime` now
+    recalc  -- `Scheduler.XRecalc` to `mark` the changed formulas, instead of
+               invalidating them in the evaluator
+    """
+
+    def __init__(self, ev: XEvaluator, granularity: Dict[str, float] = None,
+                 clock: Callable[[], datetime.datetime] = datetime.datetime.now,
+                 recalc=None) -> None:
+        self.ev = ev
+        self.granularity: Dict[str, float] = dict(GRANULARITY, **(granularity or {}))
+        self.granularity['TODAY'] = 86400.0
+        self.clock = clock
+        self.recalc = recalc
+        # function => ln of the formulas calling it
+        self.users: Dict[str, List[int]] = {name: [] for name in self.granularity}
+        for _, _, fn in ev.prog.formulas():
+            called = {ins[1].upper() for ins in fn.syntax if isinstance(ins[2], list)}
+            for name in called & self.users.keys():
+                self.users[name].append(fn.ln)
+        self.graph = None
+        # function => current bucket, as number of buckets since 1899-12-30
+        self.buckets: Dict[str, int] = {}
+        self.stats: Dict[str, int] = {'ticks': 0, 'changes': 0, 'invalidated': 0}
+        self.tick()
+        ev.funcs['TODAY'] = self.today
+        ev.funcs['NOW'] = self.now
+
+    def _value(self, name: str) -> float:
+        """ Excel serial number of the start of the current bucket."""
+        return self.buckets[name] * self.granularity[name] / 86400.0
+
+    def today(self) -> float:
+        return self._value('TODAY')
+
+    def now(self) -> float:
+        return self._value('NOW')
+
+    def _downstream(self, lines: List[int]) -> List[int]:
+        if self.graph is None:
+            self.graph = from_program(self.ev.prog)
+            self._nodes = {int(ln): i for i, ln in enumerate(self.graph.lines)}
+        nodes = [self._nodes[ln] for ln in lines if ln in self._nodes]
+        return [int(ln) for ln in self.graph.lines[self.graph.bfs(nodes) >= 0]] if nodes else []
+
+    def tick(self, t: datetime.datetime = None) -> List[int]:
+        """ Move the buckets to the time `t` (default to the clock), return the
+        ln of the formulas whose function changed its bucket.
+        """
+        serial = _serial(t if t is not None else self.clock())
+        changed: List[int] = []
+        for name, g in self.granularity.items():
+            b = int(np.floor(serial * 86400.0 / g + 1e-9))
+            if self.buckets.get(name) == b:
+                continue
+            if name in self.buckets:
+                self.stats['changes'] += 1
+                changed.extend(self.users[name])
+            self.buckets[name] = b
+        self.stats['ticks'] += 1
+        if changed:
+            if self.recalc is not None:
+                self.recalc.mark(changed)
+            else:
+                lines = self._downstream(changed)
+                self.ev.invalidate(lines)
+                self.stats['invalidated'] += len(lines)
+        return changed
+
+# vim: noai:ts=4:sw=4:expandtab
@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+from spd import CodeGen
+from spd.Compiler import load_lines
+from spd.Evaluator import XEvaluator
+from tests.fixtures import FORMULAS as LINES
+
+FUNCS = {'RTGET': lambda ric, field: 10, 'TR': lambda ric, field: 99}
+
+
+class TestCodeGen(unittest.TestCase):
+    def test_same_as_evaluator(self):
+        prog = load_lines(LINES + ["'Data'!A8 @=IF(A1>1, B1, SUM(A1:B2))",
+                                   "'Data'!A9 @=NOW()"])
+        mod = CodeGen.load_program(prog, FUNCS)
+        C = [None] * mod.N
+        self.assertEqual(mod.calculate(C), {11: 15.5})
+        ev = XEvaluator(prog, FUNCS)
+        for cell, value in zip(mod.CELLS, C):
+            sheet, _, name = cell.partition('!')
+            if name != 'A9':
+                self.assertEqual(value, ev.value(sheet.strip("'"), name), cell)
+        self.assertEqual(mod.DAGS, {11: [0, 1, 2, 9]})
+
+    def test_cache(self):
+        with tempfile.TemporaryDirectory() as d:
+            path = os.path.join(d, 'book.txt')
+            with open(path, 'w', encoding='utf-8') as f:
+                f.write('\n'.join(LINES))
+            mod = CodeGen.load(path, FUNCS)
+            self.assertTrue(os.path.exists(path + '.pyc'))
+            with mock.patch('spd.Compiler.load_lines', side_effect=AssertionError):
+                mod = CodeGen.load(path, FUNCS)
+            self.assertEqual(mod.calculate(), {11: 15.5})
+            # content changed: the cache is rebuilt
+            with open(path, 'a', encoding='utf-8') as f:
+                f.write("\n'Data'!B1 @=2.5")
+            self.assertEqual(CodeGen.load(path, FUNCS).calculate(), {11: 26.5})
+            with open(path + '.pyc', 'rb') as f:
+                self.assertEqual(f.read(16)[8:], CodeGen.cache_key(open(path, 'rb').read(), FUNCS))
+            # other function names, or another generator version: rebuilt too
+            for patch in (mock.patch.dict(FUNCS, {'EXTRA': abs}), mock.patch.object(CodeGen, 'VERSION', 'test')):
+                with patch, mock.patch('spd.Compiler.load_lines', side_effect=AssertionError):
+                    self.assertRaises(AssertionError, CodeGen.load, path, FUNCS)
+
+    def test_sparse_range(self):
+        # only the populated cells of a range are emitted
+        prog = load_lines(["'S'!A1 @=1", "'S'!Z2000 @=2", "'S'!B1:B2 @=A1+1",
+                           "'T'!A1 @=OUTPUT(\"x\", SUM('S'!A1:Z2000))"])
+        src = CodeGen.generate(prog)
+        self.assertLess(len(src), 4096)
+        self.assertEqual(CodeGen.load_program(prog).calculate(), {4: 7})
+        self.assertEqual(XEvaluator(prog).calculate(), {4: 7})
+
+
+#############################################################################
+# Unit Test
+if __name__ == '__main__':
+    unittest.main()
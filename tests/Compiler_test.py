@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import io
+import sys
+import types
+import unittest
+from contextlib import redirect_stdout
+from unittest import mock
+
+from spd.Compiler import D_ERROR, D_WARNING, compile_lines, workbook_lines
+from spd.Evaluator import XEvaluator
+from tests.fixtures import BASE
+
+LINES = BASE[:3] + ["'Data'!A2 @=A1*RATE+",
+                    "'Data'!A3 @=A1*RATE+'Data'!B1",
+                    "'Data'!A4 @=A1 ~ 2",
+                    "just some text",
+                    "'Out'!A1 @=RTC(\"x\", 'Data'!A3)"]
+
+
+class TestCompileLines(unittest.TestCase):
+    def test_diagnostics(self):
+        out = io.StringIO()
+        with redirect_stdout(out):
+            prog, diags = compile_lines(LINES)
+            prog.build_call_trees()
+        self.assertEqual(out.getvalue(), '')
+        self.assertEqual([(d.ln, d.level) for d in diags],
+                         [(4, D_ERROR), (6, D_WARNING), (6, D_ERROR), (7, D_ERROR)])
+        self.assertEqual(diags[0].txt, LINES[3])
+        # bad lines are skipped, the rest are compiled
+        self.assertEqual(sorted(prog.sheetsExpr['Data']), ['A1', 'A3'])
+        self.assertEqual([fn.ln for fn in prog.egressCells], [8])
+        self.assertEqual(len(prog.callflow[8]), 3)
+        self.assertIsNone(prog.sheetsExpr['Data']['A3'].txt)
+
+    def test_keep_txt(self):
+        prog, diags = compile_lines(LINES[:3], keep_txt=True)
+        self.assertEqual(diags, [])
+        self.assertEqual(prog.sheetsExpr['Data']['A1'].txt, LINES[2])
+
+    def test_empty_if_args(self):
+        # empty arguments of IF are None, same as the params of other functions
+        prog, diags = compile_lines(["'S'!A1 @=1", "'S'!A2 @=0", "'S'!B1 @=5",
+                                     "'S'!C1 @=IF(A1,,2)", "'S'!C2 @=IF(A2,,2)",
+                                     "'S'!C3 @=IF(,1,2)", "'S'!C4 @=IF(A2,B1*2,)",
+                                     "'S'!C5 @=IF(A1, , B1+1)", "'S'!C6 @=IF(A1,)"])
+        self.assertEqual(diags, [])
+        ev = XEvaluator(prog)
+        self.assertEqual([ev.value('S', f"C{i}") for i in range(1, 7)], [None, 2, 2, None, None, None])
+
+    def test_workbook_cells(self):
+        cells = [("A1", "Total amount"), ("A2", 'say "hi"'), ("A3", 2.5), ("A4", 0), ("A5", True),
+                 ("A6", None), ("A7", "=A3*2")]
+        sheet = types.SimpleNamespace(title='S')
+        sheet.columns = [[types.SimpleNamespace(parent=sheet, coordinate=k, value=v) for k, v in cells]]
+        wb = mock.MagicMock()
+        wb.defined_names.localnames.return_value = []
+        wb.__iter__.return_value = iter([sheet])
+        fake = types.SimpleNamespace(load_workbook=lambda filename: wb)
+        with mock.patch.dict(sys.modules, openpyxl=fake):
+            lines = list(workbook_lines('book.xlsx'))
+        self.assertEqual(lines, ["'S'!A1 @=\"Total amount\"", "'S'!A2 @=\"say \"\"hi\"\"\"",
+                                 "'S'!A3 @=2.5", "'S'!A4 @=0", "'S'!A5 @=TRUE", "'S'!A7 @=A3*2"])
+        prog, diags = compile_lines(lines)
+        self.assertEqual(diags, [])
+        ev = XEvaluator(prog)
+        self.assertEqual([ev.value('S', k) for k, _ in cells],
+                         ["Total amount", 'say "hi"', 2.5, 0, True, None, 5.0])
+
+
+#############################################################################
+# Unit Test
+if __name__ == '__main__':
+    unittest.main()
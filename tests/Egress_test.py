@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import json
+import os
+import socket
+import tempfile
+import unittest
+
+from spd.Compiler import load_lines
+from spd.Egress import XEgress, XFileSink, XListSink, XSocketSink, destination
+from spd.Replay import XReplay, XTick
+
+LINES = ["'Data'!A1 @=RTGET(\"X.N\",\"BID\")",
+         "'Out'!A1 @=RTC(\"px\", 'Data'!A1)",
+         "'Out'!A2 @=OUTPUT(\"risk\", 'Data'!A1*2)",
+         "'Out'!A3 @=RTC(\"px\", 'Data'!A1+1)"]
+
+
+class TestXEgress(unittest.TestCase):
+    def setUp(self):
+        self.now = 0.0
+        self.sink = XListSink()
+
+    def egress(self, **kwargs):
+        return XEgress({'': self.sink}, clock=lambda: self.now, **kwargs)
+
+    def test_destination(self):
+        prog = load_lines(LINES)
+        self.assertEqual([destination(fn) for fn in prog.egressCells], ['px', 'risk', 'px'])
+
+    def test_coalesce_window(self):
+        eg = self.egress(window=0.01)
+        for v in range(3):
+            eg.put(7, v, 'px')
+        eg.put(8, 'a', 'px')
+        eg.put(9, 1.5, 'risk')
+        self.assertEqual(eg.flush(), 0)
+        self.now = 0.02
+        self.assertEqual(eg.flush(), 2)
+        self.assertEqual(self.sink.batches, [('px', [(7, 2), (8, 'a')]), ('risk', [(9, 1.5)])])
+        self.assertEqual((eg.stats['writes'], eg.stats['coalesced'], eg.stats['sent']), (5, 2, 3))
+
+    def test_batch_and_backpressure(self):
+        eg = self.egress(window=10, max_batch=2, max_pending=3)
+        eg.put(1, 1, 'a')
+        eg.put(2, 2, 'a')      # batch is full
+        self.assertEqual(self.sink.batches, [('a', [(1, 1), (2, 2)])])
+        eg.put(3, 3, 'b')
+        eg.put(4, 4, 'c')
+        self.assertEqual(len(self.sink.batches), 1)
+        eg.put(5, 5, 'd')      # queue is full, flushed by the writer
+        self.assertEqual(eg.stats['blocked'], 1)
+        self.assertEqual(self.sink.batches[1:], [('b', [(3, 3)]), ('c', [(4, 4)]), ('d', [(5, 5)])])
+
+    def test_thread_sinks(self):
+        a, b = socket.socketpair()
+        with tempfile.TemporaryDirectory() as d:
+            path = os.path.join(d, 'out.jsonl')
+            eg = XEgress({'px': XSocketSink(a), '': XFileSink(path)}, window=0.001, max_pending=8).start()
+            for i in range(100):
+                eg.put(i % 10, i, 'px' if i % 2 else 'risk')
+            eg.close()
+            with open(path, 'rb') as f:
+                risk = [json.loads(line) for line in f]
+        px = [json.loads(line) for line in b.makefile('rb')]
+        b.close()
+        self.assertEqual({d['dest'] for d in risk}, {'risk'})
+        self.assertEqual({d['dest'] for d in px}, {'px'})
+        last = {}
+        for batch in risk + px:
+            last.update(dict(batch['writes']))
+        self.assertEqual(last, {i: 90 + i for i in range(10)})
+        self.assertEqual(eg.stats['writes'], 100)
+        self.assertEqual(eg.stats['sent'] + eg.stats['coalesced'], 100)
+
+    def test_replay(self):
+        prog = load_lines(LINES)
+        eg = XEgress.from_program(prog, {'': self.sink}, window=0)
+        replay = XReplay(prog, sink=eg)
+        replay.run([XTick(0, 'X.N', 'BID', 10), XTick(0, 'X.N', 'BID', 11)])
+        eg.close()
+        self.assertEqual(self.sink.batches, [('px', [(2, 10)]), ('risk', [(3, 20)]), ('px', [(4, 11)]),
+                                             ('px', [(2, 11)]), ('risk', [(3, 22)]), ('px', [(4, 12)])])
+
+
+#############################################################################
+# Unit Test
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,60 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import unittest
+
+from spd.Compiler import load_lines
+from spd.Evaluator import XEvaluator
+from spd.Graph import from_program
+from tests.fixtures import FORMULAS as LINES
+
+
+class TestXEvaluator(unittest.TestCase):
+    def setUp(self):
+        self.calls = []
+        self.prog = load_lines(LINES)
+
+        def rtget(ric, field):
+            return 10
+
+        def tr(ric, field):
+            self.calls.append(field)
+            return 99
+
+        self.ev = XEvaluator(self.prog, {'RTGET': rtget, 'TR': tr})
+
+    def test_values(self):
+        ev = self.ev
+        self.assertEqual(ev.value('Data', 'A2'), 16.5)
+        self.assertEqual(ev.value('Data', 'A5'), '1.5-0.5')
+        self.assertEqual(ev.value('Data', 'A6'), -13.25)
+        self.assertEqual(ev.value('Data', 'A7'), '#DIV/0!')
+        self.assertEqual(ev.fetch(('Data', 'A1:B2')), [[10, 1.5], [16.5, 'USD']])
+        self.assertEqual(ev.value('', 'RATE'), 1.5)
+
+    def test_branch(self):
+        ev = self.ev
+        self.assertEqual(ev.calculate(), {11: 15.5})
+        self.assertIs(ev.value('Data', 'A4'), False)
+        # untaken TR is never called
+        self.assertEqual(self.calls, [])
+        ev.funcs['RTGET'] = lambda ric, field: 101
+        ev.invalidate()
+        self.assertEqual(ev.value('Data', 'A3'), 99)
+        self.assertEqual(ev.value('Data', 'A4'), 99)
+        self.assertEqual(self.calls, ['ASK', 'LAST'])
+
+    def test_conditional_edges(self):
+        g = from_program(self.prog)
+        a2 = list(g.cells).index("'Data'!A2")
+        a3 = list(g.cells).index("'Data'!A3")
+        edges = g.indices[g.indptr[a2]:g.indptr[a2 + 1]]
+        conds = g.conds[g.indptr[a2]:g.indptr[a2 + 1]]
+        self.assertTrue(conds[list(edges).index(a3)])
+        self.assertEqual(self.prog.sheetsExpr['Data']['A3'].conds, {1: (1, False)})
+
+
+#############################################################################
+# Unit Test
+if __name__ == '__main__':
+    unittest.main()
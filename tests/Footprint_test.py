@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import unittest
+
+from spd.Compiler import load_lines
+from spd.Footprint import assert_budget, check_budget, footprint, sizeof, traced
+from spd.Scheduler import synthetic
+
+
+class TestFootprint(unittest.TestCase):
+    def test_sizeof(self):
+        s = 'x' * 100
+        self.assertGreater(sizeof([s, s]), sizeof(s))
+        self.assertEqual(sizeof([s, s]) - sizeof([]), sizeof(s) + 8 * 2)
+        seen: set = set()
+        sizeof(s, seen)
+        self.assertEqual(sizeof(s, seen), 0)
+
+    def test_report(self):
+        lines = synthetic(3, 4)
+        prog = load_lines(lines, keep_txt=True)
+        prog.build_call_trees()
+        rtn = footprint(prog)
+        self.assertEqual(rtn['formulas'], 15)
+        self.assertEqual(sorted(rtn['sheets']), ['S0', 'S1', 'S2'])
+        self.assertEqual(rtn['total'], sum(rtn['structures'].values()) + sum(rtn['fields'].values()))
+        self.assertGreater(rtn['fields']['txt'], sum(len(s) for s in lines))
+        self.assertGreater(rtn['structures']['callflow'], 0)
+
+        lean = footprint(load_lines(lines, keep_txt=False))
+        self.assertEqual(lean['fields']['txt'], 0)
+        assert_budget(lean, {'fields.txt': 0, 'per_formula': rtn['per_formula']})
+        with self.assertRaises(AssertionError):
+            assert_budget(rtn, {'fields.txt': 0})
+        self.assertEqual(check_budget(rtn, {'sheets.S9': 1}), ['sheets.S9: not in the report'])
+
+    def test_range_formula(self):
+        prog = load_lines(["'S'!A1 @=1", "'S'!B1:B3 @=A1*2", "'S'!C1 @=SUM(B1:B3)"])
+        self.assertEqual(footprint(prog)['formulas'], 2)
+
+    def test_same_sheets(self):
+        # the constant pool shared by all the formulas isn't put on one sheet
+        prog = load_lines(synthetic(3, 4), keep_txt=False)
+        rtn = footprint(prog)
+        # what's left is the small objects every sheet uses, on the first one reaching them
+        sizes = rtn['sheets'].values()
+        self.assertLess(max(sizes) - min(sizes), rtn['structures']['constants'])
+        self.assertEqual(rtn['fields']['values'], 0)
+
+    def test_traced(self):
+        prog, mem = traced(load_lines, synthetic(3, 4))
+        self.assertEqual(len(prog.egressCells), 3)
+        self.assertGreater(mem['allocated'], 0)
+        self.assertGreaterEqual(mem['peak'], mem['allocated'])
+        self.assertTrue(mem['top'])
+
+
+#############################################################################
+# Unit Test
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,57 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import tempfile
+import unittest
+
+import numpy as np
+
+from spd.Compiler import load_lines
+from spd.Graph import XGraph, from_program
+from tests.fixtures import WORKBOOK as LINES
+
+
+class TestXGraph(unittest.TestCase):
+    def setUp(self):
+        self.g = from_program(load_lines(LINES))
+
+    def test_export(self):
+        g = self.g
+        self.assertEqual(list(g.cells), ["'Data'!A1", "'Data'!A2",
+                                         "'Data'!C1:C3", "'Out'!A1"])
+        self.assertEqual(list(g.indptr), [0, 2, 4, 5, 5])
+        self.assertEqual(list(g.indices), [1, 2, 2, 3, 3])
+        self.assertEqual(list(g.lines), [3, 4, 5, 7])
+
+    def test_algorithms(self):
+        g = self.g
+        self.assertEqual(list(g.bfs([0])), [0, 1, 1, 2])
+        self.assertEqual(list(g.bfs([2])), [-1, -1, 0, 1])
+        order, levels = g.toposort()
+        self.assertEqual(list(order), [0, 1, 2, 3])
+        self.assertEqual(list(levels), [0, 1, 2, 3])
+        self.assertEqual(list(g.fanin()), [0, 1, 2, 2])
+        self.assertEqual(g.stats()['fanout_max'], 2)
+        t = g.transpose()
+        self.assertEqual(list(t.neighbors(np.array([3]))), [1, 2])
+
+    def test_loop(self):
+        g = XGraph([0, 1, 2, 2], [1, 0], ['a', 'b', 'c'])
+        order, levels = g.toposort()
+        self.assertEqual(list(order), [2])
+        self.assertEqual(list(levels), [-1, -1, 0])
+
+    def test_save(self):
+        with tempfile.TemporaryDirectory() as d:
+            for path in (os.path.join(d, 'g.npz'), os.path.join(d, 'g')):
+                self.g.save(path)
+                g = XGraph.load(path)
+                self.assertEqual(list(g.indices), list(self.g.indices))
+                self.assertEqual(list(g.cells), list(self.g.cells))
+
+
+#############################################################################
+# Unit Test
+if __name__ == '__main__':
+    unittest.main()
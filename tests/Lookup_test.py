@@ -0,0 +1,58 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import unittest
+
+from spd.Compiler import load_lines
+from spd.Evaluator import XEvaluator
+from spd.Lookup import XLookup
+
+LINES = ["'T'!A1 @=\"apple\"", "'T'!B1 @=1.5",
+         "'T'!A2 @=\"Pear\"", "'T'!B2 @=2.5",
+         "'T'!A3 @=10", "'T'!B3 @=A3*2",
+         "'T'!A4 @=20", "'T'!B4 @=\"twenty\"",
+         "'S'!A1 @=VLOOKUP(\"PEAR\", 'T'!A1:B4, 2, FALSE)",
+         "'S'!A2 @=VLOOKUP(15, 'T'!A1:B4, 2)",
+         "'S'!A3 @=VLOOKUP(\"kiwi\", 'T'!A1:B4, 2, 0)",
+         "'S'!A4 @=MATCH(20, 'T'!A1:A4, 0) + MATCH(\"apple\", 'T'!A1:A4, 0)",
+         "'S'!A5 @=INDEX('T'!A1:B4, 4, 2) & INDEX('T'!A1:A4, 2)",
+         "'S'!A6 @=HLOOKUP(\"apple\", 'T'!A1:B2, 2, FALSE)",
+         "'S'!A7 @=MATCH(25, 'T'!A1:A4)"]
+
+
+class TestXLookup(unittest.TestCase):
+    def setUp(self):
+        self.prog = load_lines(LINES)
+        self.ev = XEvaluator(self.prog)
+        self.lk = XLookup(self.ev)
+
+    def test_functions(self):
+        ev = self.ev
+        self.assertEqual(ev.value('S', 'A1'), 2.5)
+        self.assertEqual(ev.value('S', 'A2'), 20)
+        self.assertEqual(ev.value('S', 'A3'), '#N/A')
+        self.assertEqual(ev.value('S', 'A4'), 5)
+        self.assertEqual(ev.value('S', 'A5'), 'twentyPear')
+        self.assertEqual(ev.value('S', 'A6'), 'Pear')
+        self.assertEqual(ev.value('S', 'A7'), 4)
+
+    def test_cache(self):
+        ev, lk = self.ev, self.lk
+        ev.value('S', 'A1')
+        ev.value('S', 'A3')
+        self.assertEqual(lk.stats['builds'], 1)
+        self.assertEqual(lk.stats['hits'], 1)
+        # B3 depends on A3, change both
+        self.prog.sheetsValue['T']['A3'] = '15'
+        ev.changed('T', 'A3')
+        ev.invalidate([self.prog.sheetsExpr['T']['B3'].ln, self.prog.sheetsExpr['S']['A2'].ln])
+        self.assertNotIn(('T', 'A1:B4'), lk.tables)
+        self.assertEqual(ev.value('S', 'A2'), 30)
+        ev.invalidate()
+        self.assertEqual(lk.tables, {})
+
+
+#############################################################################
+# Unit Test
+if __name__ == '__main__':
+    unittest.main()
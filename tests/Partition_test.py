@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import multiprocessing
+import os
+import unittest
+
+from spd.Compiler import load_lines
+from spd.Evaluator import XEvaluator
+from spd.Partition import XDistributed, split
+from spd.Scheduler import synthetic
+
+
+def connected(width: int, depth: int):
+    """ Chains linked every 5 cells to the next one, all summed by one egress cell."""
+    lines = []
+    for w in range(width):
+        lines.append(f"'S{w}'!A1 @={w + 1}")
+        for d in range(2, depth + 1):
+            link = f"+'S{(w + 1) % width}'!A{d - 1}/100" if d % 5 == 0 else ""
+            lines.append(f"'S{w}'!A{d} @=A{d - 1}*1.01+SUM(A1:A{d - 1})/{d}{link}")
+    lines.append("'T'!A1 @=OUTPUT(\"y\", " + "+".join(f"'S{w}'!A{depth}" for w in range(width)) + ")")
+    return lines
+
+
+class TestSplit(unittest.TestCase):
+    def test_disjoint(self):
+        # egress DAGs are kept whole
+        prog = load_lines(synthetic(8, 10), keep_txt=False)
+        q = split(prog, 4).quality()
+        self.assertEqual(q['cut_edges'], 0)
+        self.assertEqual(q['nodes'], [22, 22, 22, 22])
+        self.assertEqual(q['imbalance'], 1.0)
+
+    def test_connected(self):
+        prog = load_lines(connected(6, 20), keep_txt=False)
+        part = split(prog, 3)
+        q = part.quality()
+        self.assertEqual(sum(q['nodes']), 6 * 19 + 1)
+        self.assertLessEqual(q['imbalance'], 1.1)
+        self.assertGreater(q['cut_edges'], 0)
+        self.assertLess(q['cut_ratio'], 0.05)
+        self.assertEqual(q['traffic'], sum(len(v) for v in part.sends().values()))
+
+
+@unittest.skipUnless('fork' in multiprocessing.get_all_start_methods(), "needs fork")
+class TestXDistributed(unittest.TestCase):
+    def test_run(self):
+        prog = load_lines(connected(6, 20), keep_txt=False)
+        expect = XEvaluator(prog).calculate()
+        dist = XDistributed(prog, parts=3, timeout=60)
+        self.assertEqual(dist.run(), expect)
+        self.assertEqual(dist.serial, 0)
+        self.assertEqual(sorted(dist.stats), [0, 1, 2])
+        self.assertEqual(sum(s['evaluated'] for s in dist.stats.values()), 6 * 19 + 1)
+        q = dist.report()
+        self.assertEqual(q['sent'], q['traffic'])
+        self.assertEqual(sum(s['received'] for s in dist.stats.values()), q['sent'])
+
+    def test_errors(self):
+        # an exception of a partition is raised by run, a partition which dies is reported
+        prog = load_lines(synthetic(4, 5), keep_txt=False)
+
+        def fail(ric, field):
+            raise RuntimeError(f"no {ric}")
+
+        with self.assertRaisesRegex(RuntimeError, "no "):
+            XDistributed(prog, {'RTGET': fail}, parts=2, timeout=60).run()
+        with self.assertRaisesRegex(RuntimeError, "exited with code 3"):
+            XDistributed(prog, {'RTGET': lambda ric, field: os._exit(3)}, parts=2, timeout=60).run()
+
+    def test_loop(self):
+        # cells in a loop can't be ordered across the partitions
+        prog = load_lines(["'S'!A1 @=B1+1", "'S'!B1 @=A1+1", "'S'!C1 @=OUTPUT(\"x\", A1)"] +
+                          synthetic(2, 3), keep_txt=False)
+        dist = XDistributed(prog, parts=2)
+        self.assertEqual(dist.run(), XEvaluator(prog).calculate())
+        self.assertEqual(dist.serial, 1)
+
+#####
+
+
+if __name__ == '__main__':
+    unittest.main()
+
+# vim: noai:ts=4:sw=4:expandtab
@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import tempfile
+import time
+import unittest
+
+from spd.Compiler import load_lines
+from spd.Evaluator import XEvaluator
+from spd.Profile import XProfiler
+
+LINES = ["'Data'!A1 @=SLOW(1)",
+         "'Data'!A2 @=A1+SUM(A1, 2)",
+         "'Data'!A3 @=A2*2",
+         "'Out'!A1 @=OUTPUT(\"x\", 'Data'!A3)"]
+
+
+def slow(x):
+    time.sleep(0.02)
+    return x
+
+
+class TestXProfiler(unittest.TestCase):
+    def setUp(self):
+        self.prog = load_lines(LINES)
+        self.ev = XEvaluator(self.prog, {'SLOW': slow})
+
+    def test_trace(self):
+        with XProfiler(self.ev) as prof:
+            self.assertEqual(self.ev.calculate(), {4: 8})
+        self.assertNotIn('evaluate', vars(self.ev))
+        self.assertIs(self.ev.funcs['SLOW'], slow)
+
+        self.assertEqual({k: v[0] for k, v in prof.formulas.items()}, {1: 1, 2: 1, 3: 1, 4: 1})
+        self.assertEqual({k: v[0] for k, v in prof.funcs.items()}, {'SLOW': 1, 'SUM': 1, 'OUTPUT': 1})
+        label, count, cum, own = prof.top(1, 'cumulative')[0]
+        self.assertEqual((label, count), ("'Out'!A1:4", 1))
+        self.assertGreaterEqual(cum, 0.02)
+        self.assertLess(own, 0.02)
+        self.assertEqual(prof.top(1, funcs=True)[0][0], 'SLOW')
+        for _, _, cum, own in prof.top(10):
+            self.assertLessEqual(own, cum)
+
+        folded = prof.folded()
+        self.assertTrue(folded[0].startswith("'Out'!A1:4;'Data'!A3:3;'Data'!A2:2;'Data'!A1:1;SLOW "))
+        self.assertGreaterEqual(int(folded[0].rsplit(' ', 1)[1]), 20000)
+        self.assertIn("SLOW", prof.report(5))
+
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'calc.folded')
+            prof.dump(path)
+            with open(path, encoding='utf-8') as f:
+                self.assertEqual(f.read().splitlines(), folded)
+
+    def test_sample(self):
+        with XProfiler(self.ev, 0.001) as prof:
+            self.ev.calculate()
+        self.assertGreater(prof.samples, 0)
+        self.assertIn('SLOW', prof.funcs)
+        self.assertEqual(prof.top(1, funcs=True)[0][0], 'SLOW')
+        self.assertTrue(prof.folded()[0].startswith("'Out'!A1:4;'Data'!A3:3;'Data'!A2:2;'Data'!A1:1;SLOW "))
+        self.assertIn('samples every 1ms', prof.report(5))
+
+#####
+
+
+if __name__ == '__main__':
+    unittest.main()
+
+# vim: noai:ts=4:sw=4:expandtab
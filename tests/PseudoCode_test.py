@@ -3,14 +3,98 @@
 
 import unittest
 
+from spd.Compiler import load_lines
+from spd.Evaluator import XEvaluator
+from spd.Formula import XFormula
 from spd.PseudoCode import XProgram
+from spd.Utils import XRange
 
 # Unit test code for class EEIProgram
 
 
 class TestEEIProgramMethods(unittest.TestCase):
     test_program = XProgram()
-    pass
+
+    def test_sparse_range(self):
+        prog = XProgram()
+        a = XFormula('S', [], [], [], 1)
+        b = XFormula('S', [], [], [], 2)
+        prog.add_formula(a, 'B2', 'S')
+        prog.add_formula(b, 'C1000000', 'S')
+        prog.add_value('1', 'B3', 'S')
+        prog.add_refer(('T', 'A1'), 'B4', 'S')
+        prog.add_formula(XFormula('T', [], [], [], 3), 'A1', 'T')
+        self.assertEqual(list(prog.sheetsIndex['S'].cells(XRange('A1:XFD1048576'))),
+                         ['B2', 'B3', 'B4', 'C1000000'])
+        found = [fn.ln for fn in prog._ref_formulas(('S', 'A1:XFD1048576'))]
+        self.assertEqual(found, [1, 3, 2])
+        self.assertEqual(list(prog._ref_formulas(('U', 'A1:B2'))), [])
+
+    def test_resolve_refers(self):
+        prog = XProgram()
+        prog.add_formula(XFormula('T', [], [], [], 1), 'A1', 'T')
+        prog.add_refer(('S', 'B1'), 'RATE')
+        prog.add_refer(('', 'RATE'), 'B2', 'S')
+        prog.add_refer(('T', 'A1'), 'B1', 'S')
+        prog.add_refer(('S', 'C2'), 'C1', 'S')
+        prog.add_refer(('S', 'C1'), 'C2', 'S')
+        prog.add_refer(('S', 'C1'), 'C3', 'S')
+        self.assertFalse(prog.refersResolved)
+        loops = prog.resolve_refers()
+        self.assertEqual(loops, [[('S', 'C1'), ('S', 'C2')]])
+        self.assertEqual(prog.sheetsRefer[''], {'RATE': ('T', 'A1')})
+        self.assertEqual(prog.sheetsRefer['S'], {'B2': ('T', 'A1'), 'B1': ('T', 'A1')})
+        self.assertEqual([fn.ln for fn in prog._ref_formulas(('S', 'B2'))], [1])
+        self.assertEqual(list(prog._ref_formulas(('S', 'C3'))), [])
+
+        # a refer leading to a loop is removed whatever the order
+        prog = XProgram()
+        prog.add_refer(('S', 'C1'), 'C3', 'S')
+        prog.add_refer(('S', 'C3'), 'C4', 'S')
+        prog.add_refer(('S', 'C2'), 'C1', 'S')
+        prog.add_refer(('S', 'C1'), 'C2', 'S')
+        prog.add_refer(('S', 'C1'), 'C5', 'S')
+        self.assertEqual(prog.resolve_refers(), [[('S', 'C1'), ('S', 'C2')]])
+        self.assertEqual(prog.sheetsRefer['S'], {})
+
+    def test_constants(self):
+        prog = load_lines(["'S'!A1 @=IF(TRUE, \"USD\" & 1, 0.5)",
+                           "'S'!A2 @=\"1\" & 1 & \"USD\"",
+                           "'S'!A3 @=1.0 + 2"])
+        self.assertEqual(prog.constants.values, [True, 'USD', 1, 0.5, '1', 1.0, 2])
+        a3 = prog.sheetsExpr['S']['A3']
+        self.assertIs(a3.values, prog.constants.values)
+        self.assertEqual(a3.syntax, [(0, '+', '#5', '#6')])
+        self.assertEqual(a3.constants(), {5: 1.0, 6: 2})
+        ev = XEvaluator(prog)
+        self.assertEqual([ev.value('S', c) for c in ('A1', 'A2', 'A3')], ['USD1', '11USD', 3.0])
+        self.assertNotEqual(prog.constants.add(-0.0), prog.constants.add(0.0))
+        self.assertEqual(prog.constants.add(-0.0), prog.constants.add(-0.0))
+
+    def test_prune(self):
+        prog = load_lines(["RATE @= 'Data'!B1",
+                           "UNUSED @= 'Data'!B9",
+                           "'Data'!B1 @=1.5",
+                           "'Data'!B2 @=7",
+                           "'Data'!B3 @='Data'!B2",
+                           "'Data'!A1 @=RTGET(\"X.N\",\"BID\")",
+                           "'Data'!A2 @=A1*RATE",
+                           "'Data'!A3 @=SUM(B2:B3)",
+                           "'Dead'!A1 @=RTGET(\"Y.N\",\"BID\")",
+                           "'Dead'!A2 @='Data'!A1*2",
+                           "'Data'!C1:C2 @=A1+1",
+                           "'Out'!A1 @=RTC(\"x\", 'Data'!A2+'Data'!C2)"])
+        rtn = prog.prune()
+        self.assertEqual({k: rtn[k] for k in ('formulas', 'values', 'refers', 'cells')},
+                         {'formulas': 3, 'values': 1, 'refers': 2, 'cells': 6})
+        self.assertGreater(rtn['bytes'], 0)
+        self.assertEqual(prog.sheetsPruned, {'Data': {'A3': ('F', 8), 'B2': ('V', 0), 'B3': ('R', 0)},
+                                             'Dead': {'A1': ('F', 9), 'A2': ('F', 10)},
+                                             '': {'UNUSED': ('R', 0)}})
+        self.assertEqual(sorted(prog.sheetsExpr), ['Data', 'Out'])
+        self.assertEqual(sorted(prog.sheetsIndex['Data'].cells(XRange('A1:C9'))), ['A1', 'A2', 'B1'])
+        self.assertEqual([fn.ln for fn in prog.ingressCells], [6])
+        self.assertEqual(XEvaluator(prog, {'RTGET': lambda ric, field: 2}).calculate(), {12: 6.0})
 
 
 #############################################################################
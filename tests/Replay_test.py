@@ -0,0 +1,56 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import tempfile
+import unittest
+
+from spd.Compiler import load_lines
+from spd.Replay import XReplay, XTick, load_ticks, save_ticks, synthetic_ticks
+from tests.fixtures import BASE
+
+LINES = BASE + ["'Data'!A3 @=IF(A1>100, TR(\"X.N\", \"ASK\"), A2-1)",
+                "'Data'!A4 @=RTGET(\"Y.N\",\"BID\")",
+                "'Out'!A1 @=RTC(\"x\", 'Data'!A3)",
+                "'Out'!A2 @=OUTPUT(\"y\", 'Data'!A4)"]
+
+
+class TestXReplay(unittest.TestCase):
+    def setUp(self):
+        self.replay = XReplay(load_lines(LINES))
+
+    def test_keys(self):
+        self.assertEqual(sorted(self.replay.keys), [('X.N', 'ASK'), ('X.N', 'BID'), ('Y.N', 'BID')])
+        lines, egress = self.replay.affected(('X.N', 'BID'))
+        self.assertEqual(sorted(lines), [3, 4, 5, 7])
+        self.assertEqual([fn.ln for fn in egress], [7])
+        self.assertEqual(self.replay.affected(('Z.N', 'BID')), ([], []))
+
+    def test_run(self):
+        ticks = [XTick(0.0, 'X.N', 'BID', 10), XTick(0.001, 'X.N', 'ASK', 99),
+                 XTick(0.002, 'Y.N', 'BID', 7), XTick(0.003, 'X.N', 'BID', 101),
+                 XTick(0.004, 'Z.N', 'BID', 1)]
+        self.replay.prime()
+        rtn = self.replay.run(ticks)
+        self.assertEqual(self.replay.sink.writes, [(7, 15.5), (7, 15.5), (8, 7), (7, 99)])
+        self.assertEqual((rtn['ticks'], rtn['writes']), (5, 4))
+        self.assertLessEqual(rtn['p50'], rtn['p99'])
+        self.assertLessEqual(rtn['p99'], rtn['p999'])
+        self.assertLessEqual(rtn['p999'], rtn['max'])
+        self.assertGreater(rtn['throughput'], 0)
+
+    def test_record(self):
+        ticks = synthetic_ticks([('X.N', 'BID'), ('Y.N', 'BID')], 50)
+        with tempfile.TemporaryDirectory() as d:
+            path = os.path.join(d, 'ticks.csv')
+            save_ticks(ticks, path)
+            self.assertEqual(load_ticks(path), ticks)
+        rtn = self.replay.run(ticks, speed=100.0)
+        self.assertEqual(rtn['writes'], 50)
+        self.assertGreaterEqual(rtn['elapsed'], ticks[-1].ts / 100.0)
+
+
+#############################################################################
+# Unit Test
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import unittest
+
+from spd.Compiler import load_lines
+from spd.Evaluator import XEvaluator
+from spd.Scheduler import XRecalc, XScheduler, components, partition, synthetic
+
+FUNCS = {'RTGET': lambda ric, field: 2.0}
+
+
+class TestXScheduler(unittest.TestCase):
+    def setUp(self):
+        self.prog = load_lines(synthetic(6, 5) + ["'T'!A1 @=OUTPUT(\"y\", 'S0'!A3+'S1'!A2)"])
+        self.expect = XEvaluator(self.prog, FUNCS).calculate()
+
+    def test_partition(self):
+        self.assertEqual(partition([5, 1, 4, 2, 3], 2), [[0, 1, 3], [2, 4]])
+        self.assertEqual(partition([1, 1], 4), [[0], [1]])
+
+    def test_components(self):
+        groups = components(self.prog)
+        self.assertEqual([[e.ln for e in g] for g in groups],
+                         [[6, 12, 37], [18], [24], [30], [36]])
+
+    def test_run(self):
+        for mode in ('thread', 'process'):
+            sch = XScheduler(self.prog, FUNCS, workers=3, mode=mode, min_cost=0)
+            self.assertEqual(sch.run(), self.expect)
+            self.assertEqual(sch.stats['serial'], 0)
+            self.assertGreater(sch.stats['tasks'], 1)
+
+    def test_serial_fallback(self):
+        for mode in ('thread', 'process'):
+            sch = XScheduler(self.prog, FUNCS, workers=3, mode=mode, min_cost=10 ** 6)
+            self.assertEqual(sch.run(), self.expect)
+            self.assertEqual(sch.stats['serial'], 1)
+
+    def test_thread_evaluators(self):
+        # every task has its own evaluator, a shared precedent is not a circular reference
+        prog = load_lines(["'S'!A1 @=RTGET(\"X.N\", \"BID\")"] +
+                          [f"'S'!B{i} @=A1*{i}" for i in range(1, 41)] +
+                          ["'S'!C1 @=OUTPUT(\"x\", SUM(B1:B40))"])
+        sch = XScheduler(prog, FUNCS, workers=4, mode='thread', min_cost=0)
+        self.assertEqual(sch.run(), {42: 1640.0})
+        self.assertGreater(sch.stats['tasks'], 2)
+
+
+RECALC = ["'Data'!A1 @=RTGET(\"X.N\",\"BID\")",
+          "'Data'!A2 @=A1*2",
+          "'Data'!A3 @=A1+1",
+          "'Data'!A4 @=RTGET(\"Y.N\",\"BID\")",
+          "'Out'!A1 @=OUTPUT(\"report\", 'Data'!A3)",
+          "'Out'!A2 @=RTC(\"px\", 'Data'!A2)",
+          "'Out'!A3 @=OUTPUT(\"report\", 'Data'!A4)"]
+
+
+class TestXRecalc(unittest.TestCase):
+    def setUp(self):
+        self.now = 0.0
+        self.prog = load_lines(RECALC)
+
+    def recalc(self, **kwargs):
+        return XRecalc(self.prog, FUNCS, clock=lambda: self.now, **kwargs)
+
+    def test_priority(self):
+        rc = self.recalc()
+        self.assertEqual(rc.priority, {5: 10, 6: 0, 7: 10})
+        rc = self.recalc(priorities={('Out', 'A1'): -1})
+        self.assertEqual(rc.priority, {5: -1, 6: 0, 7: 10})
+        rc.mark([1])
+        self.assertEqual(rc.run(), [(5, 3.0), (6, 4.0)])
+
+    def test_run(self):
+        rc = self.recalc()
+        self.assertEqual(rc.mark([1]), 0)
+        self.assertEqual(rc.pending(), 2)
+        self.assertEqual(rc.run(), [(6, 4.0), (5, 3.0)])
+        self.assertEqual(rc.mark([4]), 10)
+        self.assertEqual(rc.run(), [(7, 2.0)])
+        self.assertEqual(rc.mark([2]), 0)
+        self.assertEqual(rc.run(), [(6, 4.0)])
+
+    def test_defer(self):
+        rc = self.recalc(deadlines={0: 0.001})
+        rc.mark([1, 4])
+        self.assertEqual(rc.run(budget=0, defer=10), [(6, 4.0)])
+        self.assertEqual(rc.pending(), 2)
+        self.assertEqual(rc.stats['deferred'], 2)
+        # marked again while deferred: queued once
+        rc.mark([4])
+        self.now = 0.01
+        self.assertEqual(rc.run(), [(5, 3.0), (7, 2.0)])
+        self.assertEqual(rc.stats['missed'], 0)
+        rc.mark([2])
+        self.now = 0.02
+        rc.run()
+        self.assertEqual(rc.stats['missed'], 1)
+
+
+#############################################################################
+# Unit Test
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import threading
+import unittest
+
+from spd.Compiler import compile_lines, load_lines
+from spd.Evaluator import XEvaluator
+from spd.Snapshot import XVersioned
+
+LINES = ["'Data'!B1 @=1.5",
+         "'Data'!A1 @=RTGET(\"X.N\",\"BID\")",
+         "'Data'!A2 @=A1*'Data'!B1",
+         "'Calc'!A1 @=SUM(1,2)",
+         "'Out'!A1 @=RTC(\"x\", 'Data'!A2)"]
+
+FUNCS = {'RTGET': lambda ric, field: 10}
+
+
+class TestXVersioned(unittest.TestCase):
+    def setUp(self):
+        prog = load_lines(LINES)
+        prog.build_call_trees()
+        self.versioned = XVersioned(prog)
+
+    def test_copy_on_write(self):
+        old = self.versioned.current()
+        outputs = {fn.ln: list(fn.outputs) for _, _, fn in old.prog.formulas()}
+        with self.versioned.begin() as w:
+            _, diags = compile_lines(["'Data'!B1 @=2", "'Out'!A2 @=OUTPUT(\"y\", 'Calc'!A1)"],
+                                     w.prog, start=6)
+        self.assertEqual(diags, [])
+        new = self.versioned.current()
+        self.assertEqual((old.version, new.version), (0, 1))
+        # the old version is untouched
+        self.assertEqual(old.prog.sheetsValue['Data']['B1'], 1.5)
+        self.assertNotIn('A2', old.prog.sheetsExpr['Out'])
+        self.assertEqual({fn.ln: fn.outputs for _, _, fn in old.prog.formulas()}, outputs)
+        self.assertEqual(XEvaluator(old.prog, FUNCS).calculate(), {5: 15.0})
+        self.assertEqual(XEvaluator(new.prog, FUNCS).calculate(), {5: 20, 7: 3})
+        # untouched sheets and formula bodies are shared
+        self.assertIsNot(new.prog.sheetsValue['Data'], old.prog.sheetsValue['Data'])
+        self.assertIs(new.prog.sheetsIndex['Calc'], old.prog.sheetsIndex['Calc'])
+        self.assertIs(new.prog.sheetsExpr['Calc']['A1'].syntax, old.prog.sheetsExpr['Calc']['A1'].syntax)
+        self.assertEqual(new.prog.sheetsExpr['Calc']['A1'].outputs, [7])
+        with self.assertRaises(RuntimeError):
+            new.prog.add_value('1', 'C1', 'Data')
+
+    def test_touched_only(self):
+        old = self.versioned.current().prog
+        with self.versioned.begin() as w:
+            compile_lines(["'Data'!B1 @=2"], w.prog)
+        new = self.versioned.current().prog
+        # the call trees didn't change, no formula nor sheet of formulas is copied
+        for sheet in old.sheetsExpr:
+            self.assertIs(new.sheetsExpr[sheet], old.sheetsExpr[sheet])
+        self.assertEqual(new.callflow.keys(), old.callflow.keys())
+        for ln, visited in new.callflow.items():
+            self.assertEqual([id(fn) for fn in visited], [id(fn) for fn in old.callflow[ln]])
+        self.assertEqual(XEvaluator(new, FUNCS).calculate(), {5: 20})
+
+        with self.versioned.begin() as w:
+            compile_lines(["'Out'!A2 @=OUTPUT(\"y\", 'Calc'!A1)"], w.prog, start=6)
+        new, old = self.versioned.current().prog, new
+        self.assertIs(new.sheetsExpr['Data'], old.sheetsExpr['Data'])
+        self.assertIsNot(new.sheetsExpr['Calc'], old.sheetsExpr['Calc'])
+        self.assertEqual(old.sheetsExpr['Calc']['A1'].outputs, [])
+        self.assertEqual(new.sheetsExpr['Calc']['A1'].outputs, [6])
+        self.assertIs(new.callflow[6][1], new.sheetsExpr['Calc']['A1'])
+
+    def test_replace_and_abort(self):
+        pool = list(self.versioned.current().prog.constants.values)
+        w = self.versioned.begin()
+        compile_lines(["'Out'!A1 @=RTC(\"x\", 'Calc'!A1)", "'Out'!A3 @=OUTPUT(\"new\", 42)"], w.prog)
+        self.assertEqual(w.prog.constants.values[-2:], ['new', 42])
+        w.abort()
+        self.assertEqual(self.versioned.version, 0)
+        # the constants of the aborted version are dropped
+        self.assertEqual(self.versioned.current().prog.constants.values, pool)
+        with self.versioned.begin() as w:
+            compile_lines(["'Out'!A1 @=RTC(\"x\", 'Calc'!A1)"], w.prog, start=5)
+        prog = self.versioned.current().prog
+        self.assertEqual([fn.ln for fn in prog.egressCells], [5])
+        self.assertEqual(XEvaluator(prog, FUNCS).calculate(), {5: 3})
+
+    def test_prune(self):
+        old = self.versioned.current().prog
+        with self.versioned.begin() as w:
+            rtn = w.prog.prune()
+        self.assertEqual(rtn['formulas'], 1)
+        new = self.versioned.current().prog
+        self.assertIn('Calc', old.sheetsExpr)
+        self.assertNotIn('Calc', new.sheetsExpr)
+        self.assertEqual(new.sheetsPruned, {'Calc': {'A1': ('F', 4)}})
+        self.assertEqual(XEvaluator(new, FUNCS).calculate(), {5: 15.0})
+
+    def test_readers(self):
+        errors, stop = [], threading.Event()
+
+        def reader():
+            while not stop.is_set():
+                snap = self.versioned.current()
+                expect = 15.0 if snap.version % 2 == 0 else 20
+                rtn = XEvaluator(snap.prog, FUNCS).calculate()[5]
+                if rtn != expect:
+                    errors.append((snap.version, rtn))
+
+        threads = [threading.Thread(target=reader) for _ in range(2)]
+        for t in threads:
+            t.start()
+        for i in range(20):
+            with self.versioned.begin() as w:
+                compile_lines(["'Data'!B1 @=2" if i % 2 == 0 else "'Data'!B1 @=1.5"], w.prog)
+        stop.set()
+        for t in threads:
+            t.join()
+        self.assertEqual(self.versioned.version, 20)
+        self.assertEqual(errors, [])
+
+
+#############################################################################
+# Unit Test
+if __name__ == '__main__':
+    unittest.main()
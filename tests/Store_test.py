@@ -0,0 +1,40 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import unittest
+
+from spd.Compiler import D_ERROR
+from spd.Store import compile_stream, peak_rss
+from tests.fixtures import WORKBOOK as LINES
+
+
+class TestXStore(unittest.TestCase):
+    def test_compile(self):
+        st = compile_stream(LINES)
+        self.assertEqual(st.stats['formulas'], 4)
+        self.assertEqual(st.stats['values'], 1)
+        self.assertEqual(st.stats['refers'], 2)
+        self.assertEqual(st.egress(), [7])
+        self.assertEqual(st.ingress(), [3])
+        self.assertEqual(st.formula(4).txt, None)
+
+    def test_bad_line(self):
+        # skipped and reported, same as `compile_lines`
+        st = compile_stream(["Bar @=A1"] + LINES)
+        self.assertEqual([(d.ln, d.level) for d in st.diagnostics], [(1, D_ERROR)])
+        self.assertEqual(st.stats['formulas'], 4)
+
+    def test_walk(self):
+        st = compile_stream(LINES, memory_limit=1)
+        self.assertEqual(st.build_call_trees(), {7: 3})
+        self.assertEqual(sorted(st.visited(7)), [3, 4, 5])
+        self.assertEqual(st.outputs(3), [7])
+        self.assertGreater(st.stats['evicted'], 0)
+        self.assertGreater(st.stats['peak_rss'], 0)
+        self.assertGreaterEqual(peak_rss(), st.stats['peak_rss'])
+
+
+#############################################################################
+# Unit Test
+if __name__ == '__main__':
+    unittest.main()
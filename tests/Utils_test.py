@@ -2,7 +2,9 @@
 # Unit Tests
 import unittest
 
-from spd.Utils import range_to_cells, column_to_index, index_to_column, name_to_pos, XCell, XRange
+from spd.Utils import range_to_cells, column_to_index, index_to_column, name_to_pos, XCell, XRange, XRangeSet
+from spd.Utils import names_to_pos, pos_to_names, columns_to_indexes, indexes_to_columns
+from spd.Utils import iter_range, range_to_arrays, XOccupancy
 
 
 class TestRangeToCells(unittest.TestCase):
@@ -88,6 +90,79 @@ class TestEEIUtils(unittest.TestCase):
             self.assertEqual(XRange(tp[0]).contains(
                 XCell.new(tp[2])), tp[3])
 
+    def test_overlaps(self) -> None:
+        self.assertTrue(XRange('A1').overlaps(XRange('A1')))
+        self.assertTrue(XRange('A1:B2').overlaps(XRange('B2:C3')))
+        self.assertFalse(XRange('A1:B2').overlaps(XRange('C1:C2')))
+        self.assertEqual(XRange.from_bounds(2, 2, 1, 1), XRange('A1:B2'))
+        self.assertEqual(XRange('B2:A1').name(), 'A1:B2')
+        self.assertFalse(hasattr(XRange('A1'), '__dict__'))
+        self.assertFalse(hasattr(XCell(1, 1), '__dict__'))
+
+
+class TestXRangeSet(unittest.TestCase):
+    def test_algebra(self) -> None:
+        a = XRangeSet(['A1:B2', 'A3:B4', 'C1:C4'])
+        self.assertEqual(a.rects, [(1, 1, 3, 4)])
+        b = XRangeSet(['B2:D5'])
+        self.assertEqual(len(a | b), 12 + 12 - 6)
+        self.assertEqual(str(a & b), 'B2:C4')
+        self.assertEqual(len(a - b), 6)
+        self.assertEqual(a - b, XRangeSet(['A1:A4', 'B1:C1']))
+        self.assertEqual((a - b) | (a & b), a)
+        self.assertFalse(a - a)
+        self.assertTrue(a.contains('C4'))
+        self.assertFalse(a.contains((4, 1)))
+        self.assertTrue(a.overlaps('C4:D9'))
+        self.assertFalse(a.overlaps('D1:D9'))
+        self.assertTrue(a.covers('A2:C3'))
+        self.assertFalse(a.covers('A2:D3'))
+
+    def test_from_cells(self) -> None:
+        cells = [f"{c}{r}" for c in ('A', 'B', 'C') for r in range(1, 100001)]
+        rs = XRangeSet.from_cells(cells + ['E5', 'E6', 'E8'])
+        self.assertEqual(str(rs), 'A1:C100000,E5:E6,E8')
+        self.assertEqual(len(rs), 300003)
+        self.assertEqual(len(XRangeSet.from_cells([])), 0)
+
+
+class TestBatchMethods(unittest.TestCase):
+    names = ['A1', 'Z2', 'AA3', 'AZ4', 'IV65536', 'ZZ5', 'AAA6', 'AZZ7', 'XFD8', 'XFD1048576']
+
+    def test_names_to_pos(self):
+        cols, rows = names_to_pos(self.names)
+        self.assertEqual(list(zip(cols, rows)), [name_to_pos(n) for n in self.names])
+        cols, rows = names_to_pos([b'$b$2', b'c10'])
+        self.assertEqual((list(cols), list(rows)), ([2, 3], [2, 10]))
+        self.assertEqual(list(pos_to_names(*names_to_pos(self.names))), self.names)
+
+    def test_columns(self):
+        self.assertEqual(list(columns_to_indexes(['A', 'XFD', 'ZZ1'])), [1, 16384, 702])
+        self.assertEqual(list(indexes_to_columns([1, 27, 16384])), ['A', 'AA', 'XFD'])
+
+    def test_range(self):
+        cells = list(range_to_cells('Y8:AB10'))
+        self.assertEqual(list(iter_range('Y8:AB10')), [name_to_pos(c) for c in cells])
+        cols, rows = range_to_arrays('Y8:AB10')
+        self.assertEqual(list(pos_to_names(cols, rows)), cells)
+        self.assertEqual(list(iter_range('B2')), [(2, 2)])
+
+
+class TestXOccupancy(unittest.TestCase):
+    def test_cells(self):
+        idx = XOccupancy()
+        for c in ('C5', 'A1', 'B1000000', 'B2', 'A3', 'XFD1', 'B2'):
+            idx.add(c)
+        self.assertEqual(len(idx), 6)
+        self.assertEqual(list(idx.cells(XRange('A1:C5'))), ['A1', 'A3', 'B2', 'C5'])
+        self.assertEqual(list(idx.cells(XRange('B1:XFD1048576'))), ['B2', 'B1000000', 'C5', 'XFD1'])
+        self.assertEqual(list(idx.cells(XRange('A2'))), [])
+        idx.remove('A1')
+        idx.remove('A3')
+        idx.remove('A4')
+        self.assertEqual(idx.columns, [2, 3, 16384])
+        self.assertEqual(list(idx.cells(XRange('A1:B2'))), ['B2'])
+
 
 #############################################################################
 # Unit Test
@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import multiprocessing
+import unittest
+from unittest import mock
+
+from spd.Compiler import load_lines
+from spd.Evaluator import XEvaluator
+from spd.ValueStore import K_NUMBER, K_STRING, K_ERROR, XTiledSheetStore, XValueStore
+from tests.fixtures import FORMULAS as LINES
+
+
+def _worker(spec, lock):
+    store = XValueStore.attach(spec, lock)
+    store.set('Data', 'C1', store.get('Data', 'B1') * 2)
+    store.set('Data', 'C2', 'from worker')
+    store.close()
+
+
+class TestXValueStore(unittest.TestCase):
+    def setUp(self):
+        self.prog = load_lines(LINES + ["'Data'!C3 @=TRUE"])
+        self.store = XValueStore.from_program(self.prog)
+
+    def tearDown(self):
+        self.store.unlink()
+
+    def test_values(self):
+        st = self.store
+        self.assertEqual(st.get('Data', 'B1'), 1.5)
+        self.assertEqual(st.get('Data', 'B2'), 'USD')
+        self.assertIsNone(st.get('Data', 'A1'))
+        self.assertIsNone(st.get('Nowhere', 'A1'))
+        ev = XEvaluator(self.prog, {'RTGET': lambda ric, field: 10})
+        ev.calculate()
+        ev.value('Data', 'A7')
+        self.assertEqual(st.update(ev), 5)
+        self.assertEqual(st.get('Data', 'A2'), 16.5)
+        num, kind = st.read('Data', 'A1:B7')
+        self.assertEqual(num.shape, (2, 7))
+        self.assertEqual(list(num[0, :2]), [10, 16.5])
+        self.assertEqual(kind[1, 1], K_STRING)
+        self.assertEqual(kind[0, 6], K_ERROR)
+        self.assertEqual(st.get('Data', 'A7'), '#DIV/0!')
+        # views share the memory
+        num[0, 0] = 11
+        self.assertEqual(st.get('Data', 'A1'), 11)
+        self.assertEqual(kind[0, 0], K_NUMBER)
+
+    def test_process(self):
+        ctx = multiprocessing.get_context('fork')
+        p = ctx.Process(target=_worker, args=(self.store.spec(), self.store.arena.lock))
+        p.start()
+        p.join()
+        self.assertEqual(p.exitcode, 0)
+        self.assertEqual(self.store.get('Data', 'C1'), 3)
+        self.assertEqual(self.store.get('Data', 'C2'), 'from worker')
+
+    def test_sparse(self):
+        prog = load_lines(["'S'!A1 @=1", "'S'!A2 @=A1+1", "'S'!XFD1048576 @=A2*2",
+                           "'S'!P1024 @=3", "'S'!Q1025 @=P1024+1"])
+        store = XValueStore.from_program(prog)
+        try:
+            st = store.sheets['S']
+            self.assertIsInstance(st, XTiledSheetStore)
+            self.assertEqual(st.tiles, [(0, 0), (1, 1), (1023, 1023)])
+            self.assertLess(st.shm.size, 1 << 20)
+            self.assertEqual(store.get('S', 'P1024'), 3)
+            ev = XEvaluator(prog)
+            for _, _, fn in prog.formulas():
+                ev.result(fn)
+            self.assertEqual(store.update(ev), 3)
+            self.assertEqual(store.get('S', 'XFD1048576'), 4)
+            self.assertIsNone(store.get('S', 'B5000'))
+            with self.assertRaises(IndexError):
+                store.set('S', 'B5000', 1)
+            # a view within one block, a copy across blocks
+            num, kind = store.read('S', 'A1:A2')
+            num[0, 0] = 5
+            self.assertEqual(store.get('S', 'A1'), 5)
+            num, kind = store.read('S', 'P1024:Q1025')
+            self.assertEqual(num.tolist(), [[3, 0], [0, 4]])
+            self.assertEqual(kind.tolist(), [[K_NUMBER, 0], [0, K_NUMBER]])
+            spec = store.spec()
+            other = XValueStore.attach(spec)
+            self.assertEqual(other.get('S', 'Q1025'), 4)
+            other.close()
+        finally:
+            store.unlink()
+
+    def test_range_value(self):
+        prog = load_lines(["'S'!A1:B2 @=5", "'S'!C1 @=A2+B1", "'T'!D3:E3 @=\"x\""])
+        store = XValueStore.from_program(prog)
+        try:
+            self.assertEqual([store.get('S', c) for c in ('A1', 'A2', 'B1', 'B2')], [5] * 4)
+            self.assertEqual([store.get('T', c) for c in ('D3', 'E3')], ['x', 'x'])
+        finally:
+            store.unlink()
+        # a failed load destroys the segments
+        unlink = XValueStore.unlink
+        with mock.patch.object(XValueStore, 'unlink', autospec=True, side_effect=unlink) as m:
+            with self.assertRaises(MemoryError):
+                XValueStore.from_program(load_lines([f"'S'!A1 @=\"{'x' * 10000}\""]), capacity=1)
+            m.assert_called_once()
+
+    def test_too_large(self):
+        prog = load_lines(["'S'!B1:XFD1048576 @=A1+1"])
+        with self.assertRaises(MemoryError):
+            XValueStore.from_program(prog)
+        with self.assertRaises(MemoryError):
+            XValueStore.from_program(self.prog, max_bytes=64)
+
+
+#############################################################################
+# Unit Test
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import unittest
+
+from spd.Compiler import load_lines
+from spd.Evaluator import XEvaluator
+from spd.Vector import XVectorizer, find_blocks
+
+
+def column(formula: str, rows: int, col: str = 'A', sheet: str = 'S'):
+    return [f"'{sheet}'!{col}{r} @=" + formula.format(r=r, p=r - 1) for r in range(1, rows + 1)]
+
+
+def values(col: str, vals, sheet: str = 'S'):
+    return [f"'{sheet}'!{col}{r} @={v}" for r, v in enumerate(vals, 1)]
+
+
+class TestXVectorizer(unittest.TestCase):
+    def check(self, lines, **stats):
+        """ Vectorized results are the same as the scalar ones."""
+        prog = load_lines(lines, keep_txt=False)
+        fns = [fn for _, _, fn in prog.formulas()]
+        ev = XEvaluator(prog)
+        expect = [ev.result(fn) for fn in fns]
+        ev = XEvaluator(prog)
+        vec = XVectorizer(ev)
+        rtn = vec.run()
+        self.assertEqual([ev.result(fn) for fn in fns], expect)
+        self.assertEqual([type(ev.result(fn)) for fn in fns], [type(v) for v in expect])
+        for k, v in stats.items():
+            self.assertEqual(rtn[k], v, k)
+        return ev, vec
+
+    def test_blocks(self):
+        prog = load_lines(column("B{r}*2", 6) + column("B{r}+1", 3, 'C') + column("B{r}*3", 2, 'D')
+                          + ["'S'!A8 @=B8*2", "'S'!A9 @=B9*2", "'S'!A10 @=B9*2"] + column("B{r}*2", 5, 'A', 'T'))
+        blocks = sorted(find_blocks(prog, 3), key=lambda b: (b.sheet, b.col, b.top))
+        self.assertEqual([(b.sheet, b.col, b.top, b.bottom) for b in blocks],
+                         [('S', 1, 1, 6), ('S', 3, 1, 3), ('T', 1, 1, 5)])
+        self.assertEqual(blocks[0].params, [('S', 2, 0)])
+
+    def test_operators(self):
+        lines = values('B', [1, 2.5, -3, 0, 7, 10]) + values('C', [4, 0, 2, 5, 0.5, 3])
+        self.check(lines + column("-B{r}*C{r}+B{r}/4-C{r}^2&\"\"", 6, 'X')
+                   + column("-B{r}*C{r}+B{r}/4-C{r}^2+5%", 6, 'A')
+                   + column("IF(B{r}>=C{r}, B{r}-C{r}, IF(B{r}=0, 1, C{r}))", 6, 'D')
+                   + column("ABS(B{r})+MAX(B{r}, C{r}, 1)+INT(C{r}/3)", 6, 'E')
+                   + column("AND(B{r}>0, NOT(C{r}<1))", 6, 'F'),
+                   blocks=4, scalar_blocks=1, scalar_cells=6)
+
+    def test_ints(self):
+        # int results where the scalar evaluator gives an int
+        lines = values('B', [1, 2, -3, 4, 5, 6]) + values('C', [2, 0.5, 3, 1, 2, 9])
+        ev, _ = self.check(lines + column("B{r}*2-1", 6, 'D') + column("B{r}+C{r}", 6, 'E')
+                           + column("INT(C{r}*3)", 6, 'F') + column("MAX(B{r}, C{r})+ABS(B{r})", 6, 'G')
+                           + column("B{r}^2+SUM(B{r}, 1)", 6, 'H') + column("IF(B{r}>C{r}, B{r}, C{r})", 6, 'I')
+                           + column("B{r}*4503599627370496", 6, 'J') + column("-B{r}/2", 6, 'K'),
+                           blocks=8, scalar_cells=5)
+        self.assertIs(type(ev.value('S', 'D1')), int)
+        self.assertIs(type(ev.value('S', 'E2')), float)
+        self.assertIs(type(ev.value('S', 'I2')), int)
+
+    def test_fallback(self):
+        # division by zero, text and blanks are evaluated by the scalar evaluator, row by row
+        lines = values('B', [1, 2, 3, 4, '"x"', 6]) + values('C', [1, 0, 2, 0, 1, 1])
+        ev, _ = self.check(lines + column("B{r}/C{r}", 7), blocks=1, cells=7, scalar_cells=4)
+        self.assertEqual(ev.value('S', 'A2'), '#DIV/0!')
+        self.assertEqual(ev.value('S', 'A5'), '#VALUE!')
+
+    def test_dependencies(self):
+        # blocks over other blocks, and a running total which can't be vectorized
+        lines = values('B', range(1, 9)) + column("B{r}*2", 8, 'C') + column("C{r}+B{r}", 8, 'D')
+        lines += ["'S'!E1 @=D1"] + column("E{p}+D{r}", 8, 'E')[1:]
+        ev, vec = self.check(lines, blocks=2, cells=16, scalar_blocks=1, scalar_cells=7)
+        self.assertEqual(ev.value('S', 'E8'), 108)
+
+#####
+
+
+if __name__ == '__main__':
+    unittest.main()
+
+# vim: noai:ts=4:sw=4:expandtab
@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import datetime
+import unittest
+
+from spd.Compiler import load_lines
+from spd.Evaluator import XEvaluator
+from spd.Scheduler import XRecalc
+from spd.Volatile import XVolatile
+
+LINES = ["'Data'!A1 @=TODAY()",
+         "'Data'!A2 @=NOW()",
+         "'Data'!A3 @=A2*86400",
+         "'Data'!A4 @=RTGET(\"X.N\",\"BID\")",
+         "'Out'!A1 @=RTC(\"x\", 'Data'!A1)",
+         "'Out'!A2 @=RTC(\"y\", 'Data'!A3+'Data'!A4)"]
+
+T0 = datetime.datetime(2024, 1, 2, 23, 59, 58, 100000)
+
+
+class TestXVolatile(unittest.TestCase):
+    def setUp(self):
+        self.calls = 0
+
+        def rtget(ric, field):
+            self.calls += 1
+            return 1
+
+        self.prog = load_lines(LINES)
+        self.ev = XEvaluator(self.prog, {'RTGET': rtget})
+
+    def test_buckets(self):
+        vol = XVolatile(self.ev, {'NOW': 5}, clock=lambda: T0)
+        day = (T0 - datetime.datetime(1899, 12, 30)).days
+        self.assertEqual(self.ev.value('Data', 'A1'), day)
+        self.assertEqual(self.ev.value('Data', 'A3'), day * 86400 + 86395)
+        self.assertEqual(vol.tick(T0 + datetime.timedelta(seconds=1)), [])
+        self.assertEqual(self.ev.calculate(), {5: day, 6: day * 86400 + 86396})
+        self.assertEqual(self.calls, 1)
+        # NOW moves to the next bucket, TODAY too
+        self.assertEqual(vol.tick(T0 + datetime.timedelta(seconds=2)), [1, 2])
+        self.assertEqual(self.ev.calculate(), {5: day + 1, 6: (day + 1) * 86400 + 1})
+        self.assertEqual(self.calls, 1)
+        self.assertEqual(vol.stats['invalidated'], 5)
+        # NOW only
+        self.assertEqual(vol.tick(T0 + datetime.timedelta(seconds=7)), [2])
+        self.assertEqual(self.ev.value('Data', 'A1'), day + 1)
+        self.assertEqual(vol.stats['changes'], 3)
+
+    def test_recalc(self):
+        rc = XRecalc(self.prog, ev=self.ev)
+        vol = XVolatile(self.ev, clock=lambda: T0, recalc=rc)
+        rc.run()
+        vol.tick(T0 + datetime.timedelta(seconds=0.5))
+        self.assertEqual(rc.pending(), 0)
+        vol.tick(T0 + datetime.timedelta(seconds=1))
+        self.assertEqual([ln for ln, _ in rc.run()], [6])
+
+
+#############################################################################
+# Unit Test
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,26 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""Workbooks shared by the tests, as `compile_lines` input."""
+
+# Alias, static value, ingress and one formula reading all of them
+BASE = ["RATE @= 'Data'!B1",
+        "'Data'!B1 @=1.5",
+        "'Data'!A1 @=RTGET(\"X.N\",\"BID\")",
+        "'Data'!A2 @=A1*RATE+'Data'!B1"]
+
+# BASE with a range formula, a reference and one egress cell
+WORKBOOK = BASE + ["'Data'!C1:C3 @=SUM(A1:A2)",
+                   "'Data'!D1 @=A2",
+                   "'Out'!A1 @=RTC(\"x\", 'Data'!D1, 'Data'!C2)"]
+
+# Operators, branches, text and errors for the evaluators
+FORMULAS = BASE[:2] + ["'Data'!B2 @=\"USD\""] + BASE[2:] + [
+    "'Data'!A3 @=IF(A1>100, TR(\"X.N\", \"ASK\"), A2-1)",
+    "'Data'!A4 @=IF(A1>100, TR(\"X.N\", \"LAST\"))",
+    "'Data'!A5 @=IF(A1, B1, B2) & \"-\" & 50%",
+    "'Data'!A6 @=SUM(A1:A2)/-2",
+    "'Data'!A7 @=1/0",
+    "'Out'!A1 @=RTC(\"x\", 'Data'!A3)"]
+
+# vim: noai:ts=4:sw=4:expandtab